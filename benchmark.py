@@ -0,0 +1,348 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+'''
+Benchmarks for DictLiteStore.
+-----------------------------
+
+Run with:
+
+    python benchmark.py [--rows N] [--db FILE]
+
+or, for the full suite (every kind of document, every operation, in memory
+and in a file), saving the results as JSON to compare with other versions:
+
+    python benchmark.py --suite --rows 10000 1000000 --json results.json
+
+'''
+
+import sys
+reload(sys)
+sys.setdefaultencoding('utf-8') # pylint: disable=no-member
+
+import os
+import time
+import json
+import random
+import sqlite3
+import argparse
+import platform
+import threading
+import dictlitestore
+from dictlitestore import DictLiteStore, AsyncDictLiteStore, CODECS
+
+# pylint: disable=missing-docstring, invalid-name
+
+############################################
+
+def make_documents(count, width=10):
+    ''' generate $count slightly different documents, with $width keys each,
+        picked from a pool of (2 * width) keys. '''
+    for i in xrange(count):
+        yield dict(('key%d' % ((i + k) % (width * 2)), u'value %d' % i)
+                   for k in xrange(width))
+
+def timed(function, *args):
+    ''' run function(*args), return how long it took, in seconds. '''
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+def fresh_db(db_name):
+    if db_name != ':memory:' and os.path.exists(db_name):
+        os.remove(db_name)
+
+############################################
+
+def bench_store_loop(db_name, rows):
+    fresh_db(db_name)
+    with DictLiteStore(db_name) as s:
+        for document in make_documents(rows):
+            s.store(document)
+
+def bench_store_many(db_name, rows):
+    fresh_db(db_name)
+    with DictLiteStore(db_name) as s:
+        s.store_many(make_documents(rows))
+
+def bench_parallel_ingest(db_name, rows):
+    fresh_db(db_name)
+    with DictLiteStore(db_name) as s:
+        s.parallel_ingest(make_documents(rows))
+
+def bench_write_behind(db_name, rows):
+    fresh_db(db_name)
+    with DictLiteStore(db_name, write_behind=True) as s:
+        for document in make_documents(rows):
+            s.store(document)
+
+def realistic_documents(count):
+    ''' documents shaped something like what people actually store. '''
+    for i in xrange(count):
+        yield {'title': u'Document number %d' % i,
+               'author': u'Ζαχαρίας' if i % 3 else u'dan',
+               'views': i * 7,
+               'rating': i / 3.0,
+               'published': bool(i % 2),
+               'tags': [u'tag%d' % (i % 5), u'python', u'sqlite'],
+               'meta': {'source': u'import', 'line': i}}
+
+def bench_codec(codec, documents):
+    ''' encode and decode every value in $documents with $codec,
+        returns (encode_seconds, decode_seconds) '''
+    encode, decode = codec.encode, codec.decode
+
+    start = time.time()
+    encoded = [[encode(v) for v in d.itervalues()] for d in documents]
+    middle = time.time()
+    for values in encoded:
+        for v in values:
+            decode(v.encode('utf-8') if isinstance(v, unicode) else v)
+    return middle - start, time.time() - middle
+
+class PlainJSON(object):
+    ''' what was used before codecs, for comparison. '''
+    @staticmethod
+    def encode(value):
+        return json.dumps(value, default=unicode, ensure_ascii=False)
+    decode = staticmethod(json.loads)
+
+def codec_benchmarks(rows):
+    documents = list(realistic_documents(rows))
+    codecs = [('plain json', PlainJSON)] + sorted(CODECS.items())
+    for name, codec in codecs:
+        encoding, decoding = bench_codec(codec, documents)
+        print '%-20s %8d docs  encode %6.3fs  decode %6.3fs' % (
+            'codec: ' + name, rows, encoding, decoding)
+
+def loop_latency(db_name, rows, ticks=50):
+    '''
+    pretend to be an event loop, which makes a query (and a write) every
+    tick.  How long is the loop stuck each tick, calling DictLiteStore
+    directly, vs AsyncDictLiteStore?
+    '''
+    fresh_db(db_name)
+    with DictLiteStore(db_name) as s:
+        s.store_many(make_documents(rows))
+
+    def run(tick):
+        blocked = []
+        for i in xrange(ticks):
+            start = time.time()
+            tick(i)
+            blocked.append(time.time() - start)
+        return blocked
+
+    with DictLiteStore(db_name) as s:
+        sync = run(lambda i: (s.get(('key1', '==', 'value %d' % i)),
+                              s.store({'tick': i})))
+
+    futures = []
+    with AsyncDictLiteStore(db_name) as s:
+        background = run(lambda i: futures.extend([
+            s.get(('key1', '==', 'value %d' % i)), s.store({'tick': i})]))
+        for future in futures:
+            future.result()
+
+    for name, blocked in (('loop: sync', sync), ('loop: async', background)):
+        print '%-20s %8d rows  max %8.2fms  mean %8.2fms blocked per tick' % (
+            name, rows, max(blocked) * 1000, sum(blocked) * 1000 / ticks)
+
+    fresh_db(db_name)
+
+def threaded_reads(db_name, rows, queries=200):
+    ''' how many queries per second, from 1, 2 and 4 threads sharing a
+        pooled DictLiteStore? '''
+    fresh_db(db_name)
+    with DictLiteStore(db_name, pooled=True) as s:
+        s.store_many(make_documents(rows))
+        s.create_index('key1')
+
+        for thread_count in (1, 2, 4):
+            def reader():
+                for i in xrange(queries):
+                    s.count(('key2', '==', 'value %d' % i))
+
+            threads = [threading.Thread(target=reader)
+                       for _ in xrange(thread_count)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            seconds = time.time() - start
+
+            print '%-20s %8d rows %8.3fs %10.0f queries/s' % (
+                'pooled: %d threads' % thread_count, rows, seconds,
+                queries * thread_count / seconds)
+
+    for suffix in ('', '-wal', '-shm'):
+        fresh_db(db_name + suffix)
+
+BENCHMARKS = [
+    ('store() loop', bench_store_loop),
+    ('store_many()', bench_store_many),
+    ('parallel_ingest()', bench_parallel_ingest),
+    ('write-behind store()', bench_write_behind),
+    ]
+
+############################################
+# The full suite:
+
+# Every document has 'n' (unique), and 'group' (one of 100), to query on.
+
+def narrow_documents(count):
+    ''' 5 keys, every document has all of them. '''
+    for i in xrange(count):
+        yield {'n': i, 'group': i % 100, 'name': u'name %d' % i,
+               'score': i * 0.5, 'ok': bool(i % 2)}
+
+def wide_sparse_documents(count):
+    ''' 10 keys each, out of 500 (so most columns are NULL in any row). '''
+    for i in xrange(count):
+        document = dict(('key%d' % ((i * 7 + k * 50) % 500), i + k)
+                        for k in xrange(10))
+        document.update(n=i, group=i % 100)
+        yield document
+
+def wide_dense_documents(count):
+    ''' 100 keys, every document has all of them. '''
+    for i in xrange(count):
+        document = dict(('key%d' % k, u'value %d' % (i + k))
+                        for k in xrange(100))
+        document.update(n=i, group=i % 100)
+        yield document
+
+def nested_documents(count):
+    ''' lists and dicts inside documents. '''
+    for i, document in enumerate(realistic_documents(count)):
+        document.update(n=i, group=i % 100)
+        yield document
+
+def unicode_documents(count):
+    ''' long-ish non-ascii text (and keys). '''
+    text = u'Ζαχαρίας ☃ 日本語のテキスト "quoted" \\ '
+    for i in xrange(count):
+        yield {'n': i, 'group': i % 100, u'τίτλος': text * 3 + unicode(i),
+               u'ключ': text[::-1], 'body': text * 10}
+
+SHAPES = [
+    ('narrow', narrow_documents),
+    ('wide-sparse', wide_sparse_documents),
+    ('wide-dense', wide_dense_documents),
+    ('nested', nested_documents),
+    ('unicode', unicode_documents),
+    ]
+
+def suite(db_name, shape, documents, rows, queries=1000, seed=1,
+          output=sys.stdout):
+    '''
+    run every operation against $rows documents of one $shape, returns
+    a list of results, (and prints them to $output, as they're done).
+    (The same seed picks the same rows to look up.)
+    '''
+
+    results = []
+    queries = min(queries, rows)
+    picked = random.Random(seed).sample(xrange(rows), queries)
+
+    def record(operation, count, seconds):
+        results.append({'operation': operation, 'shape': shape,
+                        'db': 'memory' if db_name == ':memory:' else 'file',
+                        'rows': rows, 'count': count, 'seconds': seconds,
+                        'per_second': count / seconds if seconds else None})
+        print >> output, '%-12s %-6s %-22s %9d rows %8.3fs %10.0f /s' % (
+            shape, results[-1]['db'], operation, rows, seconds,
+            results[-1]['per_second'] or 0)
+
+    def each(function):
+        return lambda: [function(i) for i in picked]
+
+    fresh_db(db_name)
+    with DictLiteStore(db_name) as s:
+        record('store_many()', rows, timed(s.store_many, documents(rows)))
+        record('create_index()', 1, timed(s.create_index, 'n'))
+
+        # (Ids don't always follow n, as store_many() groups documents.)
+        record('get_by_id()', queries, timed(each(lambda i: s.get_by_id(i + 1))))
+        record('get() indexed ==', queries,
+               timed(each(lambda i: s.get(('n', '==', i)))))
+        record('get() scan', 10,
+               timed(lambda: [s.get(('group', '==', g)) for g in xrange(10)]))
+        record('count() scan', 10,
+               timed(lambda: [s.count(('group', '==', g)) for g in xrange(10)]))
+        record('get() sort + limit', 10,
+               timed(lambda: [s.get(order=[('group', 'DESC')], limit=100,
+                                    offset=o * 100) for o in xrange(10)]))
+        record('iterget() all', rows, timed(lambda: sum(1 for _ in s.iterget())))
+        record('update() indexed', queries,
+               timed(each(lambda i: s.update({'updated': True}, False,
+                                              ('n', '==', i)))))
+        record('delete() indexed', queries,
+               timed(each(lambda i: s.delete(('n', '==', i)))))
+        record('commit()', 1, timed(s.db.commit))
+
+    fresh_db(db_name)
+    return results
+
+def run_suite(options):
+    ''' run the whole suite, and save the results as JSON. '''
+
+    # (if the JSON goes to stdout, the table goes to stderr, out of its way)
+    output = sys.stderr if options.json == '-' else sys.stdout
+
+    results = []
+    for rows in options.rows:
+        for shape, documents in SHAPES:
+            for db_name in (':memory:', options.db):
+                results.extend(suite(db_name, shape, documents, rows,
+                                     options.queries, options.seed, output))
+
+    report = {'version': dictlitestore.__version__,
+              'python': platform.python_version(),
+              'sqlite': sqlite3.sqlite_version,
+              'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'seed': options.seed,
+              'results': results}
+
+    if options.json == '-':
+        print json.dumps(report, indent=1)
+    elif options.json:
+        with open(options.json, 'w') as output:
+            json.dump(report, output, indent=1)
+
+############################################
+
+def main():
+    parser = argparse.ArgumentParser(description='DictLiteStore benchmarks')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000])
+    parser.add_argument('--db', default='__bench.db')
+    parser.add_argument('--suite', action='store_true',
+                        help='run the full suite')
+    parser.add_argument('--queries', type=int, default=1000,
+                        help='(suite) lookups, updates & deletes to time')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='(suite) for picking which rows to look up')
+    parser.add_argument('--json', metavar='FILE',
+                        help='(suite) save the results here (- for stdout)')
+    options = parser.parse_args()
+
+    if options.suite:
+        return run_suite(options)
+
+    for rows in options.rows:
+        for name, function in BENCHMARKS:
+            seconds = timed(function, options.db, rows)
+            print '%-20s %8d rows %8.3fs %10.0f rows/s' % (
+                name, rows, seconds, rows / seconds)
+
+        fresh_db(options.db)
+
+        codec_benchmarks(rows)
+
+        loop_latency(options.db, rows)
+
+        threaded_reads(options.db, rows)
+
+if __name__ == '__main__':
+    main()
@@ -55,13 +55,36 @@ import sys
 reload(sys)
 sys.setdefaultencoding('utf-8') # pylint: disable=no-member
 
+import os
+import re
+import csv
+import base64
+import argparse
+import time
+import threading
+import Queue
+import multiprocessing
 import sqlite3 as lite
 try:
     import simplejson as json # pylint: disable=import-error
 except ImportError:
     import json
 
+try:
+    import msgpack # pylint: disable=import-error
+except ImportError:
+    msgpack = None # pylint: disable=invalid-name
+
+import zlib
+import heapq
 import logging
+from itertools import islice, groupby
+from operator import itemgetter
+from functools import wraps
+from copy import copy, deepcopy
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from bisect import bisect
 
 log = logging.getLogger(__name__) #pylint: disable=invalid-name
 
@@ -83,7 +106,31 @@ _WHERE_OPERATORS = [  #pylint: disable=invalid-name
     '+','-',
     '<<','>>','&', '|',
     '<','<=','>','>=',
-    '=','==','!=','<>','IS','IS NOT','IN','LIKE','GLOB','MATCH','REGEXP']
+    '=','==','!=','<>','IS','IS NOT','IN','LIKE','GLOB','MATCH','REGEXP',
+    'NOT IN','NOT LIKE','BETWEEN','NOT BETWEEN','IS NULL','IS NOT NULL']
+
+# Operators which don't take a value, take a list of values, or (low, high):
+_NO_VALUE_OPERATORS = frozenset(['IS NULL', 'IS NOT NULL']) #pylint: disable=invalid-name
+_LIST_OPERATORS = frozenset(['IN', 'NOT IN']) #pylint: disable=invalid-name
+_RANGE_OPERATORS = frozenset(['BETWEEN', 'NOT BETWEEN']) #pylint: disable=invalid-name
+
+# The functions aggregate() can use:
+_AGGREGATES = {  #pylint: disable=invalid-name
+    u'count': u'COUNT({0})',
+    u'count_distinct': u'COUNT(DISTINCT {0})',
+    u'sum': u'SUM({0})',
+    u'total': u'TOTAL({0})',
+    u'avg': u'AVG({0})',
+    u'min': u'MIN({0})',
+    u'max': u'MAX({0})',
+    }
+
+# The primary key column, which every table has:
+_ID_COLUMN = u'Id' #pylint: disable=invalid-name
+
+# Operators in where clauses which can use an index:
+_INDEXABLE_OPERATORS = frozenset([  #pylint: disable=invalid-name
+    '<','<=','>','>=','=','==','IS','IN','BETWEEN','IS NULL'])
 
 def clean(unclean):
     ''' Makes a string safe (and unicode) to use as
@@ -116,293 +163,4229 @@ def json_or_raw(text):
         return json.dumps(text)
 
 
-def _prepare_values(document):
+################################################################################
+# Codecs: how values are turned into something SQLite can store, and back.
+
+class JSONCodec(object):
     '''
-    get the values from document, and turn them into safe json strings.
+    The default codec.  Values are stored as JSON text, which is easy to
+    read and query with plain SQL.
+
     *NOTE* this is lossy.  Un-jsonable data will simply
            be dropped into it's string version!
     '''
-    return [json.dumps(x, default=unicode, ensure_ascii=False) \
-         for x in document.values()]
 
-def _make_where_clause(*args):
+    name = u'json'
+
+    # Plain strings and ints don't need to go all the way through json:
+    _needs_escaping = re.compile(u'["\\\\\x00-\x1f]').search
+
+    def encode(self, value):
+        ''' turn a python value into json text. '''
+        value_type = type(value)
+        if value_type is unicode and not self._needs_escaping(value):
+            return u'"' + value + u'"'
+        elif value_type is int or value_type is long:
+            return str(value)
+        return json.dumps(value, default=unicode, ensure_ascii=False)
+
+    def decode(self, text):
+        ''' turn json text back into a python value. '''
+        if text[:1] == '"' and '\\' not in text:
+            return text[1:-1].decode('utf-8')
+        elif text.isdigit():
+            return int(text)
+        return json.loads(text)
+
+
+class MsgpackCodec(object):
+    '''
+    Values are stored as msgpack BLOBs, which are smaller and faster than
+    JSON, but can't be queried with LIKE, or read by humans.
+    (Needs the msgpack module.)
+    '''
+
+    name = u'msgpack'
+
+    @staticmethod
+    def encode(value):
+        ''' turn a python value into a msgpack BLOB. '''
+        return lite.Binary(msgpack.packb(value, default=unicode,
+                                         use_bin_type=True))
+
+    @staticmethod
+    def decode(blob):
+        ''' turn a msgpack BLOB back into a python value. '''
+        return msgpack.unpackb(bytes(blob), raw=False)
+
+
+class NativeCodec(object):
+    '''
+    Strings and numbers are stored as plain SQLite TEXT, INTEGER and REAL,
+    so ('price', '>', 10) and ordering compare them as numbers (and can
+    use indexes), and LIKE works without NoJSON.  Everything else (lists,
+    dicts, True/False, None, and numbers too big for SQLite) is stored as
+    a JSON BLOB.  The SQLite type of each value says which it was, so they
+    all come back exactly as they went in.
+    '''
+
+    name = u'native'
+
+    @staticmethod
+    def encode(value):
+        ''' turn a python value into something SQLite can store. '''
+        value_type = type(value)
+        if value_type is unicode or value_type is str:
+            return value
+        elif value_type is int or value_type is long:
+            if -2 ** 63 <= value < 2 ** 63:
+                return value
+        elif value_type is float:
+            if value == value: # (NaN would be stored as NULL)
+                return value
+        return lite.Binary(json.dumps(value, default=unicode,
+                                      ensure_ascii=False).encode('utf-8'))
+
+    @staticmethod
+    def decode(stored):
+        ''' turn what SQLite gives back into the python value. '''
+        if type(stored) is str:
+            return stored.decode('utf-8')
+        elif type(stored) is buffer:
+            return json.loads(bytes(stored))
+        return stored
+
+
+# All the codecs which can be used, by name.  If you write your own, (any
+# object with .name, .encode(value) and .decode(stored_value) will do),
+# add it here, so tables using it can be opened again.
+CODECS = {JSONCodec.name: JSONCodec(),  #pylint: disable=invalid-name
+          NativeCodec.name: NativeCodec()}
+
+if msgpack:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+_DEFAULT_CODEC = CODECS[JSONCodec.name] #pylint: disable=invalid-name
+
+def _prepare_values(document, encode=_DEFAULT_CODEC.encode):
+    '''
+    get the values from document, and turn them into something which can
+    be stored (by default, safe json strings).
+    '''
+    return [encode(x) for x in document.values()]
+
+def _chunks(iterable, size):
+    '''
+    split an iterable up into lists of (at most) $size items.
+    If size is None, then everything comes back as one list.
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _encode_chunk(chunk, encode, storage=u'columns'):
+    '''
+    encode a list of documents, grouped by their keys, ready to INSERT:
+    {(key, ...): [[value, ...], ...]}.  (In json storage, every document
+    is one value, in the document column.)
+    '''
+
+    if storage == u'json':
+        return {(_DOCUMENT_COLUMN,): [[encode(_nested(document))]
+                                      for document in chunk]}
+
+    groups = {}
+    for document in chunk:
+        groups.setdefault(tuple(document.keys()), []) \
+              .append(_prepare_values(document, encode))
+    return groups
+
+def _ingest_worker(tasks, results, codec, storage):
+    '''
+    (a parallel_ingest() worker process) encode (number, chunk)s from tasks
+    until it gets None, putting (number, [(column names, rows, has blobs)],
+    documents, error) on results for each.
+    '''
+
+    for number, chunk in iter(tasks.get, None):
+        try:
+            groups = {}
+            for keys, rows in _encode_chunk(chunk, codec.encode,
+                                            storage).items():
+                # ('a' and u'a' are the same column):
+                groups.setdefault(tuple(unicode(k) for k in keys),
+                                  []).extend(rows)
+
+            encoded = []
+            for keys, rows in groups.items():
+                # buffers (BLOBs) can't be pickled, bytearrays can:
+                blobs = any(type(value) is buffer
+                            for row in rows for value in row)
+                if blobs:
+                    rows = [[bytearray(value) if type(value) is buffer
+                             else value for value in row] for row in rows]
+                encoded.append((keys, rows, blobs))
+
+            results.put((number, encoded, len(chunk), None))
+        except Exception as err: # pylint: disable=broad-except
+            results.put((number, None, 0, repr(err)))
+
+    results.put(None)
+
+def _feed_chunks(documents, chunk_size, tasks, workers, stop, errors):
+    '''
+    (a parallel_ingest() thread) put numbered chunks of documents on tasks,
+    (waiting when it's full) and then a None for each worker.
+    '''
+
+    def put(item):
+        ''' put(), unless parallel_ingest() has given up. '''
+        while not stop.is_set():
+            try:
+                tasks.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    try:
+        for number, chunk in enumerate(_chunks(documents, chunk_size)):
+            if not put((number, chunk)):
+                return
+    except Exception as err: # pylint: disable=broad-except
+        errors.append(err)
+
+    for _ in xrange(workers):
+        put(None)
+
+def _decode_row(row, decode=_DEFAULT_CODEC.decode):
+    '''
+    turn a sqlite3.Row back into a dict, decoding the values, and
+    dropping NULLs (which are columns the document didn't have).
+    '''
+    return dict((key, decode(value))
+                for key, value in zip(row.keys(), row)
+                if value is not None and key != _ID_COLUMN)
+
+def _make_limit_clause(limit=None, offset=None):
     '''
-    given a list of three-tuples (column_name, operator, value)
-    return the valid SQL version of it for use at the end of queries.
+    return ('LIMIT (?) OFFSET (?)', [limit, offset]) for the end of a
+    SELECT, or nothing, if neither is set.
     '''
 
-    if len(args) == 0:
+    if limit is None and offset is None:
         return u'', []
 
-    # collection boxes:
-    where_clauses = []
-    sql_values = []
+    # SQLite needs a LIMIT if there's an OFFSET. -1 means no limit.
+    return u'LIMIT (?) OFFSET (?)', [-1 if limit is None else int(limit),
+                                     int(offset or 0)]
+
+class And(object): # pylint: disable=too-few-public-methods
+    '''
+    Where clauses which must all match, (which is what a list of them
+    means anyway), for grouping them inside Or() or Not():
+
+    >>> bucket.get(Or(('a', '==', 1), And(('b', '==', 2), ('c', '>', 3))))
+    '''
+
+    joiner = u' AND '
+    empty = u'1'
+    negate = False
 
-    # work through inputs, sanitize 'em and put them in the collection:
-    for (col, operator, value) in args:
+    def __init__(self, *clauses):
+        self.clauses = clauses
+
+    def __repr__(self):
+        return u'{0}{1!r}'.format(type(self).__name__, self.clauses)
+
+class Or(And): # pylint: disable=too-few-public-methods
+    ''' Where clauses, any of which can match. '''
+    joiner = u' OR '
+    empty = u'0'
+
+class Not(And): # pylint: disable=too-few-public-methods
+    ''' Where clause(s) which must *not* (all) match. '''
+    empty = u'0'    # (NOT of nothing, which always matches)
+    negate = True
+
+class Param(object): # pylint: disable=too-few-public-methods
+    '''
+    A value in a compile()d query, which is filled in later, by name.
+    (For IN, a Param is the whole list of values.)
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return u'Param({0!r})'.format(self.name)
+
+def _compile_where(args, column=cleanq):
+    '''
+    turn a list of where clauses, (three-tuples of (column_name, operator,
+    value), and And/Or/Not of them), into (parts, slots).  parts is the
+    SQL, with numbers where the '?,?,?'s for IN Params go, and slots is
+    where each value comes from, as (value or Param, is_a_list).
+    '''
+
+    parts = []
+    slots = []
+
+    def add(clause, top=False):
+        ''' add the SQL (and slots) for one clause. '''
+
+        if isinstance(clause, And):
+            if not clause.clauses:
+                parts.append(clause.empty)
+                return
+            if clause.negate:
+                parts.append(u'NOT ')
+            if not top:
+                parts.append(u'(')
+            for number, inner in enumerate(clause.clauses):
+                if number:
+                    parts.append(clause.joiner)
+                add(inner)
+            if not top:
+                parts.append(u')')
+            return
+
+        col, operator, value = (tuple(clause) + (None,))[:3]
         if not operator in _WHERE_OPERATORS:
             raise KeyError('Invalid operator ({0})'.format(operator))
-        where_clauses.append(u' '.join([cleanq(col),
-                                        unicode(operator),
-                                        u'(?)']))
-        if isinstance(value, NoJSON):
-            sql_values.append(value)
-        else:
-            sql_values.append(json.dumps(value))
 
-    return u'WHERE' + u' AND '.join(where_clauses), sql_values
+        parts.append(column(col) + u' ' + unicode(operator))
 
+        if operator in _NO_VALUE_OPERATORS:
+            return
+        elif operator in _RANGE_OPERATORS:
+            low, high = value
+            parts.append(u' (?) AND (?)')
+            slots.extend([(low, False), (high, False)])
+        elif operator in _LIST_OPERATORS and isinstance(value, Param):
+            parts.extend([u' (', sum(many for _, many in slots), u')'])
+            slots.append((value, True))
+        elif operator in _LIST_OPERATORS and hasattr(value, '__iter__'):
+            value = list(value)
+            parts.append(u' (' + u','.join(len(value) * u'?') + u')')
+            slots.extend((item, False) for item in value)
+        else:
+            parts.append(u' (?)')
+            slots.append((value, False))
 
-################################################################################
+    add(And(*args), top=True)
 
+    # Join up the plain SQL between the IN Params:
+    joined = [u'']
+    for part in parts:
+        if isinstance(part, int):
+            joined.extend([part, u''])
+        else:
+            joined[-1] += part
 
-class DictLiteStore(object):
+    return joined, slots
+
+class Query(object):
     '''
-    A simple(ish) way to store dict-like objects in a SQLite database,
-    which can then be queried against.  Useful for caching schemaless data.
+    A where clause, which is turned into SQL once, and can then be run again
+    and again, only putting in new values for its Params.  Make them with
+    DictLiteStore.compile(), and use them with any DictLiteStore which
+    stores things the same way.
+
+    >>> popular = bucket.compile(('views', '>', Param('views')),
+    ...                          ('tag', 'IN', Param('tags')))
+    >>> bucket.get(popular.bind(views=100, tags=['python', 'sqlite']))
     '''
 
-    def __init__(self, db_name=":memory:", table_name=u"def"):
-        '''
-        Initialise the object, but don't actually open the database
-        connection yet.
-        '''
+    def __init__(self, args, column=cleanq, encode=_DEFAULT_CODEC.encode):
+        self.args = args
+        self.params = {}
+        self._encode = encode
+        self._parts, self._slots = _compile_where(args, column)
+        self._sql = {}
 
-        self.db_name = db_name
-        self.table_name = clean(table_name)
+    def bind(self, **params):
+        ''' A copy of this query, with values for its Params. '''
+        bound = object.__new__(Query)
+        bound.__dict__.update(self.__dict__)
+        bound.params = params
+        return bound
 
-    def open(self):
+    def where_clause(self):
         '''
-        open the connection to the database.
-        if you call this function, remember to close() as well.
+        Returns ('WHERE ...', values), (or nothing, for an empty query).
+        The SQL is only made once, (well, once for each length of lists
+        given to IN Params).
         '''
 
-        self.db = lite.connect(self.db_name)
-        self.db.text_factory = lambda x: x.encode('utf-8')
-        self.db.row_factory = lite.Row
-        self.cur = self.db.cursor()
+        if not self.args:
+            return u'', []
 
-        self.cur.execute(u'CREATE TABLE IF NOT EXISTS'
-                          ' "{0}"(Id INT)'.format(self.table_name))
-        self.db.commit()
+        encode = self._encode
+        values = []
+        lengths = []
 
-        self.sql_columns = []
+        for value, many in self._slots:
+            if isinstance(value, Param):
+                value = self.params[value.name]
+            if many:
+                value = list(value)
+                lengths.append(len(value))
+            else:
+                value = [value]
+            values.extend(item if isinstance(item, NoJSON) else encode(item)
+                          for item in value)
 
-        # Get current columns:
-        self.cur.execute(u"PRAGMA table_info(\"{0}\")".format(self.table_name))
+        lengths = tuple(lengths)
+        sql = self._sql.get(lengths)
+        if sql is None:
+            sql = self._sql[lengths] = u'WHERE ' + u''.join(
+                part if isinstance(part, unicode) else
+                u','.join(lengths[part] * u'?') for part in self._parts)
 
-        # Add them to the sql_columns list:
-        for row in self.cur.fetchall()[1:]:
-            self.sql_columns.append(row[1])
+        return sql, values
 
-    def close(self):
-        '''
-        commit and close the database connection. if you use
-        the 'with DictLiteStore(...) as ...' pattern, you don't need
-        to call this.
-        '''
+def _where_leaves(args):
+    ''' all the (column_name, operator, value) clauses in a where clause. '''
 
-        self.db.commit()
-        self.db.close()
+    for clause in args:
+        if isinstance(clause, And):
+            for leaf in _where_leaves(clause.clauses):
+                yield leaf
+        else:
+            yield (tuple(clause) + (None,))[:3]
 
-    def __enter__(self):
-        ''' Open the database connection.
-            Called in the 'with' pattern. '''
-        self.open()
-        return self
+def _make_where_clause(*args, **kwargs):
+    '''
+    given a list of three-tuples (column_name, operator, value), (or And,
+    Or and Not of them), return the valid SQL version of it for use at the
+    end of queries.  (values are encoded with encode=..., which defaults to
+    json, and column names are turned into SQL with column=..., which
+    defaults to quoting them.)
+    '''
 
-    def __exit__(self, exptype, expvalue, exptb):
-        ''' Close the database connection.
-            Called in the 'with' pattern. '''
-        self.close()
+    return Query(args, kwargs.get('column', cleanq),
+                 kwargs.get('encode', _DEFAULT_CODEC.encode)).where_clause()
 
-    def _update_columns(self, document):
-        ''' Update the table 'schema' to have any columns which the document
-            has, but the table doesn't.
-            Returns a list of the columns, quoted and ready to use
-            in a query. '''
 
-        columns = []
-        for raw_key in document.keys():
-            # Clean the key:
-            key = clean(raw_key)
-
-            # If needed, add a new column to the self.db:
-            if key not in self.sql_columns:
-                sql = u"ALTER TABLE \"{0}\" " \
-                      u"ADD COLUMN \"{1}\"".format(self.table_name, key)
-                self.cur.execute(sql)
-                self.sql_columns.append(key)
-            # Add this item to the list of stuff to commit:
-            columns.append(u'"' + key + u'"')
+################################################################################
+# JSON storage: each document is kept whole, as JSON text, in one column.
 
-        # Commit new columns:
-        self.db.commit()
+# The column documents are kept in, in json storage:
+_DOCUMENT_COLUMN = u'document' #pylint: disable=invalid-name
 
-        return columns
+# The ways documents can be laid out in a table:
+STORAGES = (u'columns', u'json')
 
-    def store(self, document):
-        '''
-        Store a dictionary (doc) in the database.
-        Update the table columns as needed.
-        '''
+# Parts of a JSON1 path, '$."key"."other key"[0]':
+_PATH_PARTS = re.compile(r'\."((?:[^"\\]|\\.)*)"|\[(\d+)\]')  #pylint: disable=invalid-name
 
-        # Prepare the table, and get column names:
-        columns = self._update_columns(document)
+# The paths in an index made by create_index() in json storage:
+_INDEX_PATHS = re.compile(  #pylint: disable=invalid-name
+    r'json_extract\("' + _DOCUMENT_COLUMN + r'", \'((?:[^\']|\'\')*)\'\)')
 
-        # Prepare the data for writing:
-        values = _prepare_values(document)
+def _json_path(key, nested=True):
+    '''
+    turn a key into a JSON1 path, quoted ready to go straight into SQL.
+    If nested, dots go down into the document, and numbers into lists,
+    so 'a.b.0' is '$."a"."b"[0]'.  (SQLite can't do paths to keys with '"'
+    in them, so those raise ValueError.)
+    '''
 
-        # Prepare the query:
-        sql = self._make_insert(columns)
+    parts = unicode(key).split(u'.') if nested else [unicode(key)]
+    path = [u'$']
 
-        # Debug logging...
-        log.debug ('SQL: %s DATA: %s', sql, values)
+    for number, part in enumerate(parts):
+        if number and part.isdigit():
+            path.append(u'[' + part + u']')
+            continue
+        label = json.dumps(part, ensure_ascii=False)[1:-1]
+        if u'"' in label:
+            raise ValueError('Keys with " in them can\'t be used in json '
+                             'storage queries ({0})'.format(key))
+        path.append(u'."' + label + u'"')
 
-        # Run it!
-        self.cur.execute(sql, values)
+    return u"'" + u''.join(path).replace(u"'", u"''") + u"'"
 
-    def update(self, document, insert=True, *args):
-        '''
-        Update a row in the database.  If $insert is true,
-        then insert the data as a new row, if nothing is updated.
-        '''
+def _json_text(column, path):
+    '''
+    the SQL for the JSON text at $path in $column, or NULL if it's not there,
+    (like "column" -> path, but that needs SQLite 3.38).
+    '''
 
-        assert hasattr(document, 'items')
+    return u'CASE WHEN json_type({0}, {1}) IS NOT NULL THEN ' \
+           u'json_quote(json_extract({0}, {1})) END'.format(column, path)
 
-        # Prepare the table, and get column names:
-        columns = self._update_columns(document)
+def _nested(document):
+    '''
+    (json storage) the document which writing $document over an empty one
+    with json_set() makes, so dotted keys go down into it, as they do in
+    where clauses and updates: {'a.b': 1, 'tags.0': 'x'} is
+    {'a': {'b': 1}, 'tags': ['x']}.  (Paths through something which isn't
+    an object / list, or past the end of a list, are ignored, like
+    json_set() does.)
+    '''
 
-        # Prepare the data for writing:
-        values = _prepare_values(document)
+    if not any(u'.' in unicode(key) for key in document):
+        return document
 
-        # Prepare the query:
-        sql, where_values = self._make_update(columns, args)
+    nested = {}
+    for key, value in document.items():
+        parts = unicode(key).split(u'.')
+        labels = [int(part) if number and part.isdigit() else part
+                  for number, part in enumerate(parts)]
+        # (so later keys going inside it don't change the caller's value)
+        value = deepcopy(value) if isinstance(value, (dict, list)) else value
 
-        # Debug logging
-        log.debug ('SQL: %s, DATA: %s, WHERE: %s', sql, values, where_values)
+        holder = nested
+        for number, label in enumerate(labels):
+            last = number == len(labels) - 1
+            if last:
+                child = value
+            else:
+                child = [] if isinstance(labels[number + 1], int) else {}
 
-        self.cur.execute(sql, values + where_values)
+            if isinstance(holder, dict) and not isinstance(label, int):
+                if last or label not in holder:
+                    holder[label] = child
+            elif isinstance(holder, list) and isinstance(label, int) and \
+              label <= len(holder):
+                if label == len(holder):
+                    holder.append(child)
+                elif last:
+                    holder[label] = child
+            else:
+                break
+            holder = holder[label]
 
-        if self.cur.rowcount == 0 and insert:
-            # No rows were modifed by query, and the user wants
-            # us to insert a row if that's the case.
-            sql = self._make_insert(columns)
-            self.cur.execute(sql, values)
+    return nested
 
-        return self.cur.rowcount
+def _path_key(path):
+    ''' turn a JSON1 path from _json_path() back into a dotted key. '''
+    return u'.'.join(json.loads(u'"' + label + u'"') if label else index
+                     for label, index in _PATH_PARTS.findall(path))
 
-    def _make_insert(self, columns):
-        '''
-        Given a simple list of column names,
-        return 'INSERT INTO "x"(column_names, etc) VALUES(?, ?)'
-        '''
+def _sql_value(value):
+    '''
+    turn a value into what json_extract() would give back for it, so it
+    can be compared in a where clause.  (Lists & dicts are compared as
+    compact JSON text.)
+    '''
 
-        return u'INSERT INTO "{0}"({1}) VALUES({2})'.format( \
-                    self.table_name, \
-                    u','.join(columns), \
-                    u','.join(len(columns)*u'?'))
+    if isinstance(value, bool):
+        return int(value)
+    elif value is None or isinstance(value, (basestring, int, long, float)):
+        return value
+    return json.dumps(value, separators=(',', ':'), default=unicode,
+                      ensure_ascii=False)
+
+################################################################################
+
+# PRAGMAs which can be set for every connection, and their allowed
+# (non-numeric) values:
+_PRAGMAS = {  #pylint: disable=invalid-name
+    u'journal_mode': (u'DELETE', u'TRUNCATE', u'PERSIST', u'MEMORY', u'WAL',
+                      u'OFF'),
+    u'synchronous': (u'OFF', u'NORMAL', u'FULL', u'EXTRA'),
+    u'cache_size': (),
+    u'mmap_size': (),
+    u'busy_timeout': (),
+    }
+
+def _pragma_value(name, value):
+    '''
+    check a PRAGMA value is allowed (so it's safe to put in SQL),
+    raises ValueError if it isn't.
+    '''
+
+    if isinstance(value, basestring) and value.upper() in _PRAGMAS[name]:
+        return value.upper()
+    return int(value)
+
+# Where settings for each table (such as the codec) are kept:
+_META_TABLE = u'_dictlitestore_meta' #pylint: disable=invalid-name
+
+# How many prepared SQL statements to keep around, per table:
+_SQL_CACHE_SIZE = 500 #pylint: disable=invalid-name
+
+class _TableSchema(object): # pylint: disable=too-few-public-methods
+    '''
+    The columns of a table, (and a cache of SQL prepared for them),
+    which are shared by all DictLiteStores using that table.
+    '''
+
+    def __init__(self):
+        self.version = None
+        self.columns = set()
+        self.sql = {}
+        self.lock = threading.RLock()
+
+    def reset(self, version, columns):
+        ''' the schema has changed, so start again. '''
+        with self.lock:
+            # (add the new columns before taking out the old ones, so other
+            #  threads never see columns missing which are still there.)
+            columns = set(columns)
+            self.columns.update(columns)
+            self.columns.intersection_update(columns)
+            self.sql.clear()
+            self.version = version
+
+    def remember(self, key, sql):
+        ''' cache some prepared SQL (or columns), and return it. '''
+        if len(self.sql) >= _SQL_CACHE_SIZE:
+            self.sql.clear()
+        self.sql[key] = sql
+        return sql
+
+def _flushed_first(method):
+    '''
+    decorator for DictLiteStore methods which need any write-behind writes
+    to have been done first.
+    '''
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        ''' flush, then run method. '''
+        if self._buffer: # pylint: disable=protected-access
+            self.flush()
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+class _ResultCache(object):
+    '''
+    A least-recently-used cache of query results, which can also be
+    limited to how long results are kept for.  Thread safe.
+    '''
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.generation = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {u'hits': 0, u'misses': 0, u'evictions': 0,
+                       u'cleared': 0}
+
+    def get(self, key):
+        ''' the result for $key, or None. '''
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is not None and \
+              (self.ttl is None or time.time() - item[0] < self.ttl):
+                self._items[key] = item
+                self._stats[u'hits'] += 1
+                return item[1]
 
-    def _make_update(self, columns, where):
+            self._stats[u'misses'] += 1
+            return None
+
+    def put(self, key, value, generation):
         '''
-        Given a list of columns, and a DictLiteStore style where clause,
-        return ('UPDATE "x" SET a=(?),b=(?),c=(?) WHERE...', where_vals)
+        cache value, unless the cache has been cleared since $generation
+        (when the query started), in which case it might be out of date.
         '''
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._items[key] = (time.time(), value)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+                self._stats[u'evictions'] += 1
 
-        # x=(?),y=(?),z=(?)
-        update_clause = u','.join([c + u'=(?)' for c in columns])
+    def clear(self):
+        ''' throw everything away. '''
+        with self._lock:
+            self._items.clear()
+            self.generation += 1
+            self._stats[u'cleared'] += 1
 
-        # WHERE ...
-        where_clause, where_values = _make_where_clause(*where) #pylint: disable=star-args
+    def stats(self):
+        ''' hits, misses, evictions, cleared and size. '''
+        with self._lock:
+            stats = dict(self._stats)
+            stats[u'size'] = len(self._items)
+        return stats
 
-        return u'UPDATE "{0}" SET {1} {2}'.format(
-            self.table_name,
-            update_clause,
-            where_clause
-            ), where_values
+################################################################################
+# Instrumentation: (none of this runs at all, unless instrument=... is set)
 
-    def _make_order_clause(self, order_input=None):
+# The DictLiteStore methods which are instrumented:
+_INSTRUMENTED = (  #pylint: disable=invalid-name
+    u'store', u'store_many', u'update', u'update_many', u'upsert_many',
+    u'get', u'iterget', u'delete', u'count', u'exists', u'aggregate',
+    u'search', u'get_by_id', u'get_many_by_ids', u'update_by_id',
+    u'delete_by_id', u'flush', u'create_index', u'drop_index', u'get_page',
+    u'changes')
+
+# (the ones which are generators, and are timed while they're fetching)
+_INSTRUMENTED_ITERATORS = (u'iterget', u'changes')  #pylint: disable=invalid-name
+
+# How many statements to remember for each operation, to EXPLAIN if it's slow:
+_KEEP_STATEMENTS = 20 #pylint: disable=invalid-name
+
+class Instrumentation(object):
+    '''
+    Hooks which are called around every DictLiteStore operation (store(),
+    get(), ...), when it's given as DictLiteStore(..., instrument=...).
+    Override before() and/or after().  If slow is set, operations which take
+    longer than that (in seconds) have the query plans of their SELECTs,
+    UPDATEs and DELETEs included.
+    '''
+
+    slow = None
+
+    def before(self, operation, args):
+        ''' called as $operation starts. '''
+        pass
+
+    def after(self, operation, record):
         '''
-        given a list of columns to order by,
-        return the correct SQL to add into a query.
+        called when $operation has finished, with a dict of: seconds (in
+        total), sql_seconds, encode_seconds, decode_seconds, rows, bytes
+        (encoded & decoded), error (the exception, if there was one), and
+        plans ([(sql, [plan lines]), ...], if it was slow).
         '''
+        pass
 
-        if not order_input:
-            return u''
-        if not hasattr(order_input, '__iter__'):
-            # probably a string? So stuff it in a tuple.
-            order_input = (order_input,)
+class Profiler(Instrumentation):
+    '''
+    Instrumentation which keeps totals for each operation, a histogram of how
+    long they took, and the query plans of slow ones.  Thread safe.
 
-        order_segments = []
-        for order in order_input:
-            if len(order) == 2 and (order[1] == u'ASC' or order[1] == u'DESC'):
-                log.debug('sorting by %s, %s.', order[0], order[1])
-                if order[0] in self.sql_columns:
-                    order_segments.append(cleanq(order[0]) + u' ' + order[1])
-                else:
-                    log.warn('Trying to sort (ORDER), '
-                             'but "%s" is not a column.', order[0])
-            elif order in self.sql_columns:
-                order_segments.append(cleanq(order))
+    >>> profiler = Profiler(slow=0.1)
+    >>> bucket = DictLiteStore('data.db', instrument=profiler)
+    >>> ...
+    >>> profiler.stats()['get']
+    {'calls': 1200, 'seconds': 3.1, 'sql_seconds': 2.2, ...}
+    '''
 
-        if not order_segments:
-            return u''
+    # The histogram buckets: (up to) 0.1ms, 1ms, 10ms, 100ms, 1s, 10s, more.
+    buckets = (0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
 
-        return u'ORDER BY ' + u','.join(order_segments)
+    def __init__(self, slow=None, keep_slow=100):
+        self.slow = slow
+        self.slow_queries = deque(maxlen=keep_slow)
+        self._stats = {}
+        self._lock = threading.Lock()
 
+    def after(self, operation, record):
+        ''' add $record to the totals for $operation. '''
+        with self._lock:
+            stats = self._stats.get(operation)
+            if stats is None:
+                stats = self._stats[operation] = {
+                    u'calls': 0, u'errors': 0, u'seconds': 0.0,
+                    u'max_seconds': 0.0, u'sql_seconds': 0.0,
+                    u'encode_seconds': 0.0, u'decode_seconds': 0.0,
+                    u'rows': 0, u'bytes': 0,
+                    u'histogram': [0] * (len(self.buckets) + 1)}
 
-    def get(self, *args, **vargs):
-        '''
-        A wrapper around sqllite SELECT (makes things a little safer,
-        and simpler)
+            stats[u'calls'] += 1
+            stats[u'errors'] += record[u'error'] is not None
+            stats[u'max_seconds'] = max(stats[u'max_seconds'],
+                                        record[u'seconds'])
+            for key in (u'seconds', u'sql_seconds', u'encode_seconds',
+                        u'decode_seconds', u'rows', u'bytes'):
+                stats[key] += record[key]
+            stats[u'histogram'][bisect(self.buckets, record[u'seconds'])] += 1
 
-        Usage:
+            if record.get(u'plans'):
+                self.slow_queries.append({u'operation': operation,
+                                          u'seconds': record[u'seconds'],
+                                          u'plans': record[u'plans']})
 
-        >>> bucket.get(('title','LIKE','%foo%'), order='mtime')
-        [ {'title': 'posts', 'other': 'are', 'data': 'returned'},
-        {'title': 'here', 'other': 'as', 'rows': 'a'},
-        {'title': 'list', 'more': 'of', 'stuff': 'dicts'} ]
+    def stats(self):
+        ''' the totals so far, as {operation: {calls: ..., ...}} '''
+        with self._lock:
+            return dict((operation, dict(stats, histogram=list(
+                stats[u'histogram']))) for operation, stats in
+                        self._stats.items())
 
-        '''
-        # Work around python not liking *args before named args.
-        _options = {u'order': u'id'}
-        _options.update(vargs)
+    def reset(self):
+        ''' start again. '''
+        with self._lock:
+            self._stats.clear()
+            self.slow_queries.clear()
 
-        ####
-        # Sanitize column names and operators:
-        ####
+class _TimedCursor(lite.Cursor):
+    ''' (instrumented) a cursor which times queries, and counts rows. '''
 
-        where_clause, sql_values = _make_where_clause(*args)
+    store = None
 
-        # Order by value gets tacked on the end:
-        order_clause = self._make_order_clause(_options[u'order'])
+    def _timed(self, method, args, statement=False):
+        ''' run method, adding how long it took to the current record. '''
+        record = getattr(self.store._local, 'record', None) # pylint: disable=protected-access
+        if record is None:
+            return method(self, *args)
 
-        # Prepare the query:
-        sql = u'SELECT * FROM \"{0}\" {1} {2}'.format( \
-            self.table_name, where_clause, order_clause)
+        if statement and len(record[u'statements']) < _KEEP_STATEMENTS:
+            record[u'statements'].append(args)
 
+        start = time.time()
+        try:
+            result = method(self, *args)
+        finally:
+            record[u'sql_seconds'] += time.time() - start
 
-        log.debug ('SQL: %s ; DATA: %s ;', sql, sql_values)
-        # Run the query, and parse the result(s).
-        data = [dict(x) for x in self.cur.execute(sql, sql_values).fetchall()]
-        for document in data:
-            log.debug('ROW: %s', document)
-            for key, value in document.items():
-                if value == None:
-                    del document[key]
-                else:
-                    document[key] = json.loads(value)
-        # Return the newly parsed data:
-        return data
+        if isinstance(result, list):
+            record[u'rows'] += len(result)
+        elif method is lite.Cursor.fetchone:
+            record[u'rows'] += result is not None
+        elif self.rowcount > 0:
+            record[u'rows'] += self.rowcount
+        return result
 
-    def delete(self, *args):
-        ''' a wrapper around sqlite DELETE '''
+    def execute(self, *args):
+        return self._timed(lite.Cursor.execute, args, True)
 
-        where_clause, sql_values = _make_where_clause(*args)
-        sql = u'DELETE FROM \"{0}\" {1}'.format(self.table_name, where_clause)
+    def executemany(self, *args):
+        return self._timed(lite.Cursor.executemany, args)
 
-        log.debug('SQL: %s; DATA: %s;', sql, sql_values)
+    def fetchone(self):
+        return self._timed(lite.Cursor.fetchone, ())
+
+    def fetchmany(self, *args):
+        return self._timed(lite.Cursor.fetchmany, args)
+
+    def fetchall(self):
+        return self._timed(lite.Cursor.fetchall, ())
+
+class _TimedCodec(object):
+    ''' (instrumented) a codec, which times encoding & decoding. '''
+
+    def __init__(self, codec, store):
+        self.codec = codec
+        self.name = codec.name
+        self.store = store
+
+    def _timed(self, method, kind, value):
+        ''' run method(value), adding its time and size to the record. '''
+        record = getattr(self.store._local, 'record', None) # pylint: disable=protected-access
+        if record is None:
+            return method(value)
+
+        start = time.time()
+        result = method(value)
+        record[kind] += time.time() - start
+
+        stored = result if kind == u'encode_seconds' else value
+        if isinstance(stored, (basestring, buffer)):
+            record[u'bytes'] += len(stored)
+        return result
+
+    def encode(self, value):
+        ''' the codec's encode(), timed. '''
+        return self._timed(self.codec.encode, u'encode_seconds', value)
 
-        return self.cur.execute(sql, sql_values)
+    def decode(self, stored):
+        ''' the codec's decode(), timed. '''
+        return self._timed(self.codec.decode, u'decode_seconds', stored)
+
+################################################################################
+
+class _Connection(lite.Connection): # pylint: disable=too-few-public-methods
+    ''' a sqlite3 connection, which knows how many transaction()s deep it is. '''
+    atomic = 0
+    store = None
+
+    def cursor(self, *args):
+        ''' (when instrumented, cursors are timed.) '''
+        if self.store is None or args:
+            return lite.Connection.cursor(self, *args)
+        cursor = lite.Connection.cursor(self, _TimedCursor)
+        cursor.store = self.store
+        return cursor
+
+_SCHEMAS = {}  #pylint: disable=invalid-name
+
+def _table_schema(db_name, table_name):
+    '''
+    get the shared _TableSchema for a table.  (:memory: databases are
+    different for every connection, so they don't get shared.)
+    '''
+
+    if db_name in (':memory:', ''):
+        return _TableSchema()
+
+    return _SCHEMAS.setdefault((os.path.abspath(db_name), table_name),
+                               _TableSchema())
+
+class _Flusher(threading.Thread):
+    '''
+    (write_behind) flushes a DictLiteStore once the oldest write waiting
+    is flush_interval seconds old, even if nothing else is written.  It has
+    its own connection, (so it doesn't need the store's thread), which
+    doesn't wait for locks: if the database is busy, it tries again later.
+    '''
+
+    def __init__(self, store):
+        threading.Thread.__init__(self, name='DictLiteStore flusher')
+        self.daemon = True
+        self.store = store
+        self.stopped = threading.Event()
+
+    def _view(self):
+        '''
+        the store, but with this thread's own (unpooled) connection, and
+        its own methods, (not the instrumented ones, bound to the store).
+        '''
+        # pylint: disable=protected-access
+        view = copy(self.store)
+        for name in _INSTRUMENTED:
+            view.__dict__.pop(name, None)
+        view.pooled = False
+        view._db = view._connect()
+        view._db.execute(u'PRAGMA busy_timeout=0')
+        view._cur = view._db.cursor()
+        return view
+
+    def run(self):
+        # pylint: disable=protected-access
+        store, view = self.store, None
+        try:
+            while not self.stopped.is_set():
+                with store._buffer_lock:
+                    started = store._buffer_started if store._buffer else None
+                wait = store.flush_interval if started is None else \
+                       started + store.flush_interval - time.time()
+                if wait > 0:
+                    self.stopped.wait(wait)
+                    continue
+
+                # (if someone else is flushing, they'll do these too)
+                if not store._flush_lock.acquire(False):
+                    self.stopped.wait(store.flush_interval)
+                    continue
+                try:
+                    if view is None:
+                        view = self._view()
+                    view._flush_buffer()
+                except Exception as exc: # pylint: disable=broad-except
+                    # (they're still buffered, for the next flush)
+                    log.debug('Flushing in the background failed: %s', exc)
+                    self.stopped.wait(store.flush_interval)
+                finally:
+                    store._flush_lock.release()
+        finally:
+            if view is not None:
+                view._db.close()
+
+    def stop(self):
+        ''' stop, and wait for any flush it's doing. '''
+        self.stopped.set()
+        self.join()
+
+################################################################################
+
+
+class DictLiteStore(object):
+    '''
+    A simple(ish) way to store dict-like objects in a SQLite database,
+    which can then be queried against.  Useful for caching schemaless data.
+    '''
+
+    def __init__(self, db_name=":memory:", table_name=u"def", # pylint: disable=too-many-arguments
+                 auto_index=None, codec=None, pooled=False,
+                 journal_mode=None, synchronous=None, cache_size=None,
+                 mmap_size=None, busy_timeout=None, write_behind=False,
+                 flush_size=1000, flush_interval=1.0, result_cache=0,
+                 result_cache_ttl=None, storage=None, instrument=None):
+        '''
+        Initialise the object, but don't actually open the database
+        connection yet.
+
+        If auto_index is a number, then any column which gets used in
+        that many where clauses will have an index created on it.
+
+        codec is how values are stored, either the name of one of the
+        CODECS ('json', the default, 'native', which keeps numbers as numbers,
+        or 'msgpack'), or a codec object.
+        It's remembered for each table, so existing tables are always
+        read with the codec they were written with.
+
+        If pooled is True, then each thread gets its own connection, so
+        the DictLiteStore can be shared between threads.  The database is
+        switched to WAL mode (unless journal_mode says otherwise), so
+        readers don't wait for writers, and every write is committed
+        straight away, so writers don't lock each other out.
+
+        journal_mode, synchronous, cache_size, mmap_size and busy_timeout
+        set those SQLite PRAGMAs for every connection.
+
+        In write_behind mode, store() and update() are kept in memory, and
+        only written (in one transaction) by flush(), which happens when
+        there are flush_size of them, when the oldest is flush_interval
+        seconds old (checked by a background thread, for files), before
+        anything else touches the table, and on close().  That's much faster, but anything not
+        yet flushed is lost if the program crashes.
+
+        If result_cache is set, that many get() results are kept (for up to
+        result_cache_ttl seconds, if that's set), and given back again for
+        the same query, until anything writes to the database.
+
+        storage is how documents are laid out in the table, either 'columns'
+        (the default), with a column for every key, or 'json', where each
+        document is kept whole in one column, and where clauses (and order)
+        use json_extract(), so 'a.b.c' keys look inside nested documents.
+        Like the codec, it's remembered for each table. (migrate_storage()
+        moves existing tables from one to the other.)
+
+        instrument is an Instrumentation (such as a Profiler), which is
+        called before and after every operation, with how long it took
+        (in SQL, and encoding & decoding), how many rows & bytes, and so
+        on.  Without one, none of that is measured.
+        '''
+
+        self.db_name = db_name
+        self.table_name = clean(table_name)
+        self.auto_index = auto_index
+        self.codec = CODECS[codec] if isinstance(codec, basestring) else codec
+        self.pooled = pooled
+        self._where_counts = {}
+
+        if storage is not None and storage not in STORAGES:
+            raise ValueError('Unknown storage "{0}"'.format(storage))
+        self.storage = storage
+
+        if pooled and journal_mode is None:
+            journal_mode = u'WAL'
+
+        self.pragmas = [(name, _pragma_value(name, value)) for name, value in (
+            (u'journal_mode', journal_mode),
+            (u'synchronous', synchronous),
+            (u'cache_size', cache_size),
+            (u'mmap_size', mmap_size),
+            (u'busy_timeout', busy_timeout)) if value is not None]
+
+        self.write_behind = write_behind
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._buffer_started = None
+        self._buffer_lock = threading.Lock()
+        self._flush_lock = threading.RLock()
+        self._flusher = None
+        self._flush_stats = {u'flushes': 0, u'writes': 0, u'total_seconds': 0.0,
+                             u'last_seconds': 0.0, u'max_seconds': 0.0}
+
+        self._results = _ResultCache(result_cache, result_cache_ttl) \
+                        if result_cache else None
+
+        self._db = None
+        self._cur = None
+        self._local = threading.local()
+
+        self.instrument = instrument
+        if instrument is not None:
+            for name in _INSTRUMENTED:
+                setattr(self, name, self._instrumented(name))
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def open(self):
+        '''
+        open the connection to the database.
+        if you call this function, remember to close() as well.
+        '''
+
+        if not self.pooled:
+            self._db = self._connect()
+            self._cur = self._db.cursor()
+
+        self.cur.execute(u'CREATE TABLE IF NOT EXISTS'
+                          ' "{0}"({1} INTEGER PRIMARY KEY)'.format(
+                              self.table_name, _ID_COLUMN))
+        self.db.commit()
+
+        # The columns (and some prepared SQL) are shared with any other
+        # DictLiteStore on the same table:
+        self._schema = _table_schema(self.db_name, self.table_name)
+        self.sql_columns = self._schema.columns
+
+        # Older versions made 'Id INT', which was never filled in, rather
+        # than a real primary key. Upgrade those tables:
+        table_info = self.cur.execute(
+            u"PRAGMA table_info(\"{0}\")".format(self.table_name)).fetchall()
+
+        if not table_info[0][5]:
+            log.info('Upgrading table "%s" to have a primary key.',
+                     self.table_name)
+            self._rebuild_table([row[1] for row in table_info[1:]])
+
+        # Get current columns:
+        self._refresh_columns()
+
+        self._setup_codec()
+
+        self._setup_storage()
+
+        if self.instrument is not None and \
+          not isinstance(self.codec, _TimedCodec):
+            self.codec = _TimedCodec(self.codec, self)
+
+        # (:memory: databases are gone after a crash anyway, and can't be
+        #  shared with another connection)
+        if self.write_behind and self.db_name not in (':memory:', ''):
+            self._flusher = _Flusher(self)
+            self._flusher.start()
+
+    def _instrumented(self, name):
+        '''
+        (when instrumented) method $name, wrapped so it calls the instrument
+        before & after.  Operations inside other operations (such as the
+        flush() before a get()) are counted as part of the outer one.
+        '''
+
+        method = getattr(self, name)
+
+        if name in _INSTRUMENTED_ITERATORS:
+            def wrapper(*args, **kwargs):
+                ''' the generator, timed only while it's fetching. '''
+                iterator = method(*args, **kwargs)
+                if getattr(self._local, 'record', None) is not None:
+                    return iterator
+                return self._timed_iteration(name, args, iterator)
+        else:
+            def wrapper(*args, **kwargs):
+                ''' the method, timed. '''
+                if getattr(self._local, 'record', None) is not None:
+                    return method(*args, **kwargs)
+                record = self._start_record(name, args)
+                try:
+                    return self._timed(record, method, *args, **kwargs)
+                finally:
+                    self._finish_record(name, record)
+
+        return wraps(method)(wrapper)
+
+    def _start_record(self, name, args):
+        ''' (when instrumented) an operation is starting. '''
+        self.instrument.before(name, args)
+        return {u'seconds': 0.0, u'sql_seconds': 0.0, u'encode_seconds': 0.0,
+                u'decode_seconds': 0.0, u'rows': 0, u'bytes': 0,
+                u'error': None, u'statements': []}
+
+    def _timed(self, record, function, *args, **kwargs):
+        ''' (when instrumented) run function, as part of the record. '''
+        outer = getattr(self._local, 'record', None)
+        self._local.record = record
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        except StopIteration:
+            raise
+        except Exception as error:
+            record[u'error'] = error
+            raise
+        finally:
+            record[u'seconds'] += time.time() - start
+            self._local.record = outer
+
+    def _timed_iteration(self, name, args, iterator):
+        ''' (when instrumented) go through iterator, timing each step. '''
+        record = self._start_record(name, args)
+        try:
+            while True:
+                try:
+                    item = self._timed(record, next, iterator)
+                except StopIteration:
+                    return
+                yield item
+        finally:
+            self._finish_record(name, record)
+
+    def _finish_record(self, name, record):
+        ''' (when instrumented) an operation has finished. '''
+        statements = record.pop(u'statements')
+        slow = self.instrument.slow
+        if slow is not None and record[u'seconds'] >= slow:
+            record[u'plans'] = self._explain(statements)
+        self.instrument.after(name, record)
+
+    def _explain(self, statements):
+        ''' the query plans for some (sql, values) statements. '''
+
+        plans = []
+        for statement in statements:
+            sql = statement[0]
+            if sql.lstrip()[:6].upper() in (u'SELECT', u'UPDATE', u'DELETE'):
+                plans.append((sql, [row[-1] for row in self.db.execute(
+                    u'EXPLAIN QUERY PLAN ' + sql, *statement[1:]).fetchall()]))
+        return plans
+
+    def _get_meta(self, key, default=None):
+        ''' get a setting for this table, from the metadata table. '''
+        row = self.cur.execute(u'SELECT value FROM "{0}" WHERE tbl=(?) '
+                               u'AND key=(?)'.format(_META_TABLE),
+                               [self.table_name, key]).fetchone()
+        return default if row is None else row[0]
+
+    def _set_meta(self, key, value):
+        ''' store a setting for this table, in the metadata table. '''
+        self.cur.execute(u'INSERT OR REPLACE INTO "{0}"(tbl, key, value) '
+                         u'VALUES (?,?,?)'.format(_META_TABLE),
+                         [self.table_name, key, value])
+        self._commit()
+
+    def _setup_codec(self):
+        '''
+        Check which codec the table was written with, (tables from
+        before codecs were a thing are json), and make sure that's the one
+        we use.  New tables remember the codec they're made with.
+        '''
+
+        self.cur.execute(u'CREATE TABLE IF NOT EXISTS "{0}"(tbl TEXT, '
+                         u'key TEXT, value, PRIMARY KEY(tbl, key))'.format(
+                             _META_TABLE))
+
+        stored = self._get_meta(u'codec')
+
+        if stored is None:
+            if self.codec and self.codec.name != JSONCodec.name \
+              and self.cur.execute(u'SELECT 1 FROM "{0}" LIMIT 1'.format(
+                      self.table_name)).fetchone():
+                raise ValueError('Table "{0}" already has json data in it, '
+                                 'so can\'t use codec "{1}"'.format(
+                                     self.table_name, self.codec.name))
+
+            self.codec = self.codec or _DEFAULT_CODEC
+            self._set_meta(u'codec', self.codec.name)
+
+        elif self.codec is None:
+            try:
+                self.codec = CODECS[stored]
+            except KeyError:
+                raise ValueError('Table "{0}" uses codec "{1}", which '
+                                 'isn\'t available.'.format(self.table_name,
+                                                            stored))
+
+        elif self.codec.name != stored:
+            raise ValueError('Table "{0}" uses codec "{1}", not "{2}"'.format(
+                self.table_name, stored, self.codec.name))
+
+    def _setup_storage(self):
+        '''
+        Check how the table lays out documents, (tables from before
+        storage was a thing use columns), and make sure that's how we use it.
+        New tables remember the storage they're made with.
+        '''
+
+        stored = self._get_meta(u'storage')
+
+        if stored is None:
+            if self.storage not in (None, u'columns') and (self.sql_columns or
+                    self.cur.execute(u'SELECT 1 FROM "{0}" LIMIT 1'.format(
+                        self.table_name)).fetchone()):
+                raise ValueError('Table "{0}" already has columns storage, '
+                                 'use migrate_storage() to change it.'.format(
+                                     self.table_name))
+
+            self.storage = self.storage or u'columns'
+            self._set_meta(u'storage', self.storage)
+
+        elif self.storage is None:
+            self.storage = stored
+
+        elif self.storage != stored:
+            raise ValueError('Table "{0}" uses "{1}" storage, not "{2}"'.format(
+                self.table_name, stored, self.storage))
+
+        if self.storage == u'json':
+            if self.codec.name != JSONCodec.name:
+                raise ValueError('json storage needs the json codec, '
+                                 'not "{0}"'.format(self.codec.name))
+            if _DOCUMENT_COLUMN not in self.sql_columns:
+                self._add_columns([_DOCUMENT_COLUMN])
+
+    def _refresh_columns(self, force=False):
+        '''
+        Check if the database schema has changed (from another connection,
+        or another process) since the columns were last read, and if so,
+        (or if $force), read them again.  Returns True if it did.
+        '''
+
+        with self._schema.lock:
+            version = self.cur.execute(u'PRAGMA schema_version').fetchone()[0]
+
+            if version == self._schema.version and not force:
+                return False
+
+            self.cur.execute(u"PRAGMA table_info(\"{0}\")".format(
+                self.table_name))
+            self._schema.reset(version, [row[1].decode('utf-8')
+                                         for row in self.cur.fetchall()[1:]])
+
+        return True
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Run a block of writes (including schema changes) as one
+        transaction, which is committed at the end, or rolled back if
+        there's an exception.  Transactions can be nested (using
+        SAVEPOINTs), and nothing is committed until the outermost one ends.
+
+        >>> with bucket.transaction():
+        ...     bucket.store(foo)
+        ...     bucket.update({'count': 2}, False, ('title', '==', 'bar'))
+
+        (The sqlite3 module normally commits before any statement that isn't
+        INSERT/UPDATE/DELETE, so its transaction handling is turned off
+        while we do it ourselves.)
+        '''
+
+        db, cur = self.db, self.cur
+
+        # Writes inside the transaction aren't buffered, so anything
+        # already buffered should be written first, to keep them in order:
+        if not db.atomic and self._buffer and \
+          not getattr(self._local, 'flushing', False):
+            self.flush()
+
+        if db.atomic:
+            savepoint = u'dictlitestore_{0}'.format(db.atomic)
+            begin = [u'SAVEPOINT ' + savepoint]
+            commit = [u'RELEASE ' + savepoint]
+            rollback = [u'ROLLBACK TO ' + savepoint, u'RELEASE ' + savepoint]
+        else:
+            db.commit()
+            isolation_level = db.isolation_level
+            db.isolation_level = None
+            begin, commit, rollback = [u'BEGIN'], [u'COMMIT'], [u'ROLLBACK']
+
+        db.atomic += 1
+        try:
+            for sql in begin:
+                cur.execute(sql)
+            try:
+                yield
+            except:
+                for sql in rollback:
+                    cur.execute(sql)
+                # Any columns added have gone again:
+                self._refresh_columns()
+                # and any results cached during it may have been wrong:
+                if self._results is not None:
+                    self._results.clear()
+                raise
+            for sql in commit:
+                cur.execute(sql)
+        finally:
+            db.atomic -= 1
+            if not db.atomic:
+                db.isolation_level = isolation_level
+
+    def _commit(self):
+        '''
+        Commit, unless we're inside a transaction(), in which case it'll be
+        committed at the end of that.
+        '''
+
+        if not self.db.atomic:
+            self.db.commit()
+
+    def _rebuild_table(self, columns, dropped=()):
+        '''
+        Rebuild the table with only $columns (and a proper primary key),
+        copying all the data across, as ALTER TABLE can't do either of
+        those things.  Indexes and triggers on the table are kept, (apart
+        from any which use the $dropped columns).
+        '''
+
+        temp_name = self.table_name + u'__rebuild'
+        columns = u''.join(u',' + cleanq(c) for c in columns)
+        dropped = set(unicode(c) for c in dropped)
+
+        # (a trigger's 'ON "table"' isn't one of its columns, even if a
+        #  column has the same name as the table)
+        on_table = re.compile(u'\\bON\\s+' + re.escape(cleanq(self.table_name)),
+                              re.IGNORECASE)
+
+        def uses_dropped(kind, name, sql):
+            ''' does an index or trigger use any of the $dropped columns? '''
+            if not dropped:
+                return False
+            if kind == u'index':
+                return any(row[2] is not None and
+                           row[2].decode('utf-8') in dropped
+                           for row in self.cur.execute(
+                               u'PRAGMA index_info({0})'.format(cleanq(name)))
+                           .fetchall())
+            sql = on_table.sub(u'', sql, 1)
+            return any(cleanq(column) in sql for column in dropped)
+
+        with self.transaction():
+            # Save the indexes & triggers, as DROP TABLE removes them:
+            extras = []
+            for kind, name, sql in self.cur.execute(
+                    u"SELECT type, name, sql FROM sqlite_master WHERE "
+                    u"tbl_name=(?) AND type IN ('index', 'trigger') "
+                    u"AND sql IS NOT NULL", [self.table_name]).fetchall():
+                sql = sql.decode('utf-8')
+                if uses_dropped(kind.decode('utf-8'), name.decode('utf-8'),
+                                sql):
+                    log.info('Dropping "%s", as its columns are gone.', sql)
+                else:
+                    extras.append(sql)
+
+            self.cur.execute(u'CREATE TABLE "{0}"({1} INTEGER PRIMARY KEY{2})'
+                             .format(temp_name, _ID_COLUMN, columns))
+            self.cur.execute(u'INSERT INTO "{0}"({1}{2}) '
+                             u'SELECT rowid{2} FROM "{3}" ORDER BY rowid'
+                             .format(temp_name, _ID_COLUMN, columns,
+                                     self.table_name))
+            self.cur.execute(u'DROP TABLE "{0}"'.format(self.table_name))
+            self.cur.execute(u'ALTER TABLE "{0}" RENAME TO "{1}"'.format(
+                temp_name, self.table_name))
+
+            for sql in extras:
+                self.cur.execute(sql)
+
+    def close(self):
+        '''
+        commit and close the database connection. if you use
+        the 'with DictLiteStore(...) as ...' pattern, you don't need
+        to call this.
+        '''
+
+        if self._flusher is not None:
+            self._flusher.stop()
+            self._flusher = None
+
+        self.flush()
+
+        if self.pooled:
+            with self._connections_lock:
+                connections, self._connections = self._connections, []
+            self._local = threading.local()
+        else:
+            connections = [self._db]
+
+        for connection in connections:
+            connection.commit()
+            connection.close()
+
+    def _connect(self):
+        ''' make a new connection to the database, all set up. '''
+
+        connection = lite.connect(self.db_name,
+                                  cached_statements=_SQL_CACHE_SIZE,
+                                  check_same_thread=not self.pooled,
+                                  factory=_Connection)
+        connection.text_factory = lambda x: x.encode('utf-8')
+        connection.row_factory = lite.Row
+
+        if self.instrument is not None:
+            connection.store = self
+
+        for name, value in self.pragmas:
+            connection.execute(u'PRAGMA {0}={1}'.format(name, value))
+
+        return connection
+
+    def _local_connection(self):
+        ''' (pooled) the connection and cursor for this thread. '''
+
+        try:
+            return self._local.db, self._local.cur
+        except AttributeError:
+            connection = self._connect()
+            self._local.db, self._local.cur = connection, connection.cursor()
+            with self._connections_lock:
+                self._connections.append(connection)
+            return self._local.db, self._local.cur
+
+    @property
+    def db(self):
+        ''' The connection to the database (for this thread, if pooled). '''
+        return self._local_connection()[0] if self.pooled else self._db
+
+    @property
+    def cur(self):
+        ''' The cursor for running queries (for this thread, if pooled). '''
+        return self._local_connection()[1] if self.pooled else self._cur
+
+    def _wrote(self):
+        '''
+        Called after every write.  Pooled connections commit straight away,
+        so that other threads aren't locked out, and cached results are
+        thrown away.
+        '''
+
+        if self.pooled:
+            self._commit()
+
+        if self._results is not None:
+            self._results.clear()
+
+    def __enter__(self):
+        ''' Open the database connection.
+            Called in the 'with' pattern. '''
+        self.open()
+        return self
+
+    def __exit__(self, exptype, expvalue, exptb):
+        ''' Close the database connection.
+            Called in the 'with' pattern. '''
+        self.close()
+
+    def _update_columns(self, document):
+        ''' Update the table 'schema' to have any columns which the document
+            has, but the table doesn't. (Anything which iterates over
+            keys will do, so a set of keys from several documents works too.)
+            Returns a list of the columns, quoted and ready to use
+            in a query. '''
+
+        keys = tuple(document)
+
+        # Most documents have keys we've seen before:
+        columns = self._schema.sql.get(keys)
+        if columns is not None:
+            return columns
+
+        # (column names are unicode, so they match what the db gives back)
+        names = [unicode(raw_key) for raw_key in keys]
+
+        # If needed, add new columns to the self.db:
+        missing = [key for key in names if key not in self.sql_columns]
+        if missing:
+            self._add_columns(missing)
+
+        # Clean the keys:
+        columns = [cleanq(key) for key in names]
+
+        return self._schema.remember(keys, columns)
+
+    def _add_columns(self, keys, retry=True):
+        '''
+        Add columns to the table, all in one transaction, which is committed.
+        '''
+
+        # They might have been added by another connection (or thread, which
+        # will already have refreshed the shared columns):
+        self._refresh_columns()
+        keys = [key for key in keys if key not in self.sql_columns]
+        if not keys:
+            return
+
+        try:
+            with self.transaction():
+                for key in keys:
+                    sql = u"ALTER TABLE \"{0}\" " \
+                          u"ADD COLUMN {1}".format(self.table_name, cleanq(key))
+                    self.cur.execute(sql)
+        except lite.OperationalError:
+            # Someone else may have added them at the same time as us:
+            self._refresh_columns(force=True)
+            if retry and any(key in self.sql_columns for key in keys):
+                return self._add_columns(keys, retry=False)
+            raise
+
+        self._refresh_columns()
+
+    def store(self, document):
+        '''
+        Store a dictionary (doc) in the database.
+        Update the table columns as needed.
+        Returns the Id of the new row. (Or None, in write-behind mode.)
+        '''
+
+        if self._write_behind(u'store', dict(document)):
+            return None
+
+        self._fresh_schema(self._insert, document)
+        self._wrote()
+
+        return self.cur.lastrowid
+
+    def _insert(self, document):
+        ''' INSERT a document (adding any columns it needs). '''
+
+        # Prepare the table, get column names, and the data for writing:
+        columns, values = self._encode(document)
+
+        # Prepare the query:
+        sql = self._make_insert(columns)
+
+        # Debug logging...
+        log.debug ('SQL: %s DATA: %s', sql, values)
+
+        # Run it!
+        self.cur.execute(sql, values)
+
+    def _fresh_schema(self, function, *args):
+        '''
+        Run function(*args), and if it fails because a column it used (from
+        the cached columns and SQL) isn't there any more, (another process
+        compact()ed the table, say), read the columns again, and run it
+        once more.  (SQLite checks columns before it writes anything, so
+        nothing has been done twice.)
+        '''
+
+        try:
+            return function(*args)
+        except lite.OperationalError as err:
+            message = unicode(err)
+            if u'no such column' not in message and \
+               u'has no column named' not in message:
+                raise
+            log.info('Columns have changed under us (%s), reading them again.',
+                     message)
+            self._refresh_columns(force=True)
+            return function(*args)
+
+    @_flushed_first
+    def store_many(self, documents, chunk_size=1000):
+        '''
+        Store lots of dictionaries in the database in one go.
+
+        The documents are read from the iterable $chunk_size at a time
+        (or all at once, if chunk_size is None).  For each chunk, any new
+        columns are added in one pass, and then the documents are grouped
+        by their keys, and each group is written with a single
+        executemany().  Everything is committed once, at the end.
+
+        *NOTE* as documents are grouped by keys, documents with different
+               keys may end up stored in a different order to how they
+               were given.
+
+        Returns the number of documents stored.
+        '''
+
+        with self.transaction():
+            count = self._store_chunks(documents, chunk_size)
+
+        self._wrote()
+
+        return count
+
+    def _store_chunks(self, documents, chunk_size):
+        ''' (the insides of store_many) '''
+
+        count = 0
+
+        if self.storage == u'json':
+            # Every document goes in the same single column:
+            sql = self._make_insert([cleanq(_DOCUMENT_COLUMN)])
+            for chunk in _chunks(documents, chunk_size):
+                log.debug('SQL: %s ROWS: %d', sql, len(chunk))
+                self.cur.executemany(sql, [[self.codec.encode(_nested(d))]
+                                           for d in chunk])
+                count += len(chunk)
+            return count
+
+        for chunk in _chunks(documents, chunk_size):
+            # Group the documents by their keys, and INSERT each group:
+            self._write_encoded(_encode_chunk(chunk, self.codec.encode).items())
+            count += len(chunk)
+
+        return count
+
+    def _write_encoded(self, groups):
+        '''
+        INSERT (keys, rows) groups of encoded documents, (from
+        _encode_chunk()), with one schema pass for all of them, and then
+        one executemany() per group.
+        '''
+
+        if self.storage != u'json':
+            self._update_columns(set(k for keys, _ in groups for k in keys))
+
+        for keys, rows in groups:
+            self._fresh_schema(self._insert_many, keys, rows)
+
+    def _insert_many(self, keys, rows):
+        ''' INSERT rows of encoded values for $keys, with executemany(). '''
+
+        if self.storage != u'json':
+            # (nearly always cached, but the columns may have been re-read)
+            self._update_columns(keys)
+
+        sql = self._make_insert([cleanq(k) for k in keys])
+        log.debug('SQL: %s ROWS: %d', sql, len(rows))
+        self.cur.executemany(sql, rows)
+
+    @_flushed_first
+    def parallel_ingest(self, documents, workers=None, chunk_size=1000,
+                        queue_size=None, progress=None):
+        '''
+        Like store_many(), but the documents are encoded by $workers (by
+        default, one per CPU) other processes, while this one only writes
+        them, so big imports can use more than one core.
+
+        Chunks of documents are handed out to the workers, and written in
+        the same order they were read.  Only $queue_size (by default, 2 per
+        worker) chunks wait on each side, so a slow disk slows reading down,
+        rather than filling up memory.  If $progress is set, it's called with
+        stats (see below) after each chunk is written.  Everything is one
+        transaction, as in store_many().
+
+        Returns stats: {'documents', 'chunks', 'seconds', 'per_second',
+                        'workers', 'waiting' (chunks encoded, but not written)}
+
+        >>> bucket.parallel_ingest(json.loads(line) for line in open('big.jsonl'))
+        '''
+
+        workers = workers or multiprocessing.cpu_count()
+        queue_size = queue_size or workers * 2
+        codec = self.codec.codec if isinstance(self.codec, _TimedCodec) \
+                else self.codec
+
+        tasks = multiprocessing.Queue(queue_size)
+        results = multiprocessing.Queue(queue_size)
+        stop = threading.Event()
+        errors = []
+
+        processes = [multiprocessing.Process(
+            target=_ingest_worker, args=(tasks, results, codec, self.storage))
+                     for _ in xrange(workers)]
+        for process in processes:
+            process.daemon = True
+            process.start()
+
+        feeder = threading.Thread(target=_feed_chunks, args=(
+            documents, chunk_size, tasks, workers, stop, errors))
+        feeder.daemon = True
+        feeder.start()
+
+        stats = {u'documents': 0, u'chunks': 0, u'seconds': 0.0,
+                 u'per_second': None, u'workers': workers, u'waiting': 0}
+        start = time.time()
+        waiting = {}
+        finished = 0
+
+        try:
+            with self.transaction():
+                while finished < workers:
+                    try:
+                        item = results.get(timeout=1)
+                    except Queue.Empty:
+                        if not any(p.is_alive() for p in processes):
+                            raise RuntimeError('parallel_ingest() workers died')
+                        continue
+
+                    if item is None:
+                        finished += 1
+                        continue
+
+                    number, encoded, count, error = item
+                    if error is not None:
+                        raise ValueError('Encoding chunk {0} failed: {1}'
+                                         .format(number, error))
+                    waiting[number] = (encoded, count)
+
+                    # Write chunks in order, as soon as they're ready:
+                    while stats[u'chunks'] in waiting:
+                        encoded, count = waiting.pop(stats[u'chunks'])
+                        self._write_encoded(
+                            [(keys, [[buffer(v) if type(v) is bytearray else v
+                                      for v in row] for row in rows]
+                              if blobs else rows)
+                             for keys, rows, blobs in encoded])
+
+                        stats[u'chunks'] += 1
+                        stats[u'documents'] += count
+                        stats[u'seconds'] = time.time() - start
+                        stats[u'per_second'] = \
+                            stats[u'documents'] / (stats[u'seconds'] or 1e-9)
+                        stats[u'waiting'] = len(waiting)
+                        if progress:
+                            progress(dict(stats))
+
+                feeder.join()
+                if errors:
+                    raise errors[0]
+        finally:
+            stop.set()
+            for queue in (tasks, results):
+                queue.cancel_join_thread()
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+
+        self._wrote()
+
+        return stats
+
+    def update(self, document, insert=True, *args):
+        '''
+        Update a row in the database.  If $insert is true,
+        then insert the data as a new row, if nothing is updated.
+        Returns the number of rows changed. (Or None, in write-behind mode.)
+        '''
+
+        assert hasattr(document, 'items')
+
+        if self._write_behind(u'update', dict(document), insert, *args):
+            return None
+
+        def run_update():
+            ''' (the UPDATE, which may need trying again) '''
+
+            # Prepare the query (and the table):
+            sql, values = self._make_update(document, args)
+
+            # Debug logging
+            log.debug ('SQL: %s, DATA: %s', sql, values)
+
+            self.cur.execute(sql, values)
+
+        self._fresh_schema(run_update)
+
+        if self.cur.rowcount == 0 and insert:
+            # No rows were modifed by query, and the user wants
+            # us to insert a row if that's the case.
+            self._fresh_schema(self._insert, document)
+
+        self._wrote()
+
+        return self.cur.rowcount
+
+    @_flushed_first
+    def update_many(self, documents, key, chunk_size=1000):
+        '''
+        Update lots of documents in one go: each document updates the
+        row(s) with the same values for the $key column(s) as it has, (and
+        nothing is inserted).  Runs of documents with the same keys are
+        written with a single executemany(), and everything is one
+        transaction.
+        Returns the number of rows changed.
+
+        >>> bucket.update_many([{'sku': 1, 'price': 3}, ...], key='sku')
+        '''
+
+        if isinstance(key, basestring):
+            key = [key]
+
+        count = 0
+
+        with self.transaction():
+            for chunk in _chunks(documents, chunk_size):
+                updates = [self._make_update(document, [
+                    (k, u'==', document.get(k)) for k in key])
+                           for document in chunk]
+
+                # (runs of the same SQL are done together, keeping the order)
+                for sql, group in groupby(updates, key=itemgetter(0)):
+                    rows = [values for _, values in group]
+                    log.debug('SQL: %s ROWS: %d', sql, len(rows))
+                    count += self.cur.executemany(sql, rows).rowcount
+
+        self._wrote()
+
+        return count
+
+    @_flushed_first
+    def upsert_many(self, documents, key, chunk_size=1000):
+        '''
+        Store lots of documents, but where there's already a document with
+        the same values for the $key column(s), update that one instead.
+        That needs a unique index on $key, which is made if there isn't one.
+        Each run of documents with the same keys is written with a single
+        executemany() of INSERT ... ON CONFLICT DO UPDATE, all in one
+        transaction, so there's no race between checking and inserting.
+        (Documents without the key column(s) are always inserted.)
+
+        Returns {'inserted': number inserted, 'updated': number updated}
+
+        >>> bucket.upsert_many(nightly_records, key=['source', 'record_id'])
+        {'inserted': 12, 'updated': 4988}
+        '''
+
+        if isinstance(key, basestring):
+            key = [key]
+        key = [unicode(k) for k in key]
+
+        if not any(index[u'unique'] and index[u'columns'] == key
+                   for index in self.list_indexes()):
+            self.create_index(key, unique=True)
+
+        count = 0
+
+        with self.transaction():
+            # New rows get Ids after the biggest one now:
+            biggest = self.cur.execute(u'SELECT IFNULL(MAX({0}), 0) FROM "{1}"'
+                                       .format(_ID_COLUMN, self.table_name)
+                                      ).fetchone()[0]
+
+            for chunk in _chunks(documents, chunk_size):
+                # (only runs of documents with the same keys are grouped, so
+                #  later documents still win, if the same key is in twice.)
+                for keys, group in groupby(chunk, key=lambda d: tuple(d.keys())):
+                    sql = self._make_upsert(keys, key)
+                    rows = [self._encode(document)[1] for document in group]
+                    log.debug('SQL: %s ROWS: %d', sql, len(rows))
+                    self.cur.executemany(sql, rows)
+
+                count += len(chunk)
+
+            inserted = self.cur.execute(u'SELECT COUNT(*) FROM "{0}" WHERE '
+                                        u'{1} > (?)'.format(self.table_name,
+                                                            _ID_COLUMN),
+                                        [biggest]).fetchone()[0]
+
+        self._wrote()
+
+        return {u'inserted': inserted, u'updated': count - inserted}
+
+    def _make_upsert(self, keys, key):
+        '''
+        Given the keys of some documents, and the key column(s) which should
+        be unique, return 'INSERT INTO "x"(a,b) VALUES(?,?) ON CONFLICT(a)
+        DO UPDATE SET a=excluded.a,b=excluded.b'
+        '''
+
+        cache_key = (u'UPSERT', keys, tuple(key))
+        sql = self._schema.sql.get(cache_key)
+        if sql is not None:
+            return sql
+
+        if self.storage == u'json':
+            columns = [cleanq(_DOCUMENT_COLUMN)]
+            set_clause = u'{0}=json_set({0},{1})'.format(
+                columns[0], u','.join(
+                    u'{0},json_quote(json_extract(excluded.{1}, {0}))'.format(
+                        _json_path(k), columns[0])
+                    for k in keys))
+        else:
+            columns = self._update_columns(keys)
+            set_clause = u','.join(c + u'=excluded.' + c for c in columns)
+
+        return self._schema.remember(cache_key,
+            u'{0} ON CONFLICT({1}) DO UPDATE SET {2}'.format(
+                self._make_insert(columns),
+                u','.join(self._column_sql(k) for k in key),
+                set_clause))
+
+    def _write_behind(self, method, *args):
+        '''
+        In write-behind mode, keep a write to do later (flushing them all
+        if there are enough, or the oldest is old enough), and return True.
+        Otherwise return False, and it should be done now.  (Writes inside
+        a transaction() are always done now, so they can be rolled back.)
+        '''
+
+        if not self.write_behind or getattr(self._local, 'flushing', False) \
+          or self.db.atomic:
+            return False
+
+        with self._buffer_lock:
+            if not self._buffer:
+                self._buffer_started = time.time()
+            self._buffer.append((method, args))
+            full = len(self._buffer) >= self.flush_size or \
+                   time.time() - self._buffer_started >= self.flush_interval
+
+        if full:
+            self.flush()
+
+        return True
+
+    def flush(self):
+        '''
+        Write everything waiting in the write-behind buffer, in one
+        transaction.  (Runs of store()s are done with store_many(), so
+        documents with different keys may be stored out of order.)
+
+        If any of them fail, none of them are written, and they're all put
+        back in the buffer, to try again on the next flush.  (So a write
+        which can never work, such as one breaking a unique index, stops
+        every flush until whatever's wrong is fixed.)
+        '''
+
+        # (waiting for any flush in the background, so the writes it has
+        #  taken are there for whatever we're about to do)
+        with self._flush_lock:
+            self._flush_buffer()
+
+    def _flush_buffer(self):
+        ''' (the insides of flush) '''
+
+        with self._buffer_lock:
+            buffered = self._buffer[:]
+            del self._buffer[:]
+
+        if not buffered:
+            return
+
+        start = time.time()
+
+        self._local.flushing = True
+        try:
+            with self.transaction():
+                for method, group in groupby(buffered, key=itemgetter(0)):
+                    if method == u'store':
+                        self._store_chunks((args[0] for _, args in group),
+                                           self.flush_size)
+                    else:
+                        for _, args in group:
+                            getattr(self, method)(*args)
+        except:
+            with self._buffer_lock:
+                self._buffer[:0] = buffered
+            raise
+        finally:
+            self._local.flushing = False
+
+        # (store()s were written directly, so cached results are out of date)
+        self._wrote()
+
+        seconds = time.time() - start
+        with self._buffer_lock:
+            stats = self._flush_stats
+            stats[u'flushes'] += 1
+            stats[u'writes'] += len(buffered)
+            stats[u'total_seconds'] += seconds
+            stats[u'last_seconds'] = seconds
+            stats[u'max_seconds'] = max(stats[u'max_seconds'], seconds)
+
+    def flush_stats(self):
+        '''
+        How the write-behind buffer is doing: how many writes are waiting
+        (queue_depth), and how many flushes there have been, of how many
+        writes, and how long they took (in seconds).
+        '''
+
+        with self._buffer_lock:
+            stats = dict(self._flush_stats)
+            stats[u'queue_depth'] = len(self._buffer)
+
+        return stats
+
+    def _make_insert(self, columns):
+        '''
+        Given a simple list of column names,
+        return 'INSERT INTO "x"(column_names, etc) VALUES(?, ?)'
+        '''
+
+        key = (u'INSERT', tuple(columns))
+        sql = self._schema.sql.get(key)
+
+        if sql is None:
+            sql = self._schema.remember(key,
+                u'INSERT INTO "{0}"({1}) VALUES({2})'.format( \
+                    self.table_name, \
+                    u','.join(columns), \
+                    u','.join(len(columns)*u'?')))
+
+        return sql
+
+    def _make_update(self, document, where):
+        '''
+        Given a document, and a DictLiteStore style where clause,
+        return ('UPDATE "x" SET a=(?),b=(?),c=(?) WHERE...', values)
+        '''
+
+        # UPDATE "x" SET x=(?),y=(?),z=(?)
+        set_clause, values = self._make_set_clause(document)
+
+        # WHERE ...
+        where_clause, where_values = self._make_where(where)
+
+        return u'UPDATE "{0}" SET {1} {2}'.format(
+            self.table_name, set_clause, where_clause), values + where_values
+
+    def _encode(self, document):
+        '''
+        Get a document ready to INSERT, adding any columns it needs.
+        Returns (quoted column names, values).
+        '''
+
+        if self.storage == u'json':
+            return [cleanq(_DOCUMENT_COLUMN)], \
+                   [self.codec.encode(_nested(document))]
+
+        return (self._update_columns(document),
+                _prepare_values(document, self.codec.encode))
+
+    def _make_set_clause(self, document):
+        '''
+        Given a document, return ('a=(?),b=(?),c=(?)', values) to UPDATE
+        rows with its keys, adding any columns it needs.  (In json storage,
+        the keys are set inside the stored document, with json_set(), and
+        dotted keys go down into it, just like they do in where clauses,
+        so {'a.b': 1} sets 'b' inside 'a'.)
+        '''
+
+        if self.storage == u'json':
+            key = (u'JSON SET', tuple(document))
+            set_clause = self._schema.sql.get(key)
+            if set_clause is None:
+                set_clause = self._schema.remember(key,
+                    u'{0}=json_set({0},{1})'.format(
+                        cleanq(_DOCUMENT_COLUMN),
+                        u','.join([_json_path(k) + u',json(?)'
+                                   for k in key[1]])))
+            return set_clause, [self.codec.encode(v)
+                                for v in document.values()]
+
+        columns = self._update_columns(document)
+
+        key = (u'SET', tuple(columns))
+        set_clause = self._schema.sql.get(key)
+        if set_clause is None:
+            set_clause = self._schema.remember(key,
+                u','.join([c + u'=(?)' for c in columns]))
+
+        return set_clause, _prepare_values(document, self.codec.encode)
+
+    def _column_sql(self, name, row=u''):
+        '''
+        The SQL for the value of key $name, to use in where (and order)
+        clauses.  That's just the (quoted) column, or in json storage,
+        json_extract() of it from the document.  (row is put in front of
+        the column, for 'new.' or 'old.' in triggers.)
+        '''
+
+        if self.storage == u'json' and \
+          unicode(name).lower() != _ID_COLUMN.lower():
+            return u'json_extract({0}"{1}", {2})'.format(row, _DOCUMENT_COLUMN,
+                                                         _json_path(name))
+        return row + cleanq(name)
+
+    def compile(self, *args):
+        '''
+        Turn a where clause into SQL once, so it can be used again and again
+        with get() & co, only putting in new values for its Params:
+
+        >>> by_author = bucket.compile(('author', '==', Param('author')))
+        >>> bucket.get(by_author.bind(author='dan'), order='title')
+        '''
+
+        if self.storage == u'json':
+            return Query(args, self._column_sql, _sql_value)
+        return Query(args, self._column_sql, self.codec.encode)
+
+    def _make_where(self, args):
+        '''
+        Given a list of where-clauses (or a single compiled Query), return
+        (where_clause, values), and note which columns are used, for
+        auto_index.
+        '''
+
+        if len(args) == 1 and isinstance(args[0], Query):
+            query = args[0]
+        else:
+            query = self.compile(*args)
+
+        self._note_where(query.args)
+
+        return query.where_clause()
+
+    def _decode(self, row):
+        '''
+        turn a row back into a document.  In json storage, that's either
+        the whole document, or (with fields=...) each key's JSON, in a
+        column called '.key'.
+        '''
+
+        if self.storage != u'json':
+            return _decode_row(row, self.codec.decode)
+
+        keys = row.keys()
+        if keys[-1] == _DOCUMENT_COLUMN:
+            return self.codec.decode(row[-1])
+
+        return dict((key[1:], self.codec.decode(value))
+                    for key, value in zip(keys, row)
+                    if value is not None and key != _ID_COLUMN)
+
+    def _is_column(self, name):
+        '''
+        is $name a column in the table? (including the primary key)
+        In json storage, any key could be in a document, so it's always True.
+        '''
+        if self.storage == u'json':
+            return True
+        name = unicode(name)
+        if name in self.sql_columns or name.lower() == _ID_COLUMN.lower():
+            return True
+        # It might have been added by another connection:
+        return self._refresh_columns() and name in self.sql_columns
+
+    def _make_select_columns(self, fields=None):
+        '''
+        Given a list of keys, return the columns to SELECT for them.
+        Keys which aren't columns (which no document has) are left out.
+        '''
+
+        if fields is None:
+            return u'*'
+        if isinstance(fields, basestring):
+            fields = [fields]
+
+        if self.storage == u'json':
+            return u','.join([_ID_COLUMN] +
+                             [u'{0} AS {1}'.format(
+                                 _json_text(cleanq(_DOCUMENT_COLUMN),
+                                            _json_path(field)),
+                                 cleanq(u'.' + unicode(field)))
+                              for field in fields])
+
+        return u','.join([_ID_COLUMN] +
+                         [cleanq(field) for field in fields
+                          if self._is_column(field)])
+
+    def _order_keys(self, order_input=None):
+        '''
+        given a list of columns to order by, return [(column, direction)],
+        (direction is 'ASC', 'DESC', or None), leaving out any which
+        aren't columns.
+        '''
+
+        if not order_input:
+            return []
+        if not hasattr(order_input, '__iter__'):
+            # probably a string? So stuff it in a tuple.
+            order_input = (order_input,)
+
+        keys = []
+        for order in order_input:
+            if len(order) == 2 and (order[1] == u'ASC' or order[1] == u'DESC'):
+                log.debug('sorting by %s, %s.', order[0], order[1])
+                if self._is_column(order[0]):
+                    keys.append((order[0], order[1]))
+                else:
+                    log.warn('Trying to sort (ORDER), '
+                             'but "%s" is not a column.', order[0])
+            elif self._is_column(order):
+                keys.append((order, None))
+
+        return keys
+
+    def _make_order_clause(self, order_input=None):
+        '''
+        given a list of columns to order by,
+        return the correct SQL to add into a query.
+        '''
+
+        order_segments = [self._column_sql(name) +
+                          (u' ' + direction if direction else u'')
+                          for name, direction in self._order_keys(order_input)]
+
+        if not order_segments:
+            return u''
+
+        return u'ORDER BY ' + u','.join(order_segments)
+
+
+    def _make_select(self, args, options):
+        '''
+        Given a list of where-clause three-tuples, and a dict of options
+        (order, limit, offset, fields), return ('SELECT * FROM "x" ...', values)
+        '''
+
+        # Work around python not liking *args before named args.
+        _options = {u'order': u'id', u'limit': None, u'offset': None,
+                    u'fields': None}
+        _options.update(options)
+
+        ####
+        # Sanitize column names and operators:
+        ####
+
+        where_clause, sql_values = self._make_where(args)
+
+        # Only the columns asked for:
+        columns = self._make_select_columns(_options[u'fields'])
+
+        # Order by value gets tacked on the end:
+        order_clause = self._make_order_clause(_options[u'order'])
+
+        # and then LIMIT / OFFSET, if needed:
+        limit_clause, limit_values = _make_limit_clause(_options[u'limit'],
+                                                        _options[u'offset'])
+
+        # Prepare the query:
+        sql = u'SELECT {0} FROM \"{1}\" {2} {3} {4}'.format( \
+            columns, self.table_name, where_clause, order_clause, limit_clause)
+
+        return sql, sql_values + limit_values
+
+    @_flushed_first
+    def get(self, *args, **vargs):
+        '''
+        A wrapper around sqllite SELECT (makes things a little safer,
+        and simpler)
+
+        Usage:
+
+        >>> bucket.get(('title','LIKE','%foo%'), order='mtime')
+        [ {'title': 'posts', 'other': 'are', 'data': 'returned'},
+        {'title': 'here', 'other': 'as', 'rows': 'a'},
+        {'title': 'list', 'more': 'of', 'stuff': 'dicts'} ]
+
+        You can also use limit=... and offset=... to only get some of them,
+        and fields=[...] to only get (and decode) some of the keys:
+
+        >>> bucket.get(('title','LIKE','%foo%'), fields=['title'])
+        [ {'title': 'posts'}, {'title': 'here'}, {'title': 'list'} ]
+
+        '''
+
+        sql, sql_values = self._make_select(args, vargs)
+
+        if self._results is not None:
+            return self._cached_get(sql, sql_values)
+
+        log.debug ('SQL: %s ; DATA: %s ;', sql, sql_values)
+        # Run the query, and parse the result(s).
+        return [self._decode(row) for row in
+                self.cur.execute(sql, sql_values).fetchall()]
+
+    def _cached_get(self, sql, sql_values):
+        '''
+        get(), but using the results cache.  (Each document returned is a
+        copy, but anything inside them is shared with the cache, so
+        don't change that.)
+        '''
+
+        # Has anyone else written to the database since we last looked?
+        version = self.cur.execute(u'PRAGMA data_version').fetchone()[0]
+        if version != getattr(self._local, 'data_version', None):
+            self._results.clear()
+            self._local.data_version = version
+
+        try:
+            key = (sql, tuple(sql_values))
+            data = self._results.get(key)
+        except TypeError:
+            # (some values, such as BLOBs, can't be cache keys.)
+            key, data = None, None
+
+        if data is None:
+            generation = self._results.generation
+            log.debug ('SQL: %s ; DATA: %s ;', sql, sql_values)
+            data = [self._decode(row) for row in
+                    self.cur.execute(sql, sql_values).fetchall()]
+            if key is not None:
+                self._results.put(key, data, generation)
+
+        return [dict(document) for document in data]
+
+    def cache_stats(self):
+        '''
+        How the results cache is doing: hits, misses, evictions,
+        (times it's been) cleared, and size.
+        '''
+
+        if self._results is None:
+            return {}
+
+        return self._results.stats()
+
+    @_flushed_first
+    def iterget(self, *args, **vargs):
+        '''
+        Exactly like get(), but returns a generator rather than a list.
+        Rows are fetched from the database $batch_size (default 100) at a
+        time, and only decoded as they are asked for, so even huge tables
+        can be worked through in constant memory.
+
+        >>> for document in bucket.iterget(('title','LIKE','%foo%')):
+        ...     print document['title']
+
+        '''
+
+        batch_size = vargs.pop(u'batch_size', 100)
+
+        sql, sql_values = self._make_select(args, vargs)
+
+        log.debug ('SQL: %s ; DATA: %s ;', sql, sql_values)
+
+        # Use our own cursor, so other queries can run while we're iterating.
+        cursor = self.db.cursor()
+        try:
+            cursor.execute(sql, sql_values)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield self._decode(row)
+        finally:
+            cursor.close()
+
+    @_flushed_first
+    def get_page(self, *args, **vargs):
+        '''
+        Get a page of $size (default 100) documents, and a cursor for the
+        next page, (or None, if this is the last one).  Rather than skipping
+        OFFSET rows, each page starts straight after where the last one
+        ended, (by its sort values, and then Id), so with an index on the
+        order column(s), page 10,000 is as quick as page 1.
+
+        >>> documents, cursor = bucket.get_page(('type', '==', 'post'),
+        ...                                     order=[('mtime', 'DESC')])
+        >>> more, cursor = bucket.get_page(('type', '==', 'post'),
+        ...                                order=[('mtime', 'DESC')],
+        ...                                after=cursor)
+
+        The cursor is an opaque string, and only works with the same order.
+        '''
+
+        size = int(vargs.get(u'size', 100))
+        after = vargs.get(u'after')
+        if size < 1:
+            raise ValueError('get_page() needs a size of at least 1, '
+                             'not {0}'.format(size))
+
+        # Sort by the order columns, and then Id, so every row has a place:
+        keys = []
+        for name, direction in self._order_keys(vargs.get(u'order', u'id')):
+            keys.append((unicode(name), direction or u'ASC'))
+            if keys[-1][0].lower() == _ID_COLUMN.lower():
+                break
+        else:
+            keys.append((_ID_COLUMN, u'ASC'))
+
+        where_clause, sql_values = self._make_where(args)
+        if after is not None:
+            after_clause, after_values = self._make_after(
+                keys, self._page_values(after, keys))
+            where_clause = (u'WHERE (' + where_clause[6:] + u') AND '
+                            if where_clause else u'WHERE ') + after_clause
+            sql_values = sql_values + after_values
+
+        sql = u'SELECT {0} FROM "{1}" {2} ORDER BY {3} LIMIT (?)'.format(
+            self._make_select_columns(vargs.get(u'fields')), self.table_name,
+            where_clause, u','.join([self._column_sql(name) + u' ' + direction
+                                     for name, direction in keys]))
+
+        log.debug ('SQL: %s ; DATA: %s ;', sql, sql_values)
+        rows = self.cur.execute(sql, sql_values + [size + 1]).fetchall()
+
+        if len(rows) <= size:
+            return [self._decode(row) for row in rows], None
+
+        # The cursor is the last row's sort values, as they're stored:
+        # (Id is always the first column selected.)
+        rows = rows[:size]
+        values = list(self.cur.execute(
+            u'SELECT {0} FROM "{1}" WHERE {2}=(?)'.format(
+                u','.join([self._column_sql(name) for name, _ in keys]),
+                self.table_name, _ID_COLUMN), [rows[-1][0]]).fetchone())
+
+        return [self._decode(row) for row in rows], \
+               self._page_cursor(keys, values)
+
+    @staticmethod
+    def _page_cursor(keys, values):
+        ''' make a get_page() cursor, from the sort values of a row. '''
+        values = [{u'blob': base64.b64encode(bytes(value))}
+                  if isinstance(value, buffer) else
+                  value.decode('utf-8') if isinstance(value, str) else value
+                  for value in values]
+        return base64.urlsafe_b64encode(json.dumps([keys, values]))
+
+    @staticmethod
+    def _page_values(cursor, keys):
+        ''' get the sort values back out of a get_page() cursor. '''
+        try:
+            cursor_keys, values = json.loads(base64.urlsafe_b64decode(
+                bytes(cursor)))
+        except (TypeError, ValueError):
+            raise ValueError('Not a get_page() cursor: {0!r}'.format(cursor))
+
+        if [tuple(key) for key in cursor_keys] != keys:
+            raise ValueError('That cursor is for a different order.')
+
+        return [buffer(base64.b64decode(value[u'blob']))
+                if isinstance(value, dict) else value for value in values]
+
+    def _make_after(self, keys, values):
+        '''
+        SQL for rows which come after $values, in the order $keys.  That's
+        (a > ?) OR (a IS ? AND b > ?) OR (a IS ? AND b IS ? AND c > ?) ...
+        with NULLs first when ascending, and last when descending, as
+        SQLite sorts them.
+        '''
+
+        ors, sql_values = [], []
+        equal, equal_values = [], []
+
+        for (name, direction), value in zip(keys, values):
+            column = self._column_sql(name)
+
+            if value is None:
+                after = (u'{0} IS NOT NULL'.format(column), []) \
+                        if direction == u'ASC' else None
+            elif direction == u'ASC':
+                after = (u'{0} > (?)'.format(column), [value])
+            else:
+                after = (u'({0} < (?) OR {0} IS NULL)'.format(column), [value])
+
+            if after is not None:
+                ors.append(u' AND '.join(equal + [after[0]]))
+                sql_values.extend(equal_values + after[1])
+
+            equal.append(u'{0} IS (?)'.format(column))
+            equal_values.append(value)
+
+        if not ors:
+            return u'0', []
+
+        sql = u'((' + u') OR ('.join(ors) + u'))'
+
+        # (and something simple on the first column, for its index to use:)
+        if values[0] is not None and keys[0][1] == u'ASC':
+            sql += u' AND {0} >= (?)'.format(self._column_sql(keys[0][0]))
+            sql_values.append(values[0])
+
+        return sql, sql_values
+
+    @_flushed_first
+    def delete(self, *args):
+        ''' a wrapper around sqlite DELETE '''
+
+        where_clause, sql_values = self._make_where(args)
+        sql = u'DELETE FROM \"{0}\" {1}'.format(self.table_name, where_clause)
+
+        log.debug('SQL: %s; DATA: %s;', sql, sql_values)
+
+        cursor = self.cur.execute(sql, sql_values)
+        self._wrote()
+
+        return cursor
+
+    @_flushed_first
+    def count(self, *args):
+        '''
+        How many documents match the where clause?  (Nothing is fetched or
+        decoded, so this is much faster than len(get(...)))
+        '''
+
+        where_clause, sql_values = self._make_where(args)
+
+        sql = u'SELECT COUNT(*) FROM \"{0}\" {1}'.format(self.table_name,
+                                                         where_clause)
+        log.debug('SQL: %s; DATA: %s;', sql, sql_values)
+
+        return self.cur.execute(sql, sql_values).fetchone()[0]
+
+    @_flushed_first
+    def exists(self, *args):
+        '''
+        Is there at least one document which matches the where clause?
+        '''
+
+        where_clause, sql_values = self._make_where(args)
+
+        sql = u'SELECT 1 FROM \"{0}\" {1} LIMIT 1'.format(self.table_name,
+                                                          where_clause)
+        log.debug('SQL: %s; DATA: %s;', sql, sql_values)
+
+        return self.cur.execute(sql, sql_values).fetchone() is not None
+
+    @_flushed_first
+    def aggregate(self, group_by=None, metrics=None, where=()):
+        '''
+        Count, sum, average, min or max values, (optionally grouped by some
+        keys), all in SQL, so no documents are fetched or decoded.
+        metrics is a dict of {name: 'count'} or {name: (function, key)},
+        where function is count, count_distinct, sum, total, avg, min or max.
+        Returns a list of dicts, one for each group (in order).
+
+        >>> bucket.aggregate(group_by='author',
+        ...                  metrics={'n': 'count', 'views': ('sum', 'views')},
+        ...                  where=[('published', '==', True)])
+        [{'author': u'dan', 'n': 12, 'views': 3400}, ...]
+
+        (Numbers are compared and added up as numbers, even when they're
+        stored as JSON text.)
+        '''
+
+        if isinstance(group_by, basestring):
+            group_by = [group_by]
+        group_by = list(group_by or [])
+        metrics = metrics or {u'count': u'count'}
+
+        # A single where clause, rather than a list of them:
+        if isinstance(where, (And, Query)) or \
+          (where and isinstance(where[0], basestring)):
+            where = [where]
+
+        names = []
+        columns = []
+        decoders = []
+
+        for key in group_by:
+            names.append(key)
+            columns.append(self._group_sql(key))
+            decoders.append(self.codec.decode)
+
+        for name, metric in metrics.items():
+            function, key = (metric, None) if isinstance(metric, basestring) \
+                            else metric
+            if function not in _AGGREGATES:
+                raise KeyError('Invalid aggregate ({0})'.format(function))
+
+            if key is None:
+                if function != u'count':
+                    raise ValueError('{0} needs a key to work on'.format(
+                        function))
+                value, decode = u'*', None
+            else:
+                value, decode = self._value_sql(key)
+
+            names.append(name)
+            columns.append(_AGGREGATES[function].format(value))
+            decoders.append(decode if function in (u'min', u'max') else None)
+
+        where_clause, sql_values = self._make_where(where)
+
+        positions = u','.join(unicode(n + 1) for n in range(len(group_by)))
+        sql = u'SELECT {0} FROM "{1}" {2} {3}'.format(
+            u','.join(columns), self.table_name, where_clause,
+            u'GROUP BY {0} ORDER BY {0}'.format(positions) if group_by else u'')
+
+        log.debug('SQL: %s; DATA: %s;', sql, sql_values)
+
+        return [dict((name, value if decode is None or value is None
+                      else decode(value))
+                     for name, value, decode in zip(names, row, decoders))
+                for row in self.cur.execute(sql, sql_values).fetchall()]
+
+    def _group_sql(self, key):
+        ''' the SQL to GROUP BY $key, which gives back codec values. '''
+
+        if not self._is_column(key):
+            return u'NULL'
+        elif self.storage == u'json':
+            return _json_text(cleanq(_DOCUMENT_COLUMN), _json_path(key))
+        return cleanq(key)
+
+    def _value_sql(self, key):
+        '''
+        The SQL for $key as a plain SQLite value, (so numbers are numbers),
+        to aggregate, and how to decode it.
+        '''
+
+        if not self._is_column(key):
+            return u'NULL', None
+        elif self.storage == u'json' or self.codec.name == NativeCodec.name:
+            return self._column_sql(key), NativeCodec.decode
+        elif self.codec.name == JSONCodec.name:
+            return u'json_extract({0}, \'$\')'.format(cleanq(key)), \
+                   NativeCodec.decode
+        return cleanq(key), self.codec.decode
+
+    ############################################################################
+    # Access by Id (primary key):
+
+    @_flushed_first
+    def get_by_id(self, doc_id):
+        '''
+        Get a single document by its Id (as returned by store()),
+        or None if there isn't one.
+        '''
+
+        row = self.cur.execute(u'SELECT * FROM "{0}" WHERE {1}=(?)'.format(
+            self.table_name, _ID_COLUMN), [doc_id]).fetchone()
+
+        return None if row is None else self._decode(row)
+
+    @_flushed_first
+    def get_many_by_ids(self, doc_ids):
+        '''
+        Get lots of documents by their Ids.
+        Returns a dict of {Id: document}, missing Ids are left out.
+        '''
+
+        documents = {}
+
+        # SQLite only allows so many parameters per query:
+        for chunk in _chunks(doc_ids, 500):
+            sql = u'SELECT * FROM "{0}" WHERE {1} IN ({2})'.format(
+                self.table_name, _ID_COLUMN, u','.join(len(chunk) * u'?'))
+
+            # (Id is always the first column)
+            for row in self.cur.execute(sql, chunk).fetchall():
+                documents[row[0]] = self._decode(row)
+
+        return documents
+
+    @_flushed_first
+    def update_by_id(self, doc_id, document, insert=False):
+        '''
+        Update the document with Id $doc_id.  If $insert is true, and
+        there's no document with that Id, then store it with that Id.
+        Returns the number of rows changed.
+        '''
+
+        set_clause, values = self._make_set_clause(document)
+
+        sql = u'UPDATE "{0}" SET {1} WHERE {2}=(?)'.format(
+            self.table_name, set_clause, _ID_COLUMN)
+
+        log.debug('SQL: %s, DATA: %s, ID: %s', sql, values, doc_id)
+
+        self.cur.execute(sql, values + [doc_id])
+
+        if self.cur.rowcount == 0 and insert:
+            columns, values = self._encode(document)
+            sql = self._make_insert([_ID_COLUMN] + columns)
+            self.cur.execute(sql, [doc_id] + values)
+
+        self._wrote()
+
+        return self.cur.rowcount
+
+    @_flushed_first
+    def delete_by_id(self, doc_id):
+        '''
+        Delete the document with Id $doc_id.
+        Returns the number of rows deleted.
+        '''
+
+        count = self.cur.execute(u'DELETE FROM "{0}" WHERE {1}=(?)'.format(
+            self.table_name, _ID_COLUMN), [doc_id]).rowcount
+        self._wrote()
+
+        return count
+
+    ############################################################################
+    # Indexes:
+
+    def _index_name(self, columns):
+        ''' the default name for an index on this table over $columns '''
+        return u'__'.join([self.table_name] + [clean(c) for c in columns])
+
+    @_flushed_first
+    def create_index(self, columns, unique=False, name=None):
+        '''
+        Create an index on one or more columns, so that where clauses
+        using them don't need to scan the whole table.  Values are compared
+        as the stored json text, so ('col', '==', value) queries use the
+        index with no extra work.  Columns which don't exist yet are added.
+        (In json storage, the index is on the json_extract() of each key,
+        which can be a nested 'a.b.c' path.)
+        Returns the name of the index.
+
+        >>> bucket.create_index('title')
+        >>> bucket.create_index(['author', 'title'], unique=True)
+        '''
+
+        if isinstance(columns, basestring):
+            columns = [columns]
+
+        name = name or self._index_name(columns)
+
+        if self.storage == u'json':
+            columns = [self._column_sql(column) for column in columns]
+        else:
+            columns = self._update_columns(columns)
+
+        sql = u'CREATE {0}INDEX IF NOT EXISTS {1} ON "{2}"({3})'.format(
+            u'UNIQUE ' if unique else u'',
+            cleanq(name),
+            self.table_name,
+            u','.join(columns))
+
+        log.debug('SQL: %s', sql)
+
+        self.cur.execute(sql)
+        self._commit()
+
+        return name
+
+    @_flushed_first
+    def drop_index(self, name):
+        '''
+        Remove an index, either by name, or by the list of columns it was
+        created with (if it was created without a custom name).
+        '''
+
+        if not isinstance(name, basestring):
+            name = self._index_name(name)
+
+        self.cur.execute(u'DROP INDEX IF EXISTS {0}'.format(cleanq(name)))
+        self._commit()
+
+    def list_indexes(self):
+        '''
+        Returns a list of the indexes on this table, as dicts:
+        [{'name': 'def__title', 'columns': ['title'], 'unique': False}, ...]
+        '''
+
+        indexes = []
+
+        for index in self.cur.execute(u'PRAGMA index_list("{0}")'.format(
+                self.table_name)).fetchall():
+            columns = [i[2] for i in self.cur.execute(
+                u'PRAGMA index_info({0})'.format(cleanq(index[1]))).fetchall()]
+
+            if None in columns:
+                # Indexes on json_extract() in json storage have no column
+                # names, so get the keys back out of the SQL:
+                sql = self.cur.execute(u'SELECT sql FROM sqlite_master WHERE '
+                                       u'name=(?)', [index[1]]).fetchone()[0]
+                paths = iter([_path_key(path.replace(u"''", u"'")) for path in
+                              _INDEX_PATHS.findall(sql.decode('utf-8'))])
+                columns = [next(paths, None) if column is None else column
+                           for column in columns]
+
+            indexes.append({u'name': index[1],
+                            u'columns': columns,
+                            u'unique': bool(index[2])})
+
+        return indexes
+
+    def _note_where(self, args):
+        '''
+        If auto_index is on, count how often each column is used in
+        a where clause, and index it once it's been used enough.
+        '''
+
+        if not self.auto_index:
+            return
+
+        for (col, operator, _) in _where_leaves(args):
+            if operator in _INDEXABLE_OPERATORS:
+                count = self._where_counts.get(col, 0) + 1
+                self._where_counts[col] = count
+
+                if count == self.auto_index and not any(
+                        index[u'columns'][:1] == [unicode(col)]
+                        for index in self.list_indexes()):
+                    log.info('Auto-indexing column "%s"', col)
+                    self.create_index([col])
+
+    ############################################################################
+    # Column statistics, and compacting:
+
+    def _size(self):
+        ''' how big the database file is, in bytes. '''
+        return self.cur.execute(u'PRAGMA page_count').fetchone()[0] * \
+               self.cur.execute(u'PRAGMA page_size').fetchone()[0]
+
+    def _column_counts(self, columns):
+        '''
+        {column: (non-NULL values, bytes, last Id with a value)} for some
+        columns, in one pass over the table, (well, one per few hundred
+        columns, as SQLite only does so many results at once).
+        '''
+
+        counts = {}
+        for chunk in _chunks(columns, 250):
+            sql = u'SELECT {0} FROM "{1}"'.format(u','.join(
+                u'COUNT({0}),SUM(LENGTH(CAST({0} AS BLOB))),'
+                u'MAX(CASE WHEN {0} IS NOT NULL THEN {1} END)'.format(
+                    cleanq(column), _ID_COLUMN) for column in chunk),
+                self.table_name)
+            row = self.cur.execute(sql).fetchone()
+            for i, column in enumerate(chunk):
+                counts[column] = (row[i * 3], row[i * 3 + 1] or 0, row[i * 3 + 2])
+        return counts
+
+    @_flushed_first
+    def stats(self, sample=10000):
+        '''
+        Look at what's actually in the table: for each key (column), how
+        many documents have it, how much space its values take, about how
+        many different values it has, (worked out from a random $sample
+        of rows), and the last Id which has it.  Keys with no values left
+        (which compact() would get rid of) are 'dead'.
+
+        The report is kept (in the metadata table) so the next one can say
+        when each key was last seen being written: the first stats() after
+        a new document has it.
+
+        Returns {'rows', 'size' (of the whole database file), 'analyzed',
+                 'dead': [keys],
+                 'columns': [{'name', 'non_null', 'bytes', 'distinct',
+                              'last_id', 'last_seen'}, ...]}
+        with the biggest columns first.
+        '''
+
+        now = time.time()
+        rows = self.cur.execute(u'SELECT COUNT(*) FROM "{0}"'.format(
+            self.table_name)).fetchone()[0]
+
+        sample_name = self.table_name + u'__sample'
+        self.cur.execute(u'DROP TABLE IF EXISTS temp."{0}"'.format(sample_name))
+        self.cur.execute(u'CREATE TEMP TABLE "{0}" AS SELECT * FROM "{1}" '
+                         u'WHERE {2} IN (SELECT {2} FROM "{1}" ORDER BY '
+                         u'random() LIMIT (?))'.format(sample_name,
+                                                       self.table_name,
+                                                       _ID_COLUMN), [sample])
+        sampled = min(rows, sample)
+
+        try:
+            if self.storage == u'json':
+                # The keys are inside the documents:
+                counts = {}
+                for key, non_null, size, last_id in self.cur.execute(
+                        u'SELECT j.key, COUNT(*), SUM(LENGTH(CAST(j.value AS '
+                        u'BLOB))), MAX(t.{0}) FROM "{1}" t, json_each(t."{2}") j'
+                        u' GROUP BY j.key'.format(_ID_COLUMN, self.table_name,
+                                                  _DOCUMENT_COLUMN)).fetchall():
+                    counts[key.decode('utf-8')] = (non_null, size or 0, last_id)
+                seen = dict((key.decode('utf-8'), (singles, values, total))
+                            for key, singles, values, total in self.cur.execute(
+                    u'SELECT key, SUM(n = 1), COUNT(*), SUM(n) FROM ('
+                    u'SELECT j.key, COUNT(*) n FROM "{0}" t, json_each(t."{1}")'
+                    u' j GROUP BY j.key, j.type, j.value) GROUP BY key'.format(
+                        sample_name, _DOCUMENT_COLUMN)).fetchall())
+            else:
+                counts = self._column_counts(sorted(self.sql_columns))
+                seen = {}
+                for column in counts:
+                    seen[column] = self.cur.execute(
+                        u'SELECT SUM(n = 1), COUNT(*), SUM(n) FROM (SELECT '
+                        u'COUNT(*) n FROM "{0}" WHERE {1} IS NOT NULL '
+                        u'GROUP BY {1})'.format(sample_name, cleanq(column))
+                        ).fetchone()
+        finally:
+            self.cur.execute(u'DROP TABLE temp."{0}"'.format(sample_name))
+
+        previous = json.loads(self._get_meta(u'stats') or u'{}')
+        previous = dict((column[u'name'], column)
+                        for column in previous.get(u'columns', []))
+
+        columns = []
+        for name, (non_null, size, last_id) in counts.items():
+            singles, values, total = seen.get(name) or (0, 0, 0)
+            if sampled >= rows or not total:
+                distinct = values
+            elif singles == total:
+                # (every value sampled was different, so they probably all are)
+                distinct = non_null
+            else:
+                # (the 'GEE' estimate: values seen once in the sample
+                # probably have more like them, which weren't sampled.)
+                distinct = min(non_null, int(round(
+                    (non_null / float(total)) ** 0.5 * singles +
+                    values - singles)))
+
+            before = previous.get(name)
+            if before is None or last_id != before[u'last_id'] or \
+              non_null > before[u'non_null']:
+                last_seen = now if non_null else None
+            else:
+                last_seen = before[u'last_seen']
+
+            columns.append({u'name': name, u'non_null': non_null,
+                            u'bytes': size, u'distinct': distinct,
+                            u'last_id': last_id, u'last_seen': last_seen})
+
+        columns.sort(key=lambda column: (-column[u'bytes'], column[u'name']))
+
+        report = {u'rows': rows, u'size': self._size(), u'analyzed': now,
+                  u'columns': columns,
+                  u'dead': [column[u'name'] for column in columns
+                            if not column[u'non_null']]}
+
+        self._set_meta(u'stats', json.dumps(report))
+
+        return report
+
+    @_flushed_first
+    def compact(self, vacuum=True):
+        '''
+        Rebuild the table without the columns which no document has any
+        more, (every key ever stored gets a column, which stays there even
+        after all the documents with it are deleted), and then VACUUM the
+        database, to give the space back.  Indexes on dropped columns go
+        too.  Nothing else should be using the table while this runs.
+
+        Returns {'dropped': [columns], 'size_before', 'size_after'}
+        '''
+
+        size_before = self._size()
+        dropped = []
+
+        if self.storage != u'json':
+            keep = set(self.fulltext_columns() or [])
+            counts = self._column_counts(sorted(self.sql_columns))
+            dropped = [column for column, (non_null, _, _)
+                       in sorted(counts.items())
+                       if not non_null and column not in keep]
+
+        if dropped:
+            log.info('Dropping empty columns from "%s": %s',
+                     self.table_name, dropped)
+            self._rebuild_table([column for column in sorted(self.sql_columns)
+                                 if column not in dropped], dropped)
+
+            # Forget the old columns, (and SQL and results using them):
+            self._refresh_columns()
+            if self._results is not None:
+                self._results.clear()
+
+            catalog = self._get_meta(u'stats')
+            if catalog is not None:
+                catalog = json.loads(catalog)
+                catalog[u'columns'] = [column for column in catalog[u'columns']
+                                       if column[u'name'] not in dropped]
+                catalog[u'dead'] = [name for name in catalog[u'dead']
+                                    if name not in dropped]
+                self._set_meta(u'stats', json.dumps(catalog))
+
+        if vacuum:
+            self._commit()
+            self.cur.execute(u'VACUUM')
+
+        return {u'dropped': dropped, u'size_before': size_before,
+                u'size_after': self._size()}
+
+    ############################################################################
+    # Full-text search:
+
+    @_flushed_first
+    def enable_fulltext(self, columns):
+        '''
+        Keep an FTS5 full-text index of some (text) columns, so they can be
+        search()ed.  The index is kept up to date by triggers, so store(),
+        update() and delete() (and plain SQL) all work as normal.  Calling
+        it again with different columns replaces the index.
+
+        >>> bucket.enable_fulltext(['title', 'body'])
+        '''
+
+        if isinstance(columns, basestring):
+            columns = [columns]
+        columns = [unicode(column) for column in columns]
+
+        fts = cleanq(self.table_name + u'__fts')
+        names = u','.join(cleanq(column) for column in columns)
+
+        def value(column, row):
+            ''' the SQL for one value to index, from a row in a trigger. '''
+            sql = self._column_sql(column, row)
+            if self.storage != u'json' and self.codec.name == JSONCodec.name:
+                # index the text itself, not its JSON, (or '\n' & co. would
+                # stick to the next word), but don't choke on non-JSON:
+                return u'CASE WHEN json_valid({0}) THEN json_extract({0}, ' \
+                       u'\'$\') ELSE {0} END'.format(sql)
+            return sql
+
+        def values(row):
+            ''' the values to index, from a row in a trigger. '''
+            return u','.join(value(column, row) for column in columns)
+
+        if self.storage == u'json':
+            watched = cleanq(_DOCUMENT_COLUMN)
+        else:
+            watched = u','.join(self._update_columns(columns))
+
+        # (FTS5 doesn't keep its own copy of the text, just the index, so
+        #  removing a row means telling it what the old text was.)
+        insert = u'INSERT INTO {0}(rowid,{1}) VALUES (new.{2},{3});'.format(
+            fts, names, _ID_COLUMN, values(u'new.'))
+        delete = u'INSERT INTO {0}({0},rowid,{1}) VALUES ' \
+                 u'(\'delete\',old.{2},{3});'.format(fts, names, _ID_COLUMN,
+                                                   values(u'old.'))
+
+        with self.transaction():
+            self._drop_fulltext()
+
+            self.cur.execute(u'CREATE VIRTUAL TABLE {0} USING fts5({1}, '
+                             u'content=\'\')'.format(fts, names))
+
+            for name, event, sql in ((u'insert', u'INSERT', insert),
+                                     (u'delete', u'DELETE', delete),
+                                     (u'update', u'UPDATE OF ' + watched,
+                                      delete + insert)):
+                self.cur.execute(u'CREATE TRIGGER {0} AFTER {1} ON "{2}" '
+                                 u'BEGIN {3} END'.format(
+                                     cleanq(self.table_name + u'__fts_' + name),
+                                     event, self.table_name, sql))
+
+            # and index everything that's already there:
+            self.cur.execute(u'INSERT INTO {0}(rowid,{1}) SELECT {2},{3} '
+                             u'FROM "{4}"'.format(fts, names, _ID_COLUMN,
+                                                  values(u''), self.table_name))
+
+            self._set_meta(u'fulltext', json.dumps(columns))
+
+    @_flushed_first
+    def disable_fulltext(self):
+        ''' Remove the full-text index (if there is one). '''
+
+        with self.transaction():
+            self._drop_fulltext()
+
+    def _drop_fulltext(self):
+        ''' remove the full-text index and its triggers. '''
+
+        for name in (u'insert', u'delete', u'update'):
+            self.cur.execute(u'DROP TRIGGER IF EXISTS {0}'.format(
+                cleanq(self.table_name + u'__fts_' + name)))
+        self.cur.execute(u'DROP TABLE IF EXISTS {0}'.format(
+            cleanq(self.table_name + u'__fts')))
+        self.cur.execute(u'DELETE FROM "{0}" WHERE tbl=(?) AND key=(?)'.format(
+            _META_TABLE), [self.table_name, u'fulltext'])
+
+    def fulltext_columns(self):
+        ''' The columns in the full-text index, or None if there isn't one. '''
+
+        columns = self._get_meta(u'fulltext')
+        return None if columns is None else json.loads(columns)
+
+    @_flushed_first
+    def search(self, query, fields=None, limit=None, offset=None, rank=True):
+        '''
+        Full-text search of the columns given to enable_fulltext(), using
+        FTS5 query syntax ('sqlite AND python', '"exact phrase"',
+        'title: foo*', ...).  Returns a list of documents, best matches
+        first, (or in Id order, if rank is False).  fields, limit and
+        offset work just like they do in get().
+
+        >>> bucket.search('python sqlite', fields=['title'], limit=10)
+        [{'title': 'SQLite from python'}, ...]
+        '''
+
+        if self.fulltext_columns() is None:
+            raise ValueError('Table "{0}" has no full-text index, use '
+                             'enable_fulltext() first.'.format(self.table_name))
+
+        columns = self._make_select_columns(fields)
+        if columns == u'*':
+            columns = u'"{0}".*'.format(self.table_name)
+
+        order = u'rank' if rank else u'rowid'
+        limit_clause, limit_values = _make_limit_clause(limit, offset)
+
+        sql = u'SELECT {0} FROM (SELECT rowid AS _fts_rowid, {1} AS _fts_order ' \
+              u'FROM {2} WHERE {2} MATCH (?) ORDER BY {1} {3}) ' \
+              u'JOIN "{4}" ON {5}=_fts_rowid ORDER BY _fts_order'.format(
+                  columns, order, cleanq(self.table_name + u'__fts'),
+                  limit_clause, self.table_name, _ID_COLUMN)
+
+        log.debug('SQL: %s; QUERY: %s;', sql, query)
+
+        return [self._decode(row) for row in
+                self.cur.execute(sql, [query] + limit_values).fetchall()]
+
+    ############################################################################
+    # The changelog:
+
+    @_flushed_first
+    def enable_changelog(self, keep=None):
+        '''
+        Record every insert, update and delete to the table (by store(),
+        update(), delete(), or plain SQL) in a changelog, with a sequence
+        number which only ever goes up, so other things (caches, replicas,
+        search indexes...) can ask what's changed since they last looked,
+        with changes(), rather than checking everything.  It's kept by
+        triggers, in a "{table}__changes" table.  Only the last $keep
+        changes are kept, if that's set, (or see truncate_changes()).
+
+        >>> bucket.enable_changelog(keep=100000)
+        '''
+
+        changes = cleanq(self.table_name + u'__changes')
+        now = u"(julianday('now') - 2440587.5) * 86400.0"
+
+        with self.transaction():
+            self._drop_changelog_triggers()
+
+            self.cur.execute(u'CREATE TABLE IF NOT EXISTS {0}(seq INTEGER '
+                             u'PRIMARY KEY AUTOINCREMENT, op TEXT, doc_id '
+                             u'INTEGER, time REAL)'.format(changes))
+
+            for op, event, row in ((u'insert', u'INSERT', u'new'),
+                                   (u'update', u'UPDATE', u'new'),
+                                   (u'delete', u'DELETE', u'old')):
+                self.cur.execute(
+                    u'CREATE TRIGGER {0} AFTER {1} ON "{2}" BEGIN INSERT INTO '
+                    u'{3}(op, doc_id, time) VALUES (\'{4}\', {5}.{6}, {7}); '
+                    u'END'.format(cleanq(self.table_name + u'__changes_' + op),
+                                  event, self.table_name, changes, op, row,
+                                  _ID_COLUMN, now))
+
+            if keep is not None:
+                self.cur.execute(
+                    u'CREATE TRIGGER {0} AFTER INSERT ON {1} BEGIN DELETE '
+                    u'FROM {1} WHERE seq <= new.seq - {2}; END'.format(
+                        cleanq(self.table_name + u'__changes_keep'), changes,
+                        int(keep)))
+
+            self._set_meta(u'changelog', json.dumps({u'keep': keep}))
+
+    @_flushed_first
+    def disable_changelog(self):
+        ''' Stop recording changes, and throw away the changelog. '''
+
+        with self.transaction():
+            self._drop_changelog_triggers()
+            self.cur.execute(u'DROP TABLE IF EXISTS {0}'.format(
+                cleanq(self.table_name + u'__changes')))
+            self.cur.execute(u'DELETE FROM "{0}" WHERE tbl=(?) AND key=(?)'
+                             .format(_META_TABLE),
+                             [self.table_name, u'changelog'])
+
+    def _drop_changelog_triggers(self):
+        ''' remove the triggers which keep the changelog. '''
+        for name in (u'insert', u'update', u'delete', u'keep'):
+            self.cur.execute(u'DROP TRIGGER IF EXISTS {0}'.format(
+                cleanq(self.table_name + u'__changes_' + name)))
+
+    def changelog_settings(self):
+        ''' {'keep': ...} if there's a changelog, otherwise None. '''
+
+        settings = self._get_meta(u'changelog')
+        return None if settings is None else json.loads(settings)
+
+    def _change_sequence(self):
+        '''
+        (the sequence number of the last change, and of the oldest one still
+        in the changelog), or raise ValueError if there isn't a changelog.
+        '''
+
+        if self.changelog_settings() is None:
+            raise ValueError('Table "{0}" has no changelog, use '
+                             'enable_changelog() first.'.format(self.table_name))
+
+        changes = self.table_name + u'__changes'
+        last = self.cur.execute(u'SELECT seq FROM sqlite_sequence WHERE '
+                                u'name=(?)', [changes]).fetchone()
+        last = last[0] if last else 0
+        oldest = self.cur.execute(u'SELECT MIN(seq) FROM {0}'.format(
+            cleanq(changes))).fetchone()[0]
+
+        return last, last + 1 if oldest is None else oldest
+
+    def last_change(self):
+        '''
+        The sequence number of the latest change, (so a copy of everything
+        taken now can be kept up to date with changes(since=last_change())).
+        '''
+        return self._change_sequence()[0]
+
+    @_flushed_first
+    def changes(self, since=0, latest=False, fields=None, batch_size=100):
+        '''
+        A generator of everything which has changed since the change
+        numbered $since, oldest first:
+
+        {'seq': 1234, 'op': 'insert' / 'update' / 'delete', 'id': 56,
+         'time': 1400000000.0, 'document': {...} (or None, if it's deleted)}
+
+        The document is how it is now, (not when the change happened).
+        With latest=True, there's only one change for each document, its
+        latest one.  If some of the changes since $since have been
+        thrown away already, there's no way of catching up, so it raises
+        ValueError, and you need to start again from a full copy.
+
+        >>> for change in bucket.changes(since=last_seen):
+        ...     last_seen = change['seq']
+        '''
+
+        last, oldest = self._change_sequence()
+        if since < oldest - 1:
+            raise ValueError('Changes after {0} have been truncated, the '
+                             'oldest left is {1}.'.format(since, oldest))
+
+        changes = cleanq(self.table_name + u'__changes')
+        sql = u'SELECT seq, op, doc_id, time FROM {0} WHERE seq > (?) ' \
+              u'AND seq <= (?) ORDER BY seq'.format(changes)
+        if latest:
+            sql = u'SELECT seq, op, doc_id, time FROM {0} WHERE seq IN (' \
+                  u'SELECT MAX(seq) FROM {0} WHERE seq > (?) AND seq <= (?) ' \
+                  u'GROUP BY doc_id) ORDER BY seq'.format(changes)
+
+        log.debug('SQL: %s ; DATA: %s ;', sql, [since, last])
+
+        # Use our own cursor, so other queries can run while we're iterating.
+        cursor = self.db.cursor()
+        try:
+            cursor.execute(sql, [since, last])
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                # Get the documents for the whole batch at once:
+                ids = list(set(row[2] for row in rows))
+                documents = dict((row[0], self._decode(row)) for row in
+                                 self.cur.execute(
+                    u'SELECT {0} FROM "{1}" WHERE {2} IN ({3})'.format(
+                        self._make_select_columns(fields), self.table_name,
+                        _ID_COLUMN, u','.join(u'?' * len(ids))), ids))
+
+                for seq, op, doc_id, changed in rows:
+                    yield {u'seq': seq, u'op': op, u'id': doc_id,
+                           u'time': changed, u'document': documents.get(doc_id)}
+        finally:
+            cursor.close()
+
+    @_flushed_first
+    def truncate_changes(self, before=None, older_than=None, keep=None):
+        '''
+        Throw away old changes: the ones numbered before $before, the ones
+        more than $older_than seconds old, and/or all but the last $keep.
+        Returns how many were thrown away.
+        '''
+
+        last, _ = self._change_sequence()
+        clauses, values = [], []
+
+        if before is not None:
+            clauses.append(u'seq < (?)')
+            values.append(before)
+        if older_than is not None:
+            clauses.append(u'time < (?)')
+            values.append(time.time() - older_than)
+        if keep is not None:
+            clauses.append(u'seq <= (?)')
+            values.append(last - keep)
+
+        if not clauses:
+            return 0
+
+        cursor = self.cur.execute(u'DELETE FROM {0} WHERE {1}'.format(
+            cleanq(self.table_name + u'__changes'), u' OR '.join(clauses)),
+                                  values)
+        self._commit()
+        return cursor.rowcount
+
+
+def migrate_storage(db_name, table_name=u'def', storage=u'json',
+                    chunk_size=1000):
+    '''
+    Move an existing table over to a different storage ('json' or 'columns'),
+    keeping every document's Id, and making the same indexes again, (on the
+    same keys).  Nothing else should be using the table while this runs.
+    Returns the number of documents moved.
+
+    >>> migrate_storage('data.db', 'table_of_random_stuff', 'json')
+    '''
+
+    if storage not in STORAGES:
+        raise ValueError('Unknown storage "{0}"'.format(storage))
+
+    table_name = clean(table_name)
+    temp_name = table_name + u'__migrate'
+    count = 0
+
+    with DictLiteStore(db_name, table_name) as source:
+        if source.storage == storage:
+            return 0
+
+        indexes = source.list_indexes()
+        fulltext = source.fulltext_columns()
+        changelog = source.changelog_settings()
+
+        # (left over from a migration which didn't finish?)
+        with source.transaction():
+            source.cur.execute(u'DROP TABLE IF EXISTS "{0}"'.format(temp_name))
+            source.cur.execute(u'DELETE FROM "{0}" WHERE tbl=(?)'.format(
+                _META_TABLE), [temp_name])
+
+        target = DictLiteStore(db_name, temp_name, codec=source.codec,
+                               storage=storage)
+        with target:
+            select = u'SELECT * FROM "{0}" {{0}} ORDER BY {1} LIMIT (?)' \
+                     .format(table_name, _ID_COLUMN)
+
+            rows = source.cur.execute(select.format(u''),
+                                      [chunk_size]).fetchall()
+            while rows:
+                with target.transaction():
+                    for row in rows:
+                        columns, values = target._encode(source._decode(row)) # pylint: disable=protected-access
+                        target.cur.execute(target._make_insert( # pylint: disable=protected-access
+                            [_ID_COLUMN] + columns), [row[0]] + values)
+                count += len(rows)
+
+                rows = source.cur.execute(
+                    select.format(u'WHERE {0} > (?)'.format(_ID_COLUMN)),
+                    [rows[-1][0], chunk_size]).fetchall()
+
+        # Swap the new table in for the old one:
+        with source.transaction():
+            source.cur.execute(u'DROP TABLE "{0}"'.format(table_name))
+            source.cur.execute(u'ALTER TABLE "{0}" RENAME TO "{1}"'.format(
+                temp_name, table_name))
+            source.cur.execute(u'DELETE FROM "{0}" WHERE tbl=(?)'.format(
+                _META_TABLE), [table_name])
+            source.cur.execute(u'UPDATE "{0}" SET tbl=(?) WHERE tbl=(?)'.format(
+                _META_TABLE), [table_name, temp_name])
+
+    with DictLiteStore(db_name, table_name) as store:
+        for index in indexes:
+            store.create_index(index[u'columns'], unique=index[u'unique'],
+                               name=index[u'name'])
+        if fulltext:
+            store.enable_fulltext(fulltext)
+        # (the changelog table itself is still there, so nothing's lost:)
+        if changelog is not None:
+            store.enable_changelog(**changelog)
+
+    return count
+
+
+################################################################################
+# Importing and exporting (JSON lines and CSV files):
+
+@contextmanager
+def _opened(file_or_name, mode):
+    '''
+    a file, given a file object (which is left open), a file name, or '-'
+    for stdin / stdout.
+    '''
+
+    if hasattr(file_or_name, 'read') or hasattr(file_or_name, 'write'):
+        yield file_or_name
+    elif file_or_name == '-':
+        yield sys.stdin if 'r' in mode else sys.stdout
+    else:
+        with open(file_or_name, mode) as opened:
+            yield opened
+
+def _import(store, documents, chunk_size, skip):
+    '''
+    store_many() documents, $chunk_size at a time, (each chunk its own
+    transaction), skipping the first $skip.
+    '''
+
+    count = 0
+    for chunk in _chunks(islice(documents, skip, None), chunk_size):
+        store.store_many(chunk, chunk_size=None)
+        count += len(chunk)
+    return count
+
+def import_jsonl(store, source, chunk_size=1000, skip=0):
+    '''
+    Store each line (a JSON object) of a file in a DictLiteStore, reading
+    and committing $chunk_size documents at a time.  Blank lines are ignored.
+    If an import stopped half way, start again with skip=(the number of
+    documents it stored), as each chunk is stored completely, or not at all.
+    Returns the number of documents stored.
+
+    >>> import_jsonl(bucket, 'backup.jsonl')
+    '''
+
+    with _opened(source, 'rb') as lines:
+        return _import(store, (json.loads(line) for line in lines
+                               if line.strip()), chunk_size, skip)
+
+def _exported(store, args, options):
+    ''' iterget() the documents export_jsonl() / export_csv() asked for. '''
+    options = dict(options)
+    options[u'batch_size'] = options.pop(u'chunk_size', 1000)
+    return store.iterget(*args, **options)
+
+def export_jsonl(store, target, *args, **options):
+    '''
+    Write documents from a DictLiteStore to a file, one JSON object per
+    line, fetching $chunk_size (default 1000) at a time.  Takes the same
+    where clauses and fields / order / limit / offset as get(), so an export
+    can be picked up again with offset=(the number of lines written).
+    Returns the number of documents written.
+
+    >>> export_jsonl(bucket, 'active.jsonl', ('active', '==', True),
+    ...              fields=['name', 'email'])
+    '''
+
+    count = 0
+    with _opened(target, 'wb') as output:
+        for document in _exported(store, args, options):
+            line = json.dumps(document, ensure_ascii=False, default=unicode)
+            output.write((line + u'\n').encode('utf-8'))
+            count += 1
+    return count
+
+def _from_csv(text):
+    ''' a value from a CSV cell: JSON if it's valid JSON, otherwise text. '''
+    text = text.decode('utf-8')
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def _to_csv(value):
+    '''
+    a CSV cell for a value: text as it is (unless it would read back as
+    something else), and anything else as JSON, (so None is null, leaving
+    empty cells for missing keys).
+    '''
+
+    if isinstance(value, basestring):
+        try:
+            json.loads(value)
+        except ValueError:
+            if value:
+                return value.encode('utf-8') if isinstance(value, unicode) \
+                       else value
+    return json.dumps(value, ensure_ascii=False, default=unicode).encode('utf-8')
+
+def import_csv(store, source, chunk_size=1000, skip=0):
+    '''
+    Store each row of a CSV file (with the keys in the first row) as a
+    document, like import_jsonl().  Cells which are valid JSON (numbers,
+    true, [lists], "quoted text") are decoded, anything else is text,
+    and empty cells are left out of the document.
+
+    >>> import_csv(bucket, 'people.csv', skip=20000)
+    '''
+
+    with _opened(source, 'rb') as lines:
+        reader = csv.reader(lines)
+        keys = [key.decode('utf-8') for key in next(reader, [])]
+        return _import(store, (dict((key, _from_csv(cell))
+                                    for key, cell in zip(keys, row) if cell)
+                               for row in reader), chunk_size, skip)
+
+def export_csv(store, target, *args, **options):
+    '''
+    Write documents from a DictLiteStore to a CSV file, with the keys in the
+    first row, like export_jsonl().  Without fields=[...], every column is
+    written, in alphabetical order, (in json storage, that takes an extra
+    pass to find the keys, which are in the order they're found).
+    Text is written as it is, and anything else as JSON, so import_csv()
+    reads it back the same.  Returns the number of documents written.
+    '''
+
+    fields = options.get(u'fields')
+    if fields is None:
+        if store.storage == u'json':
+            keys = OrderedDict()
+            for document in _exported(store, args, options):
+                keys.update((key, True) for key in document)
+            fields = list(keys)
+        else:
+            fields = sorted(store.sql_columns)
+    elif isinstance(fields, basestring):
+        fields = [fields]
+
+    count = 0
+    with _opened(target, 'wb') as output:
+        writer = csv.writer(output)
+        writer.writerow([unicode(key).encode('utf-8') for key in fields])
+        for document in _exported(store, args, options):
+            writer.writerow([_to_csv(document[key]) if key in document
+                             else '' for key in fields])
+            count += 1
+    return count
+
+
+################################################################################
+# Running DictLiteStore in the background:
+
+class Future(object):
+    '''
+    The result of a call which is running on another thread.  (A small part
+    of concurrent.futures.Future, which python 2 doesn't have.)
+
+    Callbacks are run on the thread which finishes the call, so to get
+    back onto an event loop, use its thread-safe call (tornado's
+    IOLoop.add_callback, twisted's reactor.callFromThread, etc).
+    '''
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        ''' has the call finished yet? '''
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        ''' wait for the call to finish, and return what it returned
+            (or raise what it raised). '''
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting for a result')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        ''' wait for the call to finish, and return what it raised. '''
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting for a result')
+        return self._exception
+
+    def add_done_callback(self, function):
+        ''' call function(future) when the call finishes. '''
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(function)
+                return
+        function(self)
+
+    def _set(self, result=None, exception=None):
+        ''' the call has finished. '''
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for function in callbacks:
+            try:
+                function(self)
+            except Exception: # pylint: disable=broad-except
+                log.exception('Error in Future callback')
+
+
+class ResultStream(object):
+    '''
+    Documents from AsyncDictLiteStore.iterget(), which arrive in batches.
+    Only $prefetch batches are fetched ahead of whoever is reading them,
+    (or all of them, if $prefetch is None).
+
+    Either ask for each batch with next_batch() (which returns a Future of
+    a list of documents, empty at the end), or iterate over it (which waits
+    for each batch in turn).  If you stop before the end, close() it.
+    '''
+
+    def __init__(self, prefetch=2):
+        self._cond = threading.Condition()
+        self._batches = deque()
+        self._waiting = deque()
+        self._prefetch = prefetch
+        self._closed = False
+
+    def _put(self, batch=None, exception=None):
+        '''
+        Called by the worker thread to hand over a batch (or an exception).
+        Waits while there are already enough batches waiting to be read.
+        Returns False if the stream has been closed.
+        '''
+        with self._cond:
+            while self._prefetch is not None and not self._closed and \
+                  len(self._batches) >= self._prefetch:
+                self._cond.wait()
+            if self._closed:
+                return False
+            if not self._waiting:
+                self._batches.append((batch, exception))
+                return True
+            future = self._waiting.popleft()
+
+        future._set(batch, exception) # pylint: disable=protected-access
+        return True
+
+    def next_batch(self):
+        ''' returns a Future of the next list of documents. '''
+        future = Future()
+        with self._cond:
+            if not self._batches:
+                self._waiting.append(future)
+                return future
+            batch, exception = self._batches.popleft()
+            self._cond.notify()
+
+        future._set(batch, exception) # pylint: disable=protected-access
+        return future
+
+    def close(self):
+        ''' stop fetching documents. '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def __iter__(self):
+        while True:
+            batch = self.next_batch().result()
+            if not batch:
+                return
+            for document in batch:
+                yield document
+
+
+def _background(name, write):
+    '''
+    make an AsyncDictLiteStore method, which runs DictLiteStore.$name on
+    the writer thread (if $write), or a reader thread, returning a Future.
+    '''
+
+    def method(self, *args, **kwargs):
+        ''' run in the background. '''
+        return self._submit(write, getattr(DictLiteStore, name), args, kwargs) # pylint: disable=protected-access
+
+    method.__name__ = name
+    method.__doc__ = 'Runs DictLiteStore.{0}() in the background, ' \
+                     'and returns a Future of the result.'.format(name)
+    return method
+
+def _run_job(store, job):
+    ''' run a job, return (result, None), or (None, exception). '''
+    _, function, args, kwargs = job
+    try:
+        return function(store, *args, **kwargs), None
+    except Exception as exc: # pylint: disable=broad-except
+        return None, exc
+
+def _delete_count(store, *args):
+    ''' DictLiteStore.delete(), but returning the number of rows deleted. '''
+    return store.delete(*args).rowcount
+
+def _stream(store, stream, batch_size, args, kwargs):
+    ''' feed the results of store.iterget() into a ResultStream. '''
+    try:
+        for batch in _chunks(store.iterget(*args, **kwargs), batch_size):
+            if not stream._put(batch): # pylint: disable=protected-access
+                return
+        stream._put([]) # pylint: disable=protected-access
+    except Exception as exc: # pylint: disable=broad-except
+        stream._put(exception=exc) # pylint: disable=protected-access
+
+
+class AsyncDictLiteStore(object):
+    '''
+    A DictLiteStore which runs in the background, so that callers (such
+    as event loops) never wait for the database.  Every method returns
+    a Future.
+
+    SQLite only allows one writer at a time, so all writes are done (in
+    order) by one writer thread, which commits whenever it runs out of
+    work (or after $batch_size writes), and only then finishes their
+    Futures.  Reads are shared out between $readers threads, each with
+    its own connection. (:memory: databases can't be shared between
+    connections, so for them, everything is done by the writer.)
+
+    At most $queue_size calls can be waiting for the writer (or the
+    readers).  After that, calls wait until there's room, so a busy database
+    slows callers down, rather than using up all the memory.
+
+    Any other options are passed on to each DictLiteStore.
+    '''
+
+    def __init__(self, db_name=":memory:", table_name=u"def", readers=2,
+                 queue_size=1000, batch_size=1000, **options):
+        self.db_name = db_name
+        self.table_name = table_name
+        self.options = options
+        self.batch_size = batch_size
+        self.readers = 0 if db_name in (':memory:', '') else readers
+
+        self._writes = Queue.Queue(queue_size)
+        self._reads = Queue.Queue(queue_size) if self.readers else self._writes
+        self._threads = []
+
+    def open(self):
+        ''' start the writer and reader threads. '''
+        self._start(self._writer)
+        for _ in range(self.readers):
+            self._start(self._reader)
+
+    def close(self):
+        ''' finish everything waiting to be done, and stop the threads. '''
+        for thread in self._threads:
+            if thread.name.endswith('writer'):
+                self._writes.put(None)
+            else:
+                self._reads.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exptype, expvalue, exptb):
+        self.close()
+
+    def _start(self, target):
+        ''' start a thread, and wait for it to open its DictLiteStore. '''
+        ready = Future()
+        thread = threading.Thread(target=target, args=(ready,),
+                                  name='DictLiteStore {0} {1}'.format(
+                                      self.table_name, target.__name__[1:]))
+        thread.daemon = True
+        thread.start()
+        ready.result()
+        self._threads.append(thread)
+
+    def _open_store(self, ready):
+        ''' open a DictLiteStore for this thread, and report back. '''
+        store = DictLiteStore(self.db_name, self.table_name, **self.options)
+        try:
+            store.open()
+        except Exception as exc: # pylint: disable=broad-except
+            ready._set(exception=exc) # pylint: disable=protected-access
+            return None
+        ready._set() # pylint: disable=protected-access
+        return store
+
+    def _submit(self, write, function, args, kwargs):
+        ''' queue up function(store, *args, **kwargs), return its Future. '''
+        future = Future()
+        (self._writes if write else self._reads).put(
+            (future, function, args, kwargs))
+        return future
+
+    def _writer(self, ready):
+        '''
+        The writer thread.  Runs jobs in batches, committing at the end
+        of each batch, before telling anyone they're done.
+        '''
+        store = self._open_store(ready)
+        if store is None:
+            return
+
+        stopping = False
+        while not stopping:
+            batch = [self._writes.get()]
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except Queue.Empty:
+                    break
+
+            if batch[-1] is None:
+                stopping = True
+                batch.pop()
+
+            results = [_run_job(store, job) for job in batch]
+
+            try:
+                store.db.commit()
+            except Exception as exc: # pylint: disable=broad-except
+                results = [(None, exc)] * len(batch)
+
+            for job, (result, exception) in zip(batch, results):
+                job[0]._set(result, exception) # pylint: disable=protected-access
+
+        store.close()
+
+    def _reader(self, ready):
+        ''' A reader thread.  Runs one job at a time. '''
+        store = self._open_store(ready)
+        if store is None:
+            return
+
+        for job in iter(self._reads.get, None):
+            job[0]._set(*_run_job(store, job)) # pylint: disable=protected-access
+
+        store.close()
+
+    store = _background('store', True)
+    store_many = _background('store_many', True)
+    update = _background('update', True)
+    update_by_id = _background('update_by_id', True)
+    update_many = _background('update_many', True)
+    upsert_many = _background('upsert_many', True)
+    delete_by_id = _background('delete_by_id', True)
+    truncate_changes = _background('truncate_changes', True)
+    stats = _background('stats', True)
+    compact = _background('compact', True)
+    create_index = _background('create_index', True)
+    drop_index = _background('drop_index', True)
+
+    get = _background('get', False)
+    get_page = _background('get_page', False)
+    count = _background('count', False)
+    exists = _background('exists', False)
+    aggregate = _background('aggregate', False)
+    get_by_id = _background('get_by_id', False)
+    get_many_by_ids = _background('get_many_by_ids', False)
+    search = _background('search', False)
+
+    def delete(self, *args):
+        '''
+        Runs DictLiteStore.delete() in the background, and returns a Future
+        of the number of rows deleted.
+        '''
+        return self._submit(True, _delete_count, args, {})
+
+    def iterget(self, *args, **kwargs):
+        '''
+        Like DictLiteStore.iterget(), but returns a ResultStream, which
+        the documents arrive in, in batches of $batch_size (default 100).
+        '''
+        batch_size = kwargs.pop('batch_size', 100)
+        # (without readers, the writer does the reading, so it mustn't wait
+        #  for the caller, who could be waiting for a write...)
+        stream = ResultStream(2 if self.readers else None)
+        self._submit(False, _stream, (stream, batch_size, args, kwargs), {})
+        return stream
+
+
+################################################################################
+# Sharding documents across several database files:
+
+def _sql_order(value):
+    '''
+    a python sort key for a stored value, which sorts the same way SQLite
+    does: NULL, then numbers, then text (byte by byte), then BLOBs.
+    '''
+
+    if value is None:
+        return (0, 0)
+    elif isinstance(value, (int, long, float)):
+        return (1, value)
+    elif isinstance(value, unicode):
+        return (2, value.encode('utf-8'))
+    elif isinstance(value, str):
+        return (2, value)
+    return (3, bytes(value))
+
+class _Descending(object): # pylint: disable=too-few-public-methods
+    ''' a sort key, which sorts backwards. '''
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+_MISSING = object() #pylint: disable=invalid-name
+
+def _lookup(document, key):
+    '''
+    the value of $key in a document, (or in json storage, the 'a.b.0'
+    path, for whole documents), or _MISSING.
+    '''
+
+    if key in document:
+        return document[key]
+
+    value = document
+    for part in unicode(key).split(u'.'):
+        try:
+            value = value[int(part) if isinstance(value, list) else part]
+        except (KeyError, IndexError, TypeError, ValueError):
+            return _MISSING
+    return value
+
+
+class ShardedDictLiteStore(object):
+    '''
+    Documents split up between several database files (shards), by the value
+    of one key, so that writes to different shards don't wait for each
+    other, and can use more than one disk.  Each shard is an
+    AsyncDictLiteStore, so everything sent to several shards (get(),
+    store_many(), ...) runs on all of them at once.
+
+    By default, documents go to a shard picked by a hash of their $key,
+    or if ranges is a (sorted) list of len(db_names) - 1 boundaries, to
+    the first shard whose boundary is bigger than their $key:
+
+    >>> with ShardedDictLiteStore(['a.db', 'b.db'], key='user') as bucket:
+    ...     bucket.store({'user': 'dan', 'title': 'Hello'})
+    ...     bucket.get(('title', 'LIKE', NoJSON('H%')), order='title')
+
+    Where clauses which say which $key they want, (('user', '==', 'dan')
+    or ('user', 'IN', [...])) only go to those shards.  Results from several
+    shards are merged in order, (Ids are only unique within a shard, so
+    ordering by Id just puts them shard after shard).
+
+    Any other options are passed on to each AsyncDictLiteStore.
+    '''
+
+    def __init__(self, db_names, table_name=u"def", key=None, ranges=None,
+                 readers=1, **options):
+        if key is None:
+            raise ValueError('ShardedDictLiteStore needs a key to shard by')
+        if ranges is not None and len(ranges) != len(db_names) - 1:
+            raise ValueError('There should be one less range than shards.')
+
+        self.key = key
+        self.ranges = ranges
+        self.shards = [AsyncDictLiteStore(db_name, table_name,
+                                          readers=readers, **options)
+                       for db_name in db_names]
+        self._sort_value = None
+
+    def open(self):
+        ''' open every shard. '''
+        for shard in self.shards:
+            shard.open()
+
+        # How values are stored, to sort them like SQLite does:
+        codec, storage = self.shards[0]._submit( # pylint: disable=protected-access
+            False, lambda store: (store.codec, store.storage), (), {}).result()
+        self._sort_value = _sql_value if storage == u'json' else codec.encode
+
+    def close(self):
+        ''' close every shard. '''
+        for shard in self.shards:
+            shard.close()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exptype, expvalue, exptb):
+        self.close()
+
+    def shard_for(self, value):
+        ''' the number of the shard which documents with $key = value go in. '''
+        if self.ranges is not None:
+            return bisect(self.ranges, value)
+        return (zlib.crc32(json.dumps(value, sort_keys=True, default=unicode))
+                & 0xffffffff) % len(self.shards)
+
+    def _shards_for(self, args):
+        ''' the numbers of the shards a where clause could match in. '''
+
+        for clause in args:
+            if isinstance(clause, (And, Query)) or len(clause) != 3:
+                continue
+            col, operator, value = clause
+            if col != self.key or isinstance(value, NoJSON):
+                continue
+            if operator in (u'==', u'='):
+                return [self.shard_for(value)]
+            elif operator == u'IN' and hasattr(value, '__iter__'):
+                return sorted(set(self.shard_for(v) for v in value))
+
+        return range(len(self.shards))
+
+    def _all(self, shards, method, *args, **kwargs):
+        ''' run a method on some shards (at once), return their results. '''
+        futures = [getattr(self.shards[number], method)(*args, **kwargs)
+                   for number in shards]
+        return [future.result() for future in futures]
+
+    def store(self, document):
+        '''
+        Store a document, in the shard for its $key.
+        Returns (shard number, Id in that shard).
+        '''
+        number = self.shard_for(document.get(self.key))
+        return number, self.shards[number].store(document).result()
+
+    def store_many(self, documents, chunk_size=10000):
+        '''
+        Store lots of documents, each in the shard for its $key, with all the
+        shards writing at once, $chunk_size documents at a time.
+        Returns the number of documents stored.
+        '''
+
+        count = 0
+        for chunk in _chunks(documents, chunk_size):
+            shards = {}
+            for document in chunk:
+                shards.setdefault(self.shard_for(document.get(self.key)),
+                                  []).append(document)
+            futures = [self.shards[number].store_many(part)
+                       for number, part in shards.items()]
+            count += sum(future.result() for future in futures)
+        return count
+
+    def update(self, document, insert=True, *args):
+        '''
+        Update documents matching the where clause, (in every shard, unless
+        it says which $key).  If $insert, and nothing is updated, the document
+        is stored instead.  Documents can't be moved between shards, so
+        $key can only be in the document if the where clause pins it to
+        the same shard.  Returns the number of rows changed.
+        '''
+
+        shards = self._shards_for(args)
+
+        if self.key in document and \
+          list(shards) != [self.shard_for(document[self.key])]:
+            raise ValueError('Updating "{0}" could move documents to another '
+                             'shard'.format(self.key))
+
+        count = sum(self._all(shards, 'update', document, False, *args))
+        if count == 0 and insert:
+            self.store(document)
+            return 1
+        return count
+
+    def delete(self, *args):
+        ''' Delete matching documents. Returns how many were deleted. '''
+        return sum(self._all(self._shards_for(args), 'delete', *args))
+
+    def count(self, *args):
+        ''' How many documents match the where clause, in all the shards? '''
+        return sum(self._all(self._shards_for(args), 'count', *args))
+
+    def exists(self, *args):
+        ''' Is there a matching document in any shard? '''
+        return any(self._all(self._shards_for(args), 'exists', *args))
+
+    def create_index(self, columns, unique=False, name=None):
+        ''' Create an index in every shard. (unique is per shard) '''
+        return self._all(range(len(self.shards)), 'create_index', columns,
+                         unique, name)[0]
+
+    def drop_index(self, name):
+        ''' Drop an index from every shard. '''
+        self._all(range(len(self.shards)), 'drop_index', name)
+
+    def _order(self, order):
+        '''
+        parse order=... (like DictLiteStore does) into [(key, descending)],
+        or [] if there's no order across shards (ordering by Id).
+        '''
+
+        if not order:
+            return []
+        if not hasattr(order, '__iter__'):
+            order = (order,)
+
+        keys = []
+        for item in order:
+            if len(item) == 2 and item[1] in (u'ASC', u'DESC'):
+                keys.append((item[0], item[1] == u'DESC'))
+            else:
+                keys.append((item, False))
+
+        if any(unicode(key).lower() == _ID_COLUMN.lower() for key, _ in keys):
+            return []
+        return keys
+
+    def _merge(self, results, order):
+        '''
+        merge lists (or iterables) of documents from several shards,
+        each already sorted by $order, into one iterable.
+        '''
+
+        if not order:
+            return (document for documents in results for document in documents)
+
+        sort_value = self._sort_value
+
+        def sort_key(document):
+            ''' how SQLite would sort the document. '''
+            key = []
+            for name, descending in order:
+                value = _lookup(document, name)
+                value = _sql_order(None if value is _MISSING else
+                                   sort_value(value))
+                key.append(_Descending(value) if descending else value)
+            return key
+
+        def decorated(number, documents):
+            ''' (sort key, shard, position, document) for each document. '''
+            for position, document in enumerate(documents):
+                yield sort_key(document), number, position, document
+
+        return (item[-1] for item in heapq.merge(
+            *[decorated(n, documents) for n, documents in enumerate(results)]))
+
+    def _fields(self, fields, order):
+        '''
+        the fields to get from each shard, (including the ones to sort by),
+        and the ones to take out again afterwards.
+        '''
+
+        if fields is None:
+            return None, []
+        if isinstance(fields, basestring):
+            fields = [fields]
+        extra = [name for name, _ in order if name not in fields]
+        return list(fields) + extra, extra
+
+    def get(self, *args, **options):
+        '''
+        get() from every shard (that could match) at once, merging the results
+        by $order, and then applying $limit and $offset.
+        '''
+
+        order = self._order(options.get(u'order', u'id'))
+        limit = options.pop(u'limit', None)
+        offset = options.pop(u'offset', None) or 0
+        if limit is not None:
+            options[u'limit'] = limit + offset
+        options[u'fields'], extra = self._fields(options.get(u'fields'), order)
+
+        results = self._all(self._shards_for(args), 'get', *args, **options)
+        documents = list(islice(self._merge(results, order), offset,
+                                None if limit is None else offset + limit))
+
+        for document in documents:
+            for name in extra:
+                document.pop(name, None)
+        return documents
+
+    def iterget(self, *args, **options):
+        '''
+        Like get(), but a generator, which merges the documents from each
+        shard as they arrive.  (Each shard fetches in the background.)
+        '''
+
+        order = self._order(options.get(u'order', u'id'))
+        options[u'fields'], extra = self._fields(options.get(u'fields'), order)
+
+        streams = self._all_streams(self._shards_for(args), args, options)
+        try:
+            for document in self._merge(streams, order):
+                for name in extra:
+                    document.pop(name, None)
+                yield document
+        finally:
+            for stream in streams:
+                stream.close()
+
+    def _all_streams(self, shards, args, options):
+        ''' start iterget() on some shards, returning their ResultStreams. '''
+        return [self.shards[number].iterget(*args, **options)
+                for number in shards]
+
+
+################################################################################
+# python -m dictlitestore:
+
+def main(argv=None):
+    '''
+    Import / export files from the command line:
+
+    python -m dictlitestore import data.db mytable big.jsonl
+    python -m dictlitestore export data.db mytable - --format csv \\
+        --where '["age", ">", 30]' --fields name,age
+    '''
+
+    parser = argparse.ArgumentParser(prog='python -m dictlitestore',
+        description='Import and export DictLiteStore tables.')
+    parser.add_argument('command', choices=['import', 'export'])
+    parser.add_argument('db')
+    parser.add_argument('table')
+    parser.add_argument('file', help='(- for stdin / stdout)')
+    parser.add_argument('--format', choices=['jsonl', 'csv'],
+                        help='(by default, from the file name, or jsonl)')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--skip', type=int, default=0,
+                        help='(import) documents to skip, to carry on an import')
+    parser.add_argument('--offset', type=int, default=0,
+                        help='(export) documents to skip')
+    parser.add_argument('--where', action='append', default=[],
+                        help='(export) a where clause, as JSON: '
+                             '\'["age", ">", 30]\'')
+    parser.add_argument('--fields', help='(export) keys to export: a,b,c')
+    parser.add_argument('--order', help='(export) key to sort by')
+    parser.add_argument('--codec', help='(import) for a new table')
+    parser.add_argument('--storage', choices=STORAGES,
+                        help='(import) for a new table')
+    options = parser.parse_args(argv)
+
+    file_format = options.format or \
+        ('csv' if options.file.lower().endswith('.csv') else 'jsonl')
+
+    with DictLiteStore(options.db, options.table, codec=options.codec,
+                       storage=options.storage) as store:
+        if options.command == 'import':
+            function = import_csv if file_format == 'csv' else import_jsonl
+            count = function(store, options.file, options.chunk_size,
+                             options.skip)
+        else:
+            function = export_csv if file_format == 'csv' else export_jsonl
+            where = [tuple(json.loads(clause)) for clause in options.where]
+            count = function(store, options.file, *where,
+                             fields=options.fields and options.fields.split(','),
+                             order=options.order or u'id',
+                             offset=options.offset or None,
+                             chunk_size=options.chunk_size)
 
+    sys.stderr.write('{0}ed {1} documents.\n'.format(options.command, count))
+    return 0
 
+if __name__ == '__main__':
+    sys.exit(main())
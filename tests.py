@@ -11,7 +11,13 @@ sys.setdefaultencoding('utf-8') # pylint: disable=no-member
 
 import os
 import os.path
-from dictlitestore import DictLiteStore, NoJSON, json_or_raw
+import json
+import time
+from dictlitestore import DictLiteStore, NoJSON, json_or_raw, \
+                          JSONCodec, CODECS, AsyncDictLiteStore, \
+                          migrate_storage, And, Or, Not, Param, \
+                          Instrumentation, Profiler, ShardedDictLiteStore, \
+                          import_jsonl, export_jsonl, import_csv, export_csv
 import unittest
 
 # pylint: disable=missing-docstring, invalid-name, too-many-public-methods
@@ -189,6 +195,329 @@ class TestSort(Basic):
             self.assertEqual([c, b, a], rows)
 
 
+class TestLimitsAndIterget(Basic):
+    def setUp(self):
+        self.s = DictLiteStore()
+        self.s.open()
+        self.rows = [{'n': i, 'odd': bool(i % 2)} for i in range(10)]
+        self.s.store_many(self.rows)
+
+    def tearDown(self):
+        self.s.close()
+
+    def test_limit_offset(self):
+        self.assertEqual(self.s.get(limit=3), self.rows[:3])
+        self.assertEqual(self.s.get(limit=3, offset=2), self.rows[2:5])
+        self.assertEqual(self.s.get(offset=8), self.rows[8:])
+
+    def test_iterget_is_lazy(self):
+        it = self.s.iterget(batch_size=3)
+        self.assertFalse(isinstance(it, list))
+        self.assertEqual(next(it), self.rows[0])
+        self.assertEqual(list(it), self.rows[1:])
+
+    def test_iterget_where_order_limit(self):
+        result = list(self.s.iterget(('odd', '==', True),
+                                     order=[('n', 'DESC')], limit=2))
+        self.assertEqual(result, [self.rows[9], self.rows[7]])
+
+    def test_iterget_with_other_queries(self):
+        result = []
+        for document in self.s.iterget(batch_size=2):
+            # other queries shouldn't disturb the iteration:
+            self.s.get(('n', '==', document['n']))
+            result.append(document)
+        self.assertEqual(result, self.rows)
+
+
+class TestPages(Basic):
+    def documents(self):
+        # (some without 'group' or 'score', to check NULLs sort right)
+        for i in range(53):
+            document = {'n': i}
+            if i % 5:
+                document['group'] = i % 3
+            if i % 7:
+                document['score'] = (i * 17) % 10 * 0.5
+            yield document
+
+    def all_pages(self, s, *args, **options):
+        documents, cursor = s.get_page(*args, **options)
+        pages = [documents]
+        while cursor is not None:
+            documents, cursor = s.get_page(*args, after=cursor, **options)
+            pages.append(documents)
+        return pages
+
+    def check_orders(self, s):
+        for order in ('id', 'n', [('n', 'DESC')], ['group', ('score', 'DESC')],
+                      [('group', 'DESC'), 'score'], [('score', 'DESC')],
+                      ['missing']):
+            pages = self.all_pages(s, order=order, size=6)
+            self.assertEqual([len(page) for page in pages],
+                             [6] * 8 + [5])
+            self.assertEqual([d for page in pages for d in page],
+                             s.get(order=order + [u'Id']
+                                   if isinstance(order, list) else order))
+
+        # with a where clause (with ORs):
+        pages = self.all_pages(s, Or(('group', '==', 1), ('n', '<', 5)),
+                               order=[('score', 'DESC')], size=4)
+        self.assertEqual([d for page in pages for d in page],
+                         s.get(Or(('group', '==', 1), ('n', '<', 5)),
+                               order=[('score', 'DESC'), 'Id']))
+
+    def test_pages(self):
+        with DictLiteStore(codec='native') as s:
+            for document in self.documents():
+                s.store(document)
+            self.check_orders(s)
+
+            # the last page has no cursor, even if it's full:
+            documents, cursor = s.get_page(('n', '<', 10), order='n', size=10)
+            self.assertEqual(len(documents), 10)
+            self.assertEqual(cursor, None)
+
+    def test_json_storage(self):
+        with DictLiteStore(codec='json', storage='json') as s:
+            for document in self.documents():
+                s.store(document)
+            self.check_orders(s)
+
+    def test_bad_cursors(self):
+        with DictLiteStore() as s:
+            s.store_many([{'n': i} for i in range(5)])
+            _, cursor = s.get_page(order='n', size=2, fields=['n'])
+            with self.assertRaises(ValueError):
+                s.get_page(order=[('n', 'DESC')], after=cursor)
+            with self.assertRaises(ValueError):
+                s.get_page(order='n', after='not a cursor')
+            with self.assertRaises(ValueError):
+                s.get_page(order='n', size=0)
+            self.assertEqual(len(s.get_page(order='n', after=cursor)[0]), 3)
+
+
+class TestProjection(Basic):
+    def test_fields(self):
+        with DictLiteStore() as s:
+            s.store({'a': 1, 'b': [2], 'c': 3})
+            s.store({'a': 4, 'd': 5})
+
+            self.assertEqual(s.get(fields=['a', 'b']),
+                             [{'a': 1, 'b': [2]}, {'a': 4}])
+            self.assertEqual(list(s.iterget(('a', '==', 4), fields='d')),
+                             [{'d': 5}])
+            # keys nobody has are just left out:
+            self.assertEqual(s.get(fields=['nope', 'c']), [{'c': 3}, {}])
+
+    def test_silly_fields(self):
+        for x in SILLY_COLUMN_NAMES:
+            with DictLiteStore() as s:
+                s.store({x: 'data', 'other': 'thing'})
+                self.assertEqual(s.get(fields=[x]), [{x: 'data'}])
+
+    def test_count_exists(self):
+        with DictLiteStore() as s:
+            self.assertEqual(s.count(), 0)
+            self.assertFalse(s.exists())
+
+            s.store_many([ROW1, ROW1, ROW2])
+            self.assertEqual(s.count(), 3)
+            self.assertEqual(s.count(GOODWHERE), 2)
+            self.assertEqual(s.count(BADWHERE), 0)
+            self.assertTrue(s.exists(GOODWHERE))
+            self.assertFalse(s.exists(BADWHERE))
+
+
+class TestIndexes(Basic):
+    def query_plan(self, s, *where):
+        sql, values = s._make_select(where, {})
+        return ' '.join(str(row[-1]) for row in
+                        s.cur.execute('EXPLAIN QUERY PLAN ' + sql, values))
+
+    def test_create_list_drop(self):
+        with DictLiteStore() as s:
+            s.store(ROW1)
+            name = s.create_index('col1')
+            s.create_index(['col2', 'new'], unique=True, name='both')
+
+            self.assertEqual(sorted(s.list_indexes()), sorted([
+                {'name': name, 'columns': ['col1'], 'unique': False},
+                {'name': 'both', 'columns': ['col2', 'new'], 'unique': True}]))
+
+            s.drop_index(['col1'])
+            s.drop_index('both')
+            self.assertEqual(s.list_indexes(), [])
+
+    def test_where_uses_index(self):
+        with DictLiteStore() as s:
+            s.store(ROW1)
+            self.assertIn('SCAN', self.query_plan(s, GOODWHERE))
+
+            s.create_index('col1')
+            self.assertIn('USING INDEX', self.query_plan(s, GOODWHERE))
+            self.assertEqual(s.get(GOODWHERE), [ROW1])
+
+    def test_unique_index(self):
+        import sqlite3
+        with DictLiteStore() as s:
+            s.create_index('col1', unique=True)
+            s.store(ROW1)
+            with self.assertRaises(sqlite3.IntegrityError):
+                s.store(ROW1)
+
+    def test_auto_index(self):
+        with DictLiteStore(auto_index=3) as s:
+            s.store(ROW1)
+            s.get(GOODWHERE)
+            s.get(GOODWHERE)
+            self.assertEqual(s.list_indexes(), [])
+            s.get(GOODWHERE)
+            self.assertEqual([i['columns'] for i in s.list_indexes()],
+                             [['col1']])
+
+    def test_silly_names(self):
+        for x in SILLY_COLUMN_NAMES:
+            with DictLiteStore() as s:
+                s.store({x: 'data'})
+                s.create_index(x)
+                self.assertEqual(s.get((x, '==', 'data')), [{x: 'data'}])
+
+
+class TestById(Basic):
+    def test_store_returns_id(self):
+        with DictLiteStore() as s:
+            self.assertEqual(s.store(ROW1), 1)
+            self.assertEqual(s.store(ROW2), 2)
+
+            self.assertEqual(s.get_by_id(2), ROW2)
+            self.assertEqual(s.get_by_id(1), ROW1)
+            self.assertEqual(s.get_by_id(3), None)
+
+    def test_get_many_by_ids(self):
+        with DictLiteStore() as s:
+            ids = [s.store({'n': i}) for i in range(1200)]
+
+            found = s.get_many_by_ids(ids[::2] + [9999])
+            self.assertEqual(len(found), 600)
+            self.assertEqual(found[ids[10]], {'n': 10})
+
+    def test_update_and_delete_by_id(self):
+        with DictLiteStore() as s:
+            a = s.store(ROW1)
+            b = s.store(ROW1)
+
+            self.assertEqual(s.update_by_id(b, UPDATE1), 1)
+            self.assertEqual(s.get_by_id(a), ROW1)
+            self.assertEqual(s.get_by_id(b), copy_change(ROW1, UPDATE1))
+
+            self.assertEqual(s.update_by_id(42, UPDATE1), 0)
+            self.assertEqual(s.get_by_id(42), None)
+            s.update_by_id(42, UPDATE1, insert=True)
+            self.assertEqual(s.get_by_id(42), UPDATE1)
+
+            self.assertEqual(s.delete_by_id(a), 1)
+            self.assertEqual(s.delete_by_id(a), 0)
+            self.assertEqual(s.get(), [copy_change(ROW1, UPDATE1), UPDATE1])
+
+    def test_order_by_id(self):
+        with DictLiteStore() as s:
+            s.store(ROW1)
+            s.store(ROW2)
+            self.assertEqual(s.get(order=[('id', 'DESC')]), [ROW2, ROW1])
+
+
+class TestStatsAndCompact(Basic):
+    def fill(self, s):
+        s.store_many([{'n': i, 'group': i % 4, 'big': u'x' * 100}
+                      for i in range(100)])
+        s.store_many([{'n': i, 'gone': i, 'also_gone': [i]}
+                      for i in range(100, 110)])
+
+    def test_stats(self):
+        with DictLiteStore(codec='native') as s:
+            self.fill(s)
+            report = s.stats()
+            self.assertEqual(report['rows'], 110)
+            self.assertEqual(report['dead'], [])
+
+            columns = dict((c['name'], c) for c in report['columns'])
+            self.assertEqual(report['columns'][0]['name'], 'big')
+            self.assertEqual(columns['n']['non_null'], 110)
+            self.assertEqual(columns['n']['distinct'], 110)
+            self.assertEqual(columns['group']['distinct'], 4)
+            self.assertEqual(columns['big']['bytes'], 100 * 100)
+            self.assertEqual(columns['gone']['last_id'], 110)
+            first_seen = columns['n']['last_seen']
+            self.assertTrue(first_seen)
+
+            # (estimated from a sample:)
+            sampled = dict((c['name'], c)
+                           for c in s.stats(sample=60)['columns'])
+            self.assertEqual(sampled['group']['distinct'], 4)
+            self.assertEqual(sampled['n']['distinct'], 110)
+
+            s.delete(('n', '>=', 100))
+            report = s.stats()
+            self.assertEqual(sorted(report['dead']), ['also_gone', 'gone'])
+            columns = dict((c['name'], c) for c in report['columns'])
+            # nothing new had 'group', so it wasn't seen again:
+            self.assertEqual(columns['group']['last_seen'], first_seen)
+
+    def test_compact(self):
+        try:
+            with DictLiteStore('__test.db', codec='native') as s:
+                self.fill(s)
+                s.create_index('gone')
+                s.create_index('group')
+                s.stats()
+                s.delete(('n', '>=', 100))
+
+                result = s.compact()
+                self.assertEqual(result['dropped'], ['also_gone', 'gone'])
+                self.assertEqual(s.sql_columns, set(['n', 'group', 'big']))
+                self.assertEqual([i['columns'] for i in s.list_indexes()],
+                                 [['group']])
+                self.assertEqual(s.count(), 100)
+                self.assertEqual(s.get(('n', '==', 5)),
+                                 [{'n': 5, 'group': 1, 'big': u'x' * 100}])
+
+                # the catalog forgets them too:
+                self.assertEqual(json.loads(s._get_meta(u'stats'))['dead'], [])
+                # and new documents can have those keys again:
+                s.store({'gone': 1})
+                self.assertEqual(s.count(('gone', '==', 1)), 1)
+
+                self.assertEqual(s.compact()['dropped'], [])
+        finally:
+            os.remove('__test.db')
+
+    def test_column_named_like_table(self):
+        try:
+            with DictLiteStore('__test.db', 'def') as s:
+                s.enable_changelog()
+                s.store({'title': u'a', 'def': 1})
+                s.create_index('title')
+                s.delete(('def', '==', 1))
+                s.store({'title': u'b'})
+
+                self.assertEqual(s.compact()['dropped'], ['def'])
+                self.assertEqual([i['columns'] for i in s.list_indexes()],
+                                 [['title']])
+                s.store({'title': u'c'})
+                self.assertEqual(s.last_change(), 4)
+        finally:
+            os.remove('__test.db')
+
+    def test_json_storage(self):
+        with DictLiteStore(storage='json') as s:
+            self.fill(s)
+            columns = dict((c['name'], c) for c in s.stats()['columns'])
+            self.assertEqual(columns['gone']['non_null'], 10)
+            self.assertEqual(columns['group']['distinct'], 4)
+            self.assertEqual(s.compact()['dropped'], [])
+
+
 class TestDelete(Basic):
     def test_basic_delete(self):
         with DictLiteStore() as s:
@@ -218,8 +547,164 @@ class TestDelete(Basic):
 
             self.assertEqual(len(rows), 0)
 
+class TestStoreMany(Basic):
+    def test_store_many_same_columns(self):
+        with DictLiteStore() as s:
+            self.assertEqual(s.store_many([ROW1, ROW1, ROW1]), 3)
+            self.assertEqual(s.get(), [ROW1, ROW1, ROW1])
+
+    def test_store_many_different_columns(self):
+        with DictLiteStore() as s:
+            s.store_many([ROW1, ROW2, ROW1])
+
+            rows = s.get()
+            self.assertEqual(len(rows), 3)
+            self.assertEqual(rows.count(ROW1), 2)
+            self.assertEqual(rows.count(ROW2), 1)
+
+    def test_store_many_chunked_generator(self):
+        with DictLiteStore() as s:
+            docs = ({'n': i, 'col%d' % (i % 7): 'x'} for i in range(50))
+            self.assertEqual(s.store_many(docs, chunk_size=8), 50)
+
+            rows = s.get()
+            self.assertEqual(sorted(r['n'] for r in rows), range(50))
+            self.assertEqual(s.get(('n', '==', 10)), [{'n': 10, 'col3': 'x'}])
+
+    def test_store_many_empty(self):
+        with DictLiteStore() as s:
+            self.assertEqual(s.store_many([]), 0)
+            self.assertEqual(s.get(), [])
+
 # And the update tests:
 
+class TestParallelIngest(Basic):
+    def test_ingest(self):
+        documents = [{'n': i, 'text': u'Ζ %d' % i, 'list': [i]}
+                     for i in range(250)]
+        progress = []
+
+        with DictLiteStore() as s:
+            stats = s.parallel_ingest(iter(documents), workers=3, chunk_size=20,
+                                      progress=progress.append)
+            self.assertEqual(stats['documents'], 250)
+            self.assertEqual(stats['chunks'], 13)
+            self.assertEqual([p['documents'] for p in progress][:3],
+                             [20, 40, 60])
+
+            # in the same order they were given:
+            self.assertEqual(s.get(order='Id'), documents)
+
+    def test_blobs(self):
+        documents = [{'n': i, 'meta': {'i': i}} for i in range(10)]
+        with DictLiteStore(codec='native') as s:
+            s.parallel_ingest(documents, workers=2, chunk_size=3)
+            self.assertEqual(s.get(order='Id'), documents)
+
+    def test_errors(self):
+        def documents():
+            yield {'n': 1}
+            raise IOError('disk fell off')
+
+        with DictLiteStore() as s:
+            with self.assertRaises(IOError):
+                s.parallel_ingest(documents(), workers=2, chunk_size=1)
+            # (nothing was stored:)
+            self.assertEqual(s.count(), 0)
+
+
+class TestImportExport(Basic):
+    documents = [{'n': i, 'name': u'Ζαχαρίας %d' % i, 'tags': [u'a', i],
+                  'text': u'%d' % i, 'empty': u''} for i in range(25)]
+
+    def test_jsonl(self):
+        from StringIO import StringIO
+
+        with DictLiteStore(codec='native') as s:
+            for document in self.documents:
+                s.store(document)
+
+            output = StringIO()
+            self.assertEqual(export_jsonl(s, output, chunk_size=7), 25)
+            lines = output.getvalue().splitlines()
+            self.assertEqual(len(lines), 25)
+            self.assertIn(u'Ζαχαρίας 0'.encode('utf-8'), lines[0])
+
+            # only some of it:
+            output = StringIO()
+            self.assertEqual(export_jsonl(s, output, ('n', '>=', 20),
+                                          fields=['n'], offset=2), 3)
+            self.assertEqual(output.getvalue(),
+                             '{"n": 22}\n{"n": 23}\n{"n": 24}\n')
+
+        with DictLiteStore(codec='native') as s:
+            source = StringIO('\n'.join(lines[:10]) + '\n\n')
+            self.assertEqual(import_jsonl(s, source, chunk_size=3), 10)
+            # carry on where it stopped:
+            source = StringIO('\n'.join(lines))
+            self.assertEqual(import_jsonl(s, source, chunk_size=3, skip=10), 15)
+            self.assertEqual(s.get(order='n'), self.documents)
+
+    def test_csv(self):
+        from StringIO import StringIO
+
+        with DictLiteStore() as s:
+            for document in self.documents:
+                s.store(document)
+            s.store({'n': 99})
+
+            output = StringIO()
+            self.assertEqual(export_csv(s, output), 26)
+            lines = output.getvalue().splitlines()
+            keys = lines[0].split(',')
+            self.assertEqual(keys, ['empty', 'n', 'name', 'tags', 'text'])
+            self.assertIn('"[""a"", 0]"', lines[1])     # JSON
+            self.assertIn('Ζαχαρίας 0', lines[1])       # text
+            self.assertIn('"""0"""', lines[1])          # text, which looks like JSON
+            self.assertIn('""""""', lines[1])           # ''
+            self.assertEqual(lines[-1].count(','), 4)
+
+        with DictLiteStore(codec='native') as s:
+            self.assertEqual(import_csv(s, StringIO(output.getvalue())), 26)
+            self.assertEqual(s.get(order='n'), self.documents + [{'n': 99}])
+
+            self.assertEqual(import_csv(s, StringIO('a,b\nhello,\n'
+                                                    '"1,2",true\n')), 2)
+            self.assertEqual(s.get(('n', 'IS NULL'), order='a'),
+                             [{'a': u'1,2', 'b': True}, {'a': u'hello'}])
+
+    def test_csv_none(self):
+        from StringIO import StringIO
+
+        with DictLiteStore(storage='json') as s:
+            s.store({'a': None, 'b': 1})
+            s.store({'b': 2})
+            output = StringIO()
+            export_csv(s, output)
+            self.assertEqual(output.getvalue().splitlines()[1:],
+                             ['null,1', ',2'])
+            self.assertEqual(import_csv(s, StringIO(output.getvalue())), 2)
+            self.assertEqual(s.get(('id', '>', 2)),
+                             [{'a': None, 'b': 1}, {'b': 2}])
+
+    def test_command_line(self):
+        from dictlitestore import main
+        try:
+            with DictLiteStore('__test.db', codec='native') as s:
+                s.store_many(self.documents)
+            self.assertEqual(main(['export', '__test.db', 'def', '__test.csv',
+                                   '--where', '["n", "<", 5]',
+                                   '--fields', 'n,name']), 0)
+            self.assertEqual(len(open('__test.csv').readlines()), 6)
+            main(['import', '__test.db', 'other', '__test.csv'])
+            with DictLiteStore('__test.db', 'other') as s:
+                self.assertEqual(s.count(), 5)
+        finally:
+            for name in ('__test.db', '__test.csv'):
+                if os.path.exists(name):
+                    os.remove(name)
+
+
 class TestUpdates(Basic):
     def test_multiple_rows_same_columns(self):
         with DictLiteStore() as s:
@@ -364,7 +849,1106 @@ class TestUpdates(Basic):
 
 
 
+class ReprCodec(JSONCodec):
+    ''' a silly codec, for testing. '''
+    name = 'repr'
+
+    @staticmethod
+    def encode(value):
+        return repr(value)
+
+    @staticmethod
+    def decode(text):
+        return eval(text) # pylint: disable=eval-used
+
+CODECS[ReprCodec.name] = ReprCodec()
+
+class TestCodecs(Basic):
+    def test_json_fast_paths(self):
+        import json
+        codec = JSONCodec()
+        for value in (u'text', u'πραγμα', u'a"b', u'a\\b', u'\n', 42,
+                      10 ** 20, -1, 3.5, True, None, ['a', 1], {'a': u'é'}):
+            encoded = codec.encode(value)
+            self.assertEqual(encoded, json.dumps(value, ensure_ascii=False))
+            self.assertEqual(codec.decode(encoded.encode('utf-8')), value)
+
+    def test_unicode_where(self):
+        with DictLiteStore() as s:
+            s.store({'col1': u'πραγμα'})
+            self.assertEqual(s.get(('col1', '==', u'πραγμα')),
+                             [{'col1': u'πραγμα'}])
+
+    def test_custom_codec(self):
+        with DictLiteStore(codec='repr') as s:
+            s.store(ROW1)
+            self.assertEqual(s.get(GOODWHERE), [ROW1])
+            self.assertEqual(s.cur.execute('SELECT col1 FROM def').fetchone()[0],
+                             "'data1'")
+
+    def test_codec_remembered(self):
+        try:
+            with DictLiteStore('__test.db', codec=ReprCodec()) as s:
+                s.store(ROW1)
+
+            with DictLiteStore('__test.db') as s:
+                self.assertEqual(s.codec.name, 'repr')
+                self.assertEqual(s.get(), [ROW1])
+
+            with self.assertRaises(ValueError):
+                with DictLiteStore('__test.db', codec='json') as s:
+                    pass
+        finally:
+            os.remove('__test.db')
+
+    def test_no_codec_change_for_old_data(self):
+        try:
+            with DictLiteStore('__test.db') as s:
+                s.store(ROW1)
+                s.cur.execute('DELETE FROM _dictlitestore_meta')
+
+            with self.assertRaises(ValueError):
+                with DictLiteStore('__test.db', codec='repr') as s:
+                    pass
+        finally:
+            os.remove('__test.db')
+
+    def test_native(self):
+        with DictLiteStore(codec='native') as s:
+            a = {'price': 9, 'name': u'πραγμα', 'ok': True, 'none': None}
+            b = {'price': 10.5, 'list': [1, {'x': 2}], 'big': 10 ** 30}
+            c = {'price': 100, 'name': u'a"b', 'ok': False}
+            for document in (a, b, c):
+                s.store(document)
+
+            self.assertEqual(s.get(), [a, b, c])
+            self.assertEqual(s.get(('price', '>', 9.5)), [b, c])
+            self.assertEqual(s.get(order=[('price', 'DESC')], fields='price'),
+                             [{'price': 100}, {'price': 10.5}, {'price': 9}])
+            self.assertEqual(s.get(('ok', '==', False)), [c])
+            self.assertEqual(s.get(('name', 'LIKE', u'%γμ%')), [a])
+            self.assertEqual(tuple(s.cur.execute(
+                'SELECT typeof(price), typeof(name), typeof(ok) FROM def'
+                ).fetchone()), ('integer', 'text', 'blob'))
+
+            s.create_index('price')
+            plan = ' '.join(str(r[-1]) for r in s.cur.execute(
+                'EXPLAIN QUERY PLAN SELECT * FROM def WHERE price > 10'))
+            self.assertIn('def__price', plan)
+
+    @unittest.skipUnless('msgpack' in CODECS, 'needs msgpack')
+    def test_msgpack(self):
+        with DictLiteStore(codec='msgpack') as s:
+            a = {'col1': u'πραγμα', 'col2': [1, 2.5, {'x': None}]}
+            s.store(a)
+            self.assertEqual(s.get(('col1', '==', u'πραγμα')), [a])
+
+
+class TestQueries(Basic):
+    DOCS = [{'n': 1, 'tag': 'a'}, {'n': 2, 'tag': 'b'}, {'n': 3},
+            {'n': 4, 'tag': 'a'}]
+
+    def check(self, s):
+        for document in self.DOCS:
+            s.store(document)
+
+        def ns(*args):
+            return [d['n'] for d in s.get(*args)]
+
+        self.assertEqual(ns(Or(('n', '==', 1), ('n', '==', 3))), [1, 3])
+        self.assertEqual(ns(Not(('tag', '==', 'a'))), [2])
+        self.assertEqual(ns(Or(And(('tag', '==', 'a'), ('n', '>', 1)),
+                               ('tag', '==', 'b'))), [2, 4])
+        self.assertEqual(ns(('n', 'IN', [1, 4, 5])), [1, 4])
+        self.assertEqual(ns(('n', 'NOT IN', (1, 4))), [2, 3])
+        self.assertEqual(ns(('n', 'IN', [])), [])
+        self.assertEqual(ns(('n', 'BETWEEN', (2, 3))), [2, 3])
+        self.assertEqual(ns(('tag', 'IS NULL')), [3])
+        self.assertEqual(ns(('tag', 'IS NOT NULL', None), ('n', '<', 4)), [1, 2])
+        self.assertEqual(ns(Or()), [])
+        self.assertEqual(ns(Not()), [])
+        self.assertEqual(ns(Not(Or())), [1, 2, 3, 4])
+        self.assertEqual(s.count(Not()), 0)
+        self.assertEqual(s.count(Or(('n', '==', 1), ('tag', '==', 'b'))), 2)
+
+        with self.assertRaises(KeyError):
+            s.get(Or(('n', 'LOOKS LIKE', 1)))
+
+    def test_columns(self):
+        with DictLiteStore() as s:
+            self.check(s)
+
+    def test_json_storage(self):
+        with DictLiteStore(storage='json') as s:
+            self.check(s)
+
+    def test_compiled(self):
+        with DictLiteStore() as s:
+            for document in self.DOCS:
+                s.store(document)
+
+            query = s.compile(('tag', '==', Param('tag')),
+                              ('n', 'IN', Param('ns')))
+            self.assertEqual(s.get(query.bind(tag='a', ns=[1, 2, 3])),
+                             [self.DOCS[0]])
+            self.assertEqual(s.count(query.bind(tag='a', ns=[1, 4])), 2)
+            self.assertEqual(s.get(query.bind(tag='b', ns=[2, 3]),
+                                   fields='n'), [{'n': 2}])
+            # one SQL string for each length of list given:
+            self.assertEqual(len(query._sql), 2)
+            s.delete(query.bind(tag='a', ns=[4]))
+            self.assertEqual(s.count(), 3)
+
+
+class TestAggregate(Basic):
+    DOCS = [{'author': 'dan', 'views': 9, 'price': 1.5},
+            {'author': 'dan', 'views': 10},
+            {'author': u'Ζαχαρίας', 'views': 100, 'price': 2.5},
+            {'views': 1, 'tags': ['a']}]
+
+    def check(self, s):
+        for document in self.DOCS:
+            s.store(document)
+
+        self.assertEqual(s.aggregate(), [{'count': 4}])
+        self.assertEqual(
+            s.aggregate(group_by='author', metrics={
+                'n': 'count', 'views': ('sum', 'views'),
+                'most': ('max', 'views'), 'least': ('min', 'views'),
+                'priced': ('count', 'price'), 'price': ('avg', 'price')}),
+            [{'author': None, 'n': 1, 'views': 1, 'most': 1, 'least': 1,
+              'priced': 0, 'price': None},
+             {'author': 'dan', 'n': 2, 'views': 19, 'most': 10, 'least': 9,
+              'priced': 1, 'price': 1.5},
+             {'author': u'Ζαχαρίας', 'n': 1, 'views': 100, 'most': 100,
+              'least': 100, 'priced': 1, 'price': 2.5}])
+        self.assertEqual(s.aggregate(metrics={'n': ('count_distinct', 'author'),
+                                              't': ('total', 'nothing')},
+                                     where=('views', '!=', 100)),
+                         [{'n': 1, 't': 0.0}])
+        self.assertEqual(s.aggregate(group_by=['tags', 'nothing'],
+                                     where=[('tags', 'IS NOT NULL')]),
+                         [{'tags': ['a'], 'nothing': None, 'count': 1}])
+
+        with self.assertRaises(KeyError):
+            s.aggregate(metrics={'x': ('median', 'views')})
+        with self.assertRaises(ValueError):
+            s.aggregate(metrics={'x': 'sum'})
+
+    def test_json(self):
+        with DictLiteStore() as s:
+            self.check(s)
+
+    def test_native(self):
+        with DictLiteStore(codec='native') as s:
+            self.check(s)
+
+    def test_json_storage(self):
+        with DictLiteStore(storage='json') as s:
+            self.check(s)
+
+
+class TestJSONStorage(Basic):
+    DOC = {'title': u'πραγμα', 'n': 3, 'none': None, 'ok': True,
+           'a': {'b': {'c': 1}}, 'tags': ['x', 'y']}
+
+    def test_one_column(self):
+        with DictLiteStore(storage='json') as s:
+            s.store(self.DOC)
+            s.store_many([ROW1, ROW2])
+            self.assertEqual(s.get(), [self.DOC, ROW1, ROW2])
+            self.assertEqual(s.get_by_id(1), self.DOC)
+            self.assertEqual(s.sql_columns, set(['document']))
+
+    def test_where(self):
+        with DictLiteStore(storage='json') as s:
+            s.store(self.DOC)
+            s.store({'title': 'other', 'n': 10, 'ok': False})
+            self.assertEqual(s.get(('a.b.c', '==', 1)), [self.DOC])
+            self.assertEqual(s.get(('tags.1', '==', 'y')), [self.DOC])
+            self.assertEqual(s.get(('tags', '==', ['x', 'y'])), [self.DOC])
+            self.assertEqual(s.get(('ok', '==', True)), [self.DOC])
+            self.assertEqual(s.get(('n', '>', 5), fields=['title']),
+                             [{'title': 'other'}])
+            self.assertEqual(s.get(('none', 'IS', None), fields=['none', 'x']),
+                             [{'none': None}, {}])
+            self.assertEqual(s.get(('title', 'LIKE', '%ther')), [s.get_by_id(2)])
+            self.assertEqual(s.get(order=[('n', 'DESC')], fields='n'),
+                             [{'n': 10}, {'n': 3}])
+            self.assertEqual(s.count(('n', '<', 100)), 2)
+            s.delete(('n', '==', 3))
+            self.assertEqual(s.count(), 1)
+
+    def test_update(self):
+        with DictLiteStore(storage='json') as s:
+            s.store(self.DOC)
+            s.update({'n': 4, 'new': [1]}, False, ('a.b.c', '==', 1))
+            # dotted keys go into the document, like they do in queries:
+            s.update_by_id(1, {'a.b': None, 'tags.0': 'z'})
+            doc = dict(self.DOC, n=4, new=[1], a={'b': None}, tags=['z', 'y'])
+            self.assertEqual(s.get(), [doc])
+            self.assertEqual(s.get(('a.b', 'IS', None), fields=['a.b']),
+                             [{'a.b': None}])
+            s.update({'title': 'inserted'}, True, ('n', '==', 0))
+            self.assertEqual(s.get(('title', '==', 'inserted')),
+                             [{'title': 'inserted'}])
+
+    def test_dotted_keys_written(self):
+        with DictLiteStore(storage='json') as s:
+            # the same shape, whether it's inserted or updated:
+            s.update({'a.b': 5}, True, ('n', '==', 1))
+            self.assertEqual(s.get(('a.b', '==', 5)), [{'a': {'b': 5}}])
+            s.update({'a.b': 6}, True, ('a.b', '==', 5))
+            self.assertEqual(s.get(), [{'a': {'b': 6}}])
+
+            s.store({'tags.0': 'x', 'p.q.r': [1]})
+            self.assertEqual(s.get_by_id(2),
+                             {'tags': ['x'], 'p': {'q': {'r': [1]}}})
+
+            s.upsert_many([{'id.x': 1, 'v.w': 1}], key='id.x')
+            s.upsert_many([{'id.x': 1, 'v.w': 2}, {'id.x': 2, 'v.w': 3}],
+                          key='id.x')
+            self.assertEqual(s.get(('id.x', '>=', 1), order='id.x'),
+                             [{'id': {'x': 1}, 'v': {'w': 2}},
+                              {'id': {'x': 2}, 'v': {'w': 3}}])
+
+    def test_no_arrow_operator(self):
+        # (-> needs SQLite 3.38, which older pythons don't come with)
+        with DictLiteStore(storage='json') as s:
+            s.store({'a': {'b': [1]}, 'n': None})
+            self.assertNotIn('->', s._make_select_columns(['a.b', 'n']) +
+                             s._group_sql('a') +
+                             s._make_upsert(('a.b', 'k'), ['k']))
+            self.assertEqual(s.get(fields=['a.b', 'n', 'gone']),
+                             [{'a.b': [1], 'n': None}])
+
+    def test_bad_keys(self):
+        with DictLiteStore(storage='json') as s:
+            s.store({'a"b': 1})
+            self.assertEqual(s.get(), [{'a"b': 1}])
+            with self.assertRaises(ValueError):
+                s.get(('a"b', '==', 1))
+
+    def test_indexes(self):
+        with DictLiteStore(storage='json') as s:
+            s.store(self.DOC)
+            s.create_index(['a.b.c', 'title'])
+            self.assertEqual(s.list_indexes(), [{'name': 'def__a.b.c__title',
+                                                 'columns': ['a.b.c', 'title'],
+                                                 'unique': False}])
+            plan = ' '.join(str(r[-1]) for r in s.cur.execute(
+                'EXPLAIN QUERY PLAN ' + s._make_select([('a.b.c', '==', 1)],
+                                                       {})[0], [1]))
+            self.assertIn('def__a.b.c__title', plan)
+
+    def test_storage_remembered(self):
+        try:
+            with DictLiteStore('__test.db', storage='json') as s:
+                s.store(self.DOC)
+            with DictLiteStore('__test.db') as s:
+                self.assertEqual(s.storage, 'json')
+                self.assertEqual(s.get(), [self.DOC])
+            with self.assertRaises(ValueError):
+                with DictLiteStore('__test.db', storage='columns') as s:
+                    pass
+            with self.assertRaises(ValueError):
+                DictLiteStore(storage='xml')
+        finally:
+            os.remove('__test.db')
+
+    def test_migrate(self):
+        try:
+            with DictLiteStore('__test.db') as s:
+                s.store_many([ROW1, ROW2, self.DOC])
+                s.delete_by_id(2)
+                s.create_index('col1', unique=True)
+
+            with self.assertRaises(ValueError):
+                with DictLiteStore('__test.db', storage='json') as s:
+                    pass
+
+            self.assertEqual(migrate_storage('__test.db', storage='json'), 2)
+
+            with DictLiteStore('__test.db') as s:
+                self.assertEqual(s.storage, 'json')
+                self.assertEqual(s.get_many_by_ids([1, 3]),
+                                 {1: ROW1, 3: self.DOC})
+                self.assertEqual(s.list_indexes()[0]['columns'], ['col1'])
+                self.assertTrue(s.list_indexes()[0]['unique'])
+
+            self.assertEqual(migrate_storage('__test.db', storage='columns'), 2)
+
+            with DictLiteStore('__test.db') as s:
+                self.assertEqual(s.storage, 'columns')
+                self.assertEqual(s.get(), [ROW1, self.DOC])
+                self.assertEqual(s.store(ROW2), 4)
+        finally:
+            os.remove('__test.db')
+
+
+class TestUpsert(Basic):
+    def check(self, s):
+        s.store({'sku': 1, 'price': 5, 'name': 'one'})
+        result = s.upsert_many([{'sku': 1, 'price': 6},
+                                {'sku': 2, 'price': 7, 'name': 'two'},
+                                {'sku': 2, 'price': 8},
+                                {'price': 9}], key='sku')
+        self.assertEqual(result, {'inserted': 2, 'updated': 2})
+        self.assertEqual(s.get(), [{'sku': 1, 'price': 6, 'name': 'one'},
+                                   {'sku': 2, 'price': 8, 'name': 'two'},
+                                   {'price': 9}])
+        self.assertTrue(s.list_indexes()[0]['unique'])
+
+        self.assertEqual(s.update_many([{'sku': 1, 'name': 'ONE'},
+                                        {'sku': 3, 'name': 'three'},
+                                        {'name': 'nothing'}], 'sku'), 1)
+        self.assertEqual(s.get(('sku', '==', 1)),
+                         [{'sku': 1, 'price': 6, 'name': 'ONE'}])
+        self.assertEqual(s.count(), 3)
+
+    def test_columns(self):
+        with DictLiteStore() as s:
+            self.check(s)
+
+    def test_json_storage(self):
+        with DictLiteStore(storage='json') as s:
+            self.check(s)
+
+    def test_compound_key(self):
+        with DictLiteStore() as s:
+            s.upsert_many([{'a': 1, 'b': 1, 'v': 1}, {'a': 1, 'b': 2, 'v': 2}],
+                          key=['a', 'b'])
+            self.assertEqual(s.upsert_many([{'a': 1, 'b': 2, 'v': 3}],
+                                           key=['a', 'b']),
+                             {'inserted': 0, 'updated': 1})
+            self.assertEqual(s.get(fields='v'), [{'v': 1}, {'v': 3}])
+            self.assertEqual(len(s.list_indexes()), 1)
+
+    def test_duplicates_rolled_back(self):
+        with DictLiteStore() as s:
+            s.store_many([{'sku': 1}, {'sku': 1}])
+            with self.assertRaises(Exception):
+                s.upsert_many([{'sku': 2}], key='sku')
+            self.assertEqual(s.count(), 2)
+
+
+class TestFulltext(Basic):
+    DOCS = [{'title': u'SQLite from python', 'body': u'fast πραγμα'},
+            {'title': u'Python tricks', 'body': u'sqlite sqlite sqlite'},
+            {'title': u'Other', 'n': 1}]
+
+    def check(self, s):
+        s.store(self.DOCS[0])
+        s.enable_fulltext(['title', 'body'])
+        for document in self.DOCS[1:]:
+            s.store(document)
+
+        self.assertEqual(s.search('sqlite'), self.DOCS[1::-1])
+        self.assertEqual(s.search('sqlite', rank=False), self.DOCS[:2])
+        self.assertEqual(s.search(u'πραγμα OR other', fields='title', limit=1,
+                                  rank=False), [{'title': u'SQLite from python'}])
+        self.assertEqual(s.search('title: sqlite'), self.DOCS[:1])
+
+        s.update({'body': u'gone'}, False, ('title', '==', u'Python tricks'))
+        self.assertEqual(s.search('sqlite'), self.DOCS[:1])
+        self.assertEqual(len(s.search('gone')), 1)
+
+        s.delete_by_id(2)
+        self.assertEqual(s.search('gone'), [])
+
+        s.disable_fulltext()
+        self.assertEqual(s.fulltext_columns(), None)
+        with self.assertRaises(ValueError):
+            s.search('sqlite')
+
+    def test_columns(self):
+        with DictLiteStore() as s:
+            self.check(s)
+
+    def test_json_storage(self):
+        with DictLiteStore(storage='json') as s:
+            self.check(s)
+
+    def test_multiple_lines(self):
+        for storage in ('columns', 'json'):
+            with DictLiteStore(storage=storage) as s:
+                s.store({'body': u'first line\nsecond line'})
+                s.enable_fulltext('body')
+                s.store({'body': u'first\ttabbed'})
+                self.assertEqual(len(s.search('second')), 1)
+                self.assertEqual(len(s.search('tabbed')), 1)
+                self.assertEqual(len(s.search('first')), 2)
+
+    def test_kept_by_migrate(self):
+        try:
+            with DictLiteStore('__test.db') as s:
+                for document in self.DOCS:
+                    s.store(document)
+                s.enable_fulltext('title')
+            migrate_storage('__test.db', storage='json')
+            with DictLiteStore('__test.db') as s:
+                self.assertEqual(s.fulltext_columns(), ['title'])
+                self.assertEqual(s.search('python', rank=False), self.DOCS[:2])
+        finally:
+            os.remove('__test.db')
+
+
+class TestChangelog(Basic):
+    def test_changes(self):
+        with DictLiteStore() as s:
+            s.store({'n': 0})
+            with self.assertRaises(ValueError):
+                list(s.changes())
+
+            s.enable_changelog()
+            self.assertEqual(s.last_change(), 0)
+            self.assertEqual(list(s.changes()), [])
+
+            for i in range(1, 5):
+                s.store({'n': i})
+            s.update({'n': 20}, False, ('n', '==', 2))
+            s.delete(('n', '==', 3))
+            s.delete_by_id(1)   # (from before the changelog)
+
+            changes = list(s.changes(batch_size=2))
+            self.assertEqual([(c['seq'], c['op'], c['id']) for c in changes],
+                             [(1, 'insert', 2), (2, 'insert', 3),
+                              (3, 'insert', 4), (4, 'insert', 5),
+                              (5, 'update', 3), (6, 'delete', 4),
+                              (7, 'delete', 1)])
+            # documents are how they are now:
+            self.assertEqual([c['document'] for c in changes[:3]],
+                             [{'n': 1}, {'n': 20}, None])
+            self.assertTrue(all(c['time'] for c in changes))
+
+            self.assertEqual([c['seq'] for c in s.changes(since=5)], [6, 7])
+            self.assertEqual([(c['op'], c['id']) for c in
+                              s.changes(since=1, latest=True)],
+                             [('insert', 5), ('update', 3), ('delete', 4),
+                              ('delete', 1)])
+            self.assertEqual(s.last_change(), 7)
+
+            # plain SQL is recorded too:
+            s.cur.execute('UPDATE def SET n=\'99\' WHERE Id=2')
+            self.assertEqual([(c['op'], c['document']) for c in
+                              s.changes(since=7, fields=['n'])],
+                             [('update', {'n': 99})])
+
+            s.disable_changelog()
+            self.assertEqual(s.changelog_settings(), None)
+
+    def test_truncation(self):
+        with DictLiteStore() as s:
+            s.enable_changelog(keep=5)
+            s.store_many([{'n': i} for i in range(20)])
+            self.assertEqual([c['seq'] for c in s.changes(since=15)],
+                             [16, 17, 18, 19, 20])
+            # too far behind to catch up:
+            with self.assertRaises(ValueError):
+                list(s.changes(since=10))
+
+            self.assertEqual(s.truncate_changes(keep=2), 3)
+            self.assertEqual(s.truncate_changes(before=20), 1)
+            self.assertEqual(s.truncate_changes(older_than=-1), 1)
+            self.assertEqual(list(s.changes(since=20)), [])
+            with self.assertRaises(ValueError):
+                list(s.changes(since=19))
+
+            s.store({'n': 'new'})
+            self.assertEqual([c['seq'] for c in s.changes(since=20)], [21])
+
+    def test_compact_and_migrate(self):
+        try:
+            with DictLiteStore('__test.db') as s:
+                s.enable_changelog()
+                s.store({'n': 1, 'gone': 1})
+                s.delete(('gone', '==', 1))
+                s.store({'n': 2})
+                s.compact()
+                s.store({'n': 3})
+                self.assertEqual(s.last_change(), 4)
+
+            migrate_storage('__test.db', storage='json')
+            with DictLiteStore('__test.db') as s:
+                s.update({'n': 4}, False, ('n', '==', 3))
+                self.assertEqual(
+                    [(c['seq'], c['op'], c['document']) for c in
+                     s.changes(since=3)],
+                    [(4, 'insert', {'n': 4}), (5, 'update', {'n': 4})])
+        finally:
+            os.remove('__test.db')
+
+
+class TestTransactions(Basic):
+    def test_commit(self):
+        try:
+            with DictLiteStore('__test.db') as s:
+                with s.transaction():
+                    s.store(ROW1)
+                    s.store(ROW2)
+                with DictLiteStore('__test.db') as other:
+                    self.assertEqual(other.get(), [ROW1, ROW2])
+        finally:
+            os.remove('__test.db')
+
+    def test_rollback(self):
+        with DictLiteStore() as s:
+            s.store(ROW1)
+            with self.assertRaises(ZeroDivisionError):
+                with s.transaction():
+                    s.store(ROW2)
+                    s.update(UPDATE1)
+                    1 / 0
+
+            self.assertEqual(s.get(), [ROW1])
+            # col3 was added, and then rolled back:
+            self.assertFalse('col3' in s.sql_columns)
+            s.store(ROW2)
+            self.assertEqual(s.get(), [ROW1, ROW2])
+
+    def test_nested(self):
+        with DictLiteStore() as s:
+            with s.transaction():
+                s.store(ROW1)
+                try:
+                    with s.transaction():
+                        s.store(ROW2)
+                        raise ValueError()
+                except ValueError:
+                    pass
+                s.store_many([ROW1])
+            self.assertEqual(s.get(), [ROW1, ROW1])
+
+
+class TestWriteBehind(Basic):
+    def test_buffered_until_flush(self):
+        with DictLiteStore(write_behind=True, flush_size=100,
+                           flush_interval=60) as s:
+            self.assertEqual(s.store(ROW1), None)
+            s.update(UPDATE1, False, GOODWHERE)
+            s.store(ROW2)
+            self.assertEqual(s.flush_stats()['queue_depth'], 3)
+            self.assertEqual(s.cur.execute('SELECT * FROM def').fetchall(), [])
+
+            s.flush()
+            stats = s.flush_stats()
+            self.assertEqual(stats['queue_depth'], 0)
+            self.assertEqual(stats['flushes'], 1)
+            self.assertEqual(stats['writes'], 3)
+            self.assertEqual(s.get(), [copy_change(ROW1, UPDATE1), ROW2])
+
+    def test_flush_size(self):
+        with DictLiteStore(write_behind=True, flush_size=5) as s:
+            for n in range(12):
+                s.store({'n': n})
+            self.assertEqual(s.flush_stats()['flushes'], 2)
+            self.assertEqual(s.flush_stats()['queue_depth'], 2)
+
+    def test_flush_interval(self):
+        with DictLiteStore(write_behind=True, flush_interval=0) as s:
+            s.store(ROW1)
+            self.assertEqual(s.flush_stats()['queue_depth'], 0)
+
+    def test_reads_flush_first(self):
+        with DictLiteStore(write_behind=True) as s:
+            s.store(ROW1)
+            self.assertEqual(s.count(), 1)
+            s.store(ROW1)
+            s.delete(GOODWHERE)
+            self.assertEqual(s.get(), [])
+
+    def test_transactions_not_buffered(self):
+        with DictLiteStore(write_behind=True, flush_size=100,
+                           flush_interval=60) as s:
+            s.store({'n': 1})
+            with self.assertRaises(ValueError):
+                with s.transaction():
+                    s.store({'n': 2})
+                    raise ValueError('roll it back')
+            # (what was buffered before is kept, the rolled back one isn't:)
+            self.assertEqual(s.get(), [{'n': 1}])
+            self.assertEqual(s.flush_stats()['queue_depth'], 0)
+
+    def test_failed_flush_kept(self):
+        import sqlite3
+        with DictLiteStore(write_behind=True, flush_size=100,
+                           flush_interval=60) as s:
+            s.create_index('k', unique=True, name='unique_k')
+            for k in (1, 2, 1):
+                s.store({'k': k})
+
+            with self.assertRaises(sqlite3.IntegrityError):
+                s.get()
+            self.assertEqual(s.cur.execute('SELECT * FROM def').fetchall(), [])
+            self.assertEqual(s.flush_stats()['queue_depth'], 3)
+
+            # (drop_index() would flush first, and fail again)
+            s.cur.execute('DROP INDEX unique_k')
+            self.assertEqual(s.count(), 3)
+
+    def test_close_flushes(self):
+        try:
+            with DictLiteStore('__test.db', write_behind=True) as s:
+                s.store(ROW1)
+            with DictLiteStore('__test.db') as s:
+                self.assertEqual(s.get(), [ROW1])
+        finally:
+            os.remove('__test.db')
+
+    def test_flushed_in_background(self):
+        import sqlite3
+        try:
+            with DictLiteStore('__test.db', write_behind=True, flush_size=100,
+                               flush_interval=0.05) as s:
+                s.store(ROW1)
+                other = sqlite3.connect('__test.db')
+                for _ in range(100):
+                    if s.flush_stats()['flushes']:
+                        break
+                    time.sleep(0.02)
+                # (with nothing else written, or done, with the store)
+                self.assertEqual(other.execute('SELECT COUNT(*) FROM def')
+                                 .fetchone()[0], 1)
+                other.close()
+                s.store(ROW2)
+            with DictLiteStore('__test.db') as s:
+                self.assertEqual(s.count(), 2)
+        finally:
+            os.remove('__test.db')
+
+
+class TestResultCache(Basic):
+    def test_write_behind(self):
+        with DictLiteStore(write_behind=True, result_cache=10) as s:
+            s.store(ROW1)
+            self.assertEqual(len(s.get()), 1)
+            s.store(ROW2)
+            self.assertEqual(len(s.get()), 2)
+            self.assertEqual(s.count(), 2)
+
+    def test_hits_and_invalidation(self):
+        with DictLiteStore(result_cache=10) as s:
+            s.store(ROW1)
+            self.assertEqual(s.get(GOODWHERE), [ROW1])
+            self.assertEqual(s.get(GOODWHERE), [ROW1])
+            stats = s.cache_stats()
+            self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+            s.store(ROW1)
+            self.assertEqual(s.get(GOODWHERE), [ROW1, ROW1])
+            s.update(UPDATE1)
+            self.assertEqual(s.get(GOODWHERE), [])
+            s.store_many([ROW1])
+            self.assertEqual(s.get(GOODWHERE), [ROW1])
+            s.delete()
+            self.assertEqual(s.get(GOODWHERE), [])
+
+    def test_results_are_copies(self):
+        with DictLiteStore(result_cache=10) as s:
+            s.store(ROW1)
+            s.get()[0]['col1'] = 'changed'
+            self.assertEqual(s.get(), [ROW1])
+
+    def test_lru_eviction(self):
+        with DictLiteStore(result_cache=2) as s:
+            s.store(ROW1)
+            s.get(('col1', '==', 'a'))
+            s.get(('col1', '==', 'b'))
+            s.get(('col1', '==', 'a'))
+            s.get(('col1', '==', 'c'))  # evicts 'b'
+            s.get(('col1', '==', 'a'))
+            stats = s.cache_stats()
+            self.assertEqual(stats['evictions'], 1)
+            self.assertEqual(stats['hits'], 2)
+            self.assertEqual(stats['size'], 2)
+
+    def test_ttl(self):
+        with DictLiteStore(result_cache=10, result_cache_ttl=0) as s:
+            s.get()
+            s.get()
+            self.assertEqual(s.cache_stats()['hits'], 0)
+
+    def test_other_connection_writes(self):
+        import sqlite3
+        try:
+            with DictLiteStore('__test.db', result_cache=10) as s:
+                s.store(ROW1)
+                s.db.commit()
+                self.assertEqual(s.get(), [ROW1])
+
+                other = sqlite3.connect('__test.db')
+                other.execute('DELETE FROM def')
+                other.commit()
+                other.close()
+
+                self.assertEqual(s.get(), [])
+        finally:
+            os.remove('__test.db')
+
+    def test_rollback(self):
+        with DictLiteStore(result_cache=10) as s:
+            try:
+                with s.transaction():
+                    s.store(ROW1)
+                    self.assertEqual(s.get(), [ROW1])
+                    raise ValueError()
+            except ValueError:
+                pass
+            self.assertEqual(s.get(), [])
+
+
+class TestInstrumentation(Basic):
+    def test_off(self):
+        with DictLiteStore() as s:
+            self.assertNotIn('get', s.__dict__)
+            self.assertIsInstance(s.codec, JSONCodec)
+
+    def test_profiler(self):
+        profiler = Profiler(slow=0)
+        with DictLiteStore(instrument=profiler) as s:
+            s.store_many({'a': i, 'b': u'π%d' % i} for i in range(100))
+            s.get(('a', '==', 5))
+            # (as text, '5' < '50', so that's 0-5 and 10-49)
+            self.assertEqual(len(list(s.iterget(('a', '<', NoJSON('50'))))), 46)
+            with self.assertRaises(KeyError):
+                s.count(('a', 'BAD', 1))
+            s.get_page(size=10)
+            s.enable_changelog()
+            s.update({'c': 1}, False, ('b', 'LIKE', u'π%'))
+            self.assertEqual(len(list(s.changes())), 100)
+
+        stats = profiler.stats()
+        self.assertEqual(stats['store_many']['rows'] >= 100, True)
+        self.assertEqual(stats['store_many']['calls'], 1)
+        self.assertGreater(stats['store_many']['encode_seconds'], 0)
+        self.assertGreater(stats['store_many']['bytes'], 600)
+        self.assertEqual(stats['get']['rows'], 1)
+        self.assertEqual(sum(stats['get']['histogram']), 1)
+        self.assertGreater(stats['iterget']['decode_seconds'], 0)
+        self.assertEqual(stats['iterget']['rows'], 46)
+        self.assertEqual(stats['iterget']['errors'], 0)
+        self.assertEqual(stats['count']['errors'], 1)
+        self.assertEqual(stats['get_page']['calls'], 1)
+        self.assertGreaterEqual(stats['get_page']['rows'], 10)
+        self.assertEqual(stats['changes']['calls'], 1)
+        self.assertGreaterEqual(stats['changes']['rows'], 100)
+
+        plans = [q for q in profiler.slow_queries if q['operation'] == 'get']
+        self.assertIn('SCAN', plans[0]['plans'][0][1][0])
+
+        profiler.reset()
+        self.assertEqual(profiler.stats(), {})
+
+    def test_hooks(self):
+        calls = []
+
+        class Hooks(Instrumentation):
+            def before(self, operation, args):
+                calls.append(('before', operation))
+
+            def after(self, operation, record):
+                calls.append(('after', operation, record['error']))
+
+        with DictLiteStore(instrument=Hooks(), write_behind=True) as s:
+            s.store(ROW1)
+            # (the flush inside get() is part of the get())
+            self.assertEqual(s.get(), [ROW1])
+
+        self.assertEqual(calls, [('before', 'store'), ('after', 'store', None),
+                                 ('before', 'get'), ('after', 'get', None),
+                                 # (and close() flushes:)
+                                 ('before', 'flush'), ('after', 'flush', None)])
+
+
+class TestAsync(unittest.TestCase):
+    def check_store(self, s):
+        futures = [s.store({'n': i}) for i in range(20)]
+        self.assertEqual([f.result() for f in futures], range(1, 21))
+
+        self.assertEqual(s.count().result(), 20)
+        self.assertEqual(s.get(('n', 'IN', NoJSON('3')), order='n').result(),
+                         [{'n': 3}])
+        self.assertEqual(list(s.iterget(batch_size=7)),
+                         [{'n': i} for i in range(20)])
+
+        self.assertEqual(s.update({'n': 99}, False, ('n', '==', 5)).result(),
+                         1)
+        self.assertEqual(s.delete(('n', 'LIKE', NoJSON('1_'))).result(), 10)
+        self.assertEqual(s.get_by_id(6).result(), {'n': 99})
+
+    def test_memory(self):
+        with AsyncDictLiteStore() as s:
+            self.check_store(s)
+
+    def test_file(self):
+        try:
+            with AsyncDictLiteStore('__test.db', readers=3) as s:
+                self.check_store(s)
+        finally:
+            os.remove('__test.db')
+
+    def test_errors_and_callbacks(self):
+        with AsyncDictLiteStore() as s:
+            bad = s.get(('n', 'bogus', 1))
+            with self.assertRaises(KeyError):
+                bad.result()
+
+            import threading
+            called = []
+            finished = threading.Event()
+
+            def callback(future):
+                called.append(future.result())
+                finished.set()
+
+            good = s.store(ROW1)
+            good.add_done_callback(callback)
+            self.assertTrue(finished.wait(5))
+            self.assertEqual(called, [1])
+            # callbacks added after it's done are run straight away:
+            good.add_done_callback(callback)
+            self.assertEqual(called, [1, 1])
+
+    def test_stream_batches(self):
+        with AsyncDictLiteStore() as s:
+            s.store_many([{'n': i} for i in range(5)])
+            stream = s.iterget(batch_size=2)
+            self.assertEqual(len(stream.next_batch().result()), 2)
+            self.assertEqual(len(stream.next_batch().result()), 2)
+            self.assertEqual(len(stream.next_batch().result()), 1)
+            self.assertEqual(stream.next_batch().result(), [])
+
+    def test_stream_close(self):
+        with AsyncDictLiteStore() as s:
+            s.store_many([{'n': i} for i in range(50)])
+            stream = s.iterget(batch_size=1)
+            stream.next_batch().result()
+            stream.close()
+            # the writer isn't stuck on the stream:
+            self.assertEqual(s.store(ROW1).result(), 51)
+
+
+    def test_write_while_streaming_memory(self):
+        with AsyncDictLiteStore() as s:
+            s.store_many([{'n': i} for i in range(10)])
+            for document in s.iterget(batch_size=1):
+                # (the writer is also the reader, and mustn't be stuck)
+                s.update({'seen': 1}, False,
+                         ('n', '==', document['n'])).result()
+            self.assertEqual(s.count(('seen', '==', 1)).result(), 10)
+
+
+class TestSharded(unittest.TestCase):
+    def documents(self):
+        return [{'user': u'user%d' % (i % 7), 'n': i, 'score': (i * 37) % 11}
+                for i in range(50)]
+
+    def test_routing(self):
+        with ShardedDictLiteStore([':memory:'] * 3, key='user',
+                                  codec='native') as s:
+            self.assertEqual(s.store_many(self.documents()), 50)
+            for shard in s.shards:
+                users = set(d['user'] for d in shard.get().result())
+                self.assertTrue(all(s.shard_for(u) == s.shards.index(shard)
+                                    for u in users))
+            self.assertEqual(sum(shard.count().result() for shard in s.shards),
+                             50)
+            self.assertEqual(s._shards_for([('user', '==', u'user1')]),
+                             [s.shard_for(u'user1')])
+            self.assertEqual(s._shards_for([('n', '==', 1)]), [0, 1, 2])
+
+            self.assertEqual(s.count(('user', '==', u'user3')), 7)
+            self.assertTrue(s.exists(('n', '==', 49)))
+            self.assertFalse(s.exists(('n', '==', 50)))
+
+    def test_write_while_streaming_memory(self):
+        with ShardedDictLiteStore([':memory:'] * 2, key='user',
+                                  codec='native') as s:
+            s.store_many(self.documents())
+            for document in s.iterget(batch_size=1):
+                s.update({'seen': 1}, False, ('user', '==', document['user']),
+                         ('n', '==', document['n']))
+            self.assertEqual(s.count(('seen', '==', 1)), 50)
+
+    def test_ranges(self):
+        with ShardedDictLiteStore([':memory:'] * 3, key='n',
+                                  ranges=[10, 20]) as s:
+            self.assertEqual(s.store({'n': 5}), (0, 1))
+            self.assertEqual(s.store({'n': 10}), (1, 1))
+            self.assertEqual(s.store({'n': 99}), (2, 1))
+
+        with self.assertRaises(ValueError):
+            ShardedDictLiteStore([':memory:'] * 3, key='n', ranges=[10])
+
+    def test_merged_order(self):
+        documents = self.documents()
+        with ShardedDictLiteStore([':memory:'] * 4, key='user',
+                                  codec='native') as s:
+            s.store_many(documents)
+
+            expected = sorted(documents, key=lambda d: (-d['score'], d['n']))
+            self.assertEqual(s.get(order=[('score', 'DESC'), 'n']), expected)
+            self.assertEqual(s.get(order=[('score', 'DESC'), 'n'], limit=5,
+                                   offset=10), expected[10:15])
+            self.assertEqual(list(s.iterget(order=[('score', 'DESC'), 'n'])),
+                             expected)
+
+            # sort keys are only fetched for sorting:
+            self.assertEqual(s.get(order='n', fields=['user'], limit=3),
+                             [{'user': u'user0'}, {'user': u'user1'},
+                              {'user': u'user2'}])
+
+            # text sorts after numbers, like in SQLite:
+            s.store({'user': u'x', 'n': u'text'})
+            self.assertEqual(s.get(order=[('n', 'DESC')], limit=2),
+                             [{'user': u'x', 'n': u'text'}, documents[49]])
+
+    def test_update_and_delete(self):
+        with ShardedDictLiteStore([':memory:'] * 3, key='user',
+                                  codec='native') as s:
+            s.store_many(self.documents())
+
+            self.assertEqual(s.update({'flag': True}, False,
+                                      ('user', '==', u'user2')), 7)
+            self.assertEqual(s.count(('flag', '==', True)), 7)
+            self.assertEqual(s.update({'score': 0}, False, ('n', '<', 10)), 10)
+
+            # moving documents between shards isn't allowed:
+            with self.assertRaises(ValueError):
+                s.update({'user': u'someone'}, False, ('n', '==', 1))
+
+            # nothing to update, so it's stored in the right shard:
+            self.assertEqual(s.update({'user': u'new', 'n': 100}, True,
+                                      ('user', '==', u'new')), 1)
+            self.assertEqual(
+                s.shards[s.shard_for(u'new')].count().result(),
+                len([d for d in self.documents()
+                     if s.shard_for(d['user']) == s.shard_for(u'new')]) + 1)
+
+            self.assertEqual(s.delete(('user', 'IN', [u'user1', u'user2'])), 14)
+            self.assertEqual(s.delete(('n', '>=', 40)), 9) # (including n=100)
+            self.assertEqual(s.count(), 28)
+
+    def test_files_and_indexes(self):
+        names = ['__test%d.db' % i for i in range(2)]
+        try:
+            with ShardedDictLiteStore(names, key='user', codec='native') as s:
+                s.store_many(self.documents())
+                s.create_index('n', name='by_n')
+                self.assertEqual(len(s.get(('n', '<', 10), order='n')), 10)
+            with ShardedDictLiteStore(names, key='user', codec='native') as s:
+                self.assertEqual(s.count(), 50)
+                s.drop_index('by_n')
+        finally:
+            for name in names:
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(name + suffix):
+                        os.remove(name + suffix)
+
+
+class TestPooled(unittest.TestCase):
+    def tearDown(self):
+        for name in ('__test.db', '__test.db-wal', '__test.db-shm'):
+            if os.path.exists(name):
+                os.remove(name)
+
+    def test_pragmas(self):
+        with DictLiteStore('__test.db', synchronous='normal', cache_size=-4000,
+                           busy_timeout=1234, mmap_size=0) as s:
+            self.assertEqual(s.cur.execute('PRAGMA synchronous').fetchone()[0], 1)
+            self.assertEqual(s.cur.execute('PRAGMA cache_size').fetchone()[0],
+                             -4000)
+            self.assertEqual(s.cur.execute('PRAGMA busy_timeout').fetchone()[0],
+                             1234)
+
+        with self.assertRaises(ValueError):
+            DictLiteStore(synchronous='0; DROP TABLE def')
+
+    def test_threads(self):
+        import threading
+
+        with DictLiteStore('__test.db', pooled=True, busy_timeout=10000) as s:
+            self.assertEqual(
+                s.cur.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            s.store({'thread': -1, 'n': -1})
+
+            errors = []
+            def work(thread):
+                try:
+                    for n in range(20):
+                        s.store({'thread': thread, 'n': n})
+                        self.assertTrue(s.exists(('thread', '==', thread)))
+                        s.get()
+                except Exception as exc: # pylint: disable=broad-except
+                    errors.append(exc)
+
+            threads = [threading.Thread(target=work, args=(i,))
+                       for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(errors, [])
+            self.assertEqual(s.count(), 81)
+            self.assertEqual(s.count(('thread', '==', 2)), 20)
+
+
+    def test_threads_adding_columns(self):
+        import threading
+
+        with DictLiteStore('__test.db', pooled=True, busy_timeout=10000) as s:
+            for round_number in range(5):
+                errors = []
+                start = threading.Event()
+
+                def work(thread):
+                    start.wait()
+                    try:
+                        for n in range(5):
+                            s.store({'common%d' % round_number: n,
+                                     'thread%d' % thread: n})
+                    except Exception as exc: # pylint: disable=broad-except
+                        errors.append(exc)
+
+                threads = [threading.Thread(target=work, args=(i,))
+                           for i in range(4)]
+                for thread in threads:
+                    thread.start()
+                start.set()
+                for thread in threads:
+                    thread.join()
+
+                self.assertEqual(errors, [])
+                self.assertEqual(
+                    s.count(('common%d' % round_number, 'IS NOT NULL')), 20)
+
+
 class TestUsingFile(unittest.TestCase):
+    def test_column_dropped_elsewhere(self):
+        import sqlite3
+        try:
+            with DictLiteStore('__test.db') as s:
+                s.store({'n': 1, 'gone': 1})
+                s.update({'gone': 2}, False, ('n', '==', 1))
+                s.store_many([{'n': 2, 'gone': 3}])
+                s.delete()
+                s.db.commit()
+
+                # (another process could compact() the table like this:)
+                other = sqlite3.connect('__test.db')
+                other.execute('ALTER TABLE def DROP COLUMN gone')
+                other.commit()
+                other.close()
+
+                s.store({'n': 1, 'gone': 1})
+                s.update({'gone': 2}, False, ('n', '==', 1))
+                s.store_many([{'n': 2, 'gone': 3}])
+                self.assertEqual(s.get(order='n'), [{'n': 1, 'gone': 2},
+                                                    {'n': 2, 'gone': 3}])
+        finally:
+            os.remove('__test.db')
+
     # Other tests:
 
     def test_db_file(self):
@@ -389,6 +1973,74 @@ class TestUsingFile(unittest.TestCase):
 
         self.assertEqual(os.path.exists('__test.db'), False)
 
+    def test_upgrade_old_table(self):
+        import sqlite3
+        db = sqlite3.connect('__test.db')
+        db.execute('CREATE TABLE "def"(Id INT)')
+        db.execute('ALTER TABLE "def" ADD COLUMN "col1"')
+        db.execute('CREATE INDEX "idx" ON "def"("col1")')
+        db.executemany('INSERT INTO "def"("col1") VALUES (?)',
+                       [('"data1"',), ('"data2"',)])
+        db.commit()
+        db.close()
+
+        try:
+            with DictLiteStore('__test.db') as s:
+                self.assertEqual(s.get(), [{'col1': 'data1'}, {'col1': 'data2'}])
+                self.assertEqual(s.get_by_id(2), {'col1': 'data2'})
+                self.assertEqual(s.store({'col1': 'data3'}), 3)
+                self.assertEqual(s.list_indexes()[0]['name'], 'idx')
+        finally:
+            os.remove('__test.db')
+
+    def test_no_commit_without_schema_change(self):
+        import sqlite3
+        try:
+            with DictLiteStore('__test.db') as s:
+                s.store(ROW1)
+                s.store(ROW1)
+                s.store(ROW1)
+
+                other = sqlite3.connect('__test.db')
+                # Only the first store() changed the schema (and committed):
+                self.assertEqual(
+                    other.execute('SELECT COUNT(*) FROM "def"').fetchone()[0],
+                    0)
+                other.close()
+        finally:
+            os.remove('__test.db')
+
+    def test_shared_columns(self):
+        try:
+            with DictLiteStore('__test.db') as a:
+                with DictLiteStore('__test.db') as b:
+                    a.store(ROW1)
+                    a.db.commit()
+                    self.assertTrue('col1' in b.sql_columns)
+                    b.store(ROW1)
+                    self.assertEqual(b.get(order='col1'), [ROW1, ROW1])
+        finally:
+            os.remove('__test.db')
+
+    def test_schema_changed_elsewhere(self):
+        import sqlite3
+        try:
+            with DictLiteStore('__test.db') as s:
+                s.store(ROW1)
+                s.db.commit()
+
+                other = sqlite3.connect('__test.db')
+                other.execute('ALTER TABLE "def" ADD COLUMN "col3"')
+                other.commit()
+                other.close()
+
+                # our cache doesn't know about col3 yet, but mustn't try to
+                # add it again:
+                s.store(ROW2)
+                self.assertEqual(s.get(), [ROW1, ROW2])
+        finally:
+            os.remove('__test.db')
+
 # TODO:
 # - test a different table name.
 # - test deletion